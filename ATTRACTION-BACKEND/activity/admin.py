@@ -12,6 +12,10 @@ class SearchAdmin(admin.ModelAdmin):
         'modes',
         'requested_at',
     )
+    # browsing by month only touches that month's partition; skip the full-table count
+    date_hierarchy = 'requested_at'
+    ordering = ('-requested_at',)
+    show_full_result_count = False
 
     def user_display(self, obj):
         return obj.user.id if obj.user else 'Anonymous'
@@ -0,0 +1,298 @@
+"""Async (ASGI-native) versions of the OTP-bound endpoints.
+
+They answer exactly like PlanTripView, StopsView and get_stop_schedule but
+wait on OTP through the event loop instead of holding a worker thread. Served
+from backend.asgi they let one worker keep many OTP requests in flight; under
+WSGI they still work, one event loop per request, and close their OTP client
+when the request is done.
+"""
+import asyncio
+import functools
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import render
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .board_stream import board_events
+from .boards import BoardUnavailable, UnknownStop, aget_board
+from .gtfs import get_gtfs_store
+from .otp_client import close_async_otp_client, get_async_otp_client, OTPQueryError, OTPUnavailable
+from .planning import (
+    PlanRequest,
+    PlanRequestError,
+    closest_stations,
+    plan_cache,
+    plan_response,
+    shape_plan,
+    simplify_plan_geometry,
+    summarize_plan,
+)
+from .polyline import OTP_PRECISION
+from .serializers import PlanTripSerializer, StopQuerySerializer
+from .search_log import alog_search
+from .stations import InvalidCursor, query_stops
+from .stop_catalogue import stop_catalogue
+from .stop_tiles import InvalidTile, tile_payload
+from .stops_payload import stops_payload
+from .views import departures_response
+
+
+def method_not_allowed(request):
+    return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+def authenticate(request):
+    """JWT authentication as PlanTripView does it; returns the user or None."""
+    result = JWTAuthentication().authenticate(request)
+    return result[0] if result else None
+
+
+def wsgi_closes_otp_client(view):
+    """Under WSGI the request's event loop ends with it: close its OTP client too."""
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await view(request, *args, **kwargs)
+        finally:
+            if not isinstance(request, ASGIRequest):
+                await close_async_otp_client()
+    return wrapper
+
+
+def session_key_for(request):
+    if not request.session.session_key:
+        request.session.create()
+    return request.session.session_key
+
+
+# ------------------------------
+# Plan Trip
+# ------------------------------
+
+async def build_plan(plan_request):
+    """Query OTP and shape the itineraries; returns (response_data, error_response)."""
+    client = get_async_otp_client()
+    plan_task = asyncio.ensure_future(client.query(plan_request.query(), plan_request.variables(), name="plan"))
+    stations_task = asyncio.ensure_future(stop_catalogue.aget())
+    done, pending = await asyncio.wait((plan_task, stations_task), timeout=settings.OTP_REQUEST_DEADLINE)
+    for task in pending:
+        task.cancel()
+
+    if stations_task not in done:
+        return None, JsonResponse({"error": "Failed to fetch stops: timed out"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    try:
+        from_stop, to_stop = closest_stations(stations_task.result(), plan_request.data)
+    except OTPUnavailable as e:
+        plan_task.cancel()
+        return None, JsonResponse({"error": f"Failed to fetch stops: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except OTPQueryError as e:
+        plan_task.cancel()
+        return None, JsonResponse({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+    if plan_task not in done:
+        return None, JsonResponse({"error": "Failed to fetch plan: timed out"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    try:
+        result = plan_task.result()
+    except OTPUnavailable as e:
+        return None, JsonResponse({"error": f"Failed to fetch plan: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except OTPQueryError as e:
+        return None, JsonResponse({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+    return shape_plan(result, plan_request.mode_filter, from_stop, to_stop), None
+
+
+@wsgi_closes_otp_client
+async def plan_trip(request):
+    if request.method != "POST":
+        return method_not_allowed(request)
+
+    try:
+        user = await sync_to_async(authenticate)(request)
+    except AuthenticationFailed as e:
+        detail = e.detail if isinstance(e.detail, dict) else {"detail": e.detail}
+        return JsonResponse(detail, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        payload = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"success": False, "error": "Invalid JSON body."}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = PlanTripSerializer(data=payload)
+    if not serializer.is_valid():
+        return JsonResponse({"success": False, "error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        plan_request = PlanRequest(serializer.validated_data)
+    except PlanRequestError as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # -------- Plan cache ----------
+    cache_key = plan_request.cache_key()
+    options = plan_cache.get(cache_key)
+    if options is None:
+        response_data, error_response = await build_plan(plan_request)
+        if error_response is not None:
+            return error_response
+        plan_cache.set(cache_key, response_data["options"])
+    else:
+        # the options fit every nearby request, the closest stations only this one
+        try:
+            from_stop, to_stop = closest_stations(await stop_catalogue.aget(), plan_request.data)
+        except OTPUnavailable as e:
+            return JsonResponse({"error": f"Failed to fetch stops: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except OTPQueryError as e:
+            return JsonResponse({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        response_data = plan_response(options, from_stop, to_stop)
+    validated = serializer.validated_data
+    if "geometry_tolerance" in validated or "geometry_precision" in validated:
+        response_data = simplify_plan_geometry(
+            response_data,
+            tolerance_m=validated.get("geometry_tolerance", 0),
+            precision=validated.get("geometry_precision", OTP_PRECISION),
+        )
+    if validated["summary"]:
+        response_data = summarize_plan(response_data)
+
+    # ---- Save search ----
+    anonymous_session_key = await sync_to_async(session_key_for)(request) if user is None else None
+    await alog_search(
+        user=user,
+        anonymous_session_key=anonymous_session_key,
+        **plan_request.search_fields()
+    )
+
+    return JsonResponse(response_data, status=status.HTTP_200_OK)
+
+
+# ------------------------------
+# Stops
+# ------------------------------
+
+async def load_catalogue():
+    """The GTFS store, else the OTP stop catalogue, and whether it is stale.
+
+    Loading the store (np.load) reads files, so it runs in a thread, as does
+    whatever blocking work `stop_catalogue.aget()` has to do.
+    """
+    store = await sync_to_async(get_gtfs_store, thread_sensitive=False)()
+    if store is not None:
+        return store, False
+    return await stop_catalogue.aget(), stop_catalogue.stale
+
+
+@wsgi_closes_otp_client
+async def stops(request):
+    if request.method != "GET":
+        return method_not_allowed(request)
+    query = StopQuerySerializer(data=request.GET)
+    if not query.is_valid():
+        return JsonResponse({"success": False, "error": query.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        catalogue, stale = await load_catalogue()
+    except OTPQueryError as e:
+        return JsonResponse({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+    except OTPUnavailable as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    if "bbox" in query.validated_data or "radius" in query.validated_data:
+        try:
+            response_data = query_stops(catalogue.index, catalogue.version, query.validated_data)
+        except InvalidCursor as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if stale:
+            response_data["stale"] = True
+        return JsonResponse(response_data, status=status.HTTP_200_OK)
+    # rendering a new version compresses it (gzip, brotli): keep that off the event loop
+    payload = await sync_to_async(stops_payload, thread_sensitive=False)(
+        catalogue, query.validated_data.get("since"), stale
+    )
+    return payload.response(request)
+
+
+@wsgi_closes_otp_client
+async def stop_tile(request, z, x, y):
+    if request.method != "GET":
+        return method_not_allowed(request)
+    try:
+        catalogue, stale = await load_catalogue()
+    except OTPQueryError as e:
+        return JsonResponse({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+    except OTPUnavailable as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    try:
+        payload = await sync_to_async(tile_payload, thread_sensitive=False)(catalogue, z, x, y, stale=stale)
+    except InvalidTile as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return payload.response(request)
+
+
+# ------------------------------
+# Stop Schedule
+# ------------------------------
+
+@wsgi_closes_otp_client
+async def stop_schedule(request, stop_id):
+    try:
+        board = await aget_board(stop_id)
+    except UnknownStop:
+        return render(request, "stop_schedule.html", {
+            "stop_name": "Unknown Stop",
+            "upcoming_trips": []
+        })
+    except BoardUnavailable as e:
+        return render(request, "stop_schedule.html", {
+            "stop_name": e.stop_name or "Unknown Stop",
+            "upcoming_trips": []
+        }, status=503)
+
+    return render(request, "stop_schedule.html", {
+        "stop_name": board["stop_name"],
+        "upcoming_trips": board["upcoming_trips"],
+        "stale": board["stale"]
+    })
+
+
+@wsgi_closes_otp_client
+async def stop_departures(request, stop_id):
+    if request.method != "GET":
+        return method_not_allowed(request)
+    try:
+        board = await aget_board(stop_id)
+    except UnknownStop:
+        return JsonResponse({"error": "Unknown stop."}, status=status.HTTP_404_NOT_FOUND)
+    except BoardUnavailable as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return departures_response(request, board)
+
+
+async def stop_board_stream(request, stop_id):
+    """Server-Sent Events stream of the stop's board; needs the ASGI server."""
+    if request.method != "GET":
+        return method_not_allowed(request)
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"error": "Streaming is only available through backend.asgi."}, status=status.HTTP_501_NOT_IMPLEMENTED)
+    try:
+        await aget_board(stop_id)
+    except UnknownStop:
+        return JsonResponse({"error": "Unknown stop."}, status=status.HTTP_404_NOT_FOUND)
+    except BoardUnavailable:
+        pass  # the stream reports it and picks up once OTP is back
+
+    response = StreamingHttpResponse(board_events(stop_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+# Token-authenticated JSON endpoints, exempt from CSRF like the DRF views they mirror.
+# (Django 4.2's csrf_exempt decorator would turn these back into sync views.)
+plan_trip.csrf_exempt = True
+stops.csrf_exempt = True
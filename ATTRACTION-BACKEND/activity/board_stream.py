@@ -0,0 +1,143 @@
+"""Live station boards pushed over Server-Sent Events.
+
+Every stop with listeners has one BoardTopic per event loop. Its refresher
+task reads the board every BOARD_STREAM_INTERVAL seconds and fans the changes
+out to all subscribers, so any number of open screens cost one board refresh
+per interval (and, through the board cache, at most one OTP query per minute).
+"""
+import asyncio
+import json
+import logging
+import time
+import weakref
+
+from django.conf import settings
+
+from .boards import BoardUnavailable, UnknownStop, aget_board
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def public_board(board):
+    return {
+        "stop_id": board["stop_id"],
+        "stop_name": board["stop_name"],
+        "stale": board["stale"],
+        "upcoming_trips": board["upcoming_trips"],
+    }
+
+
+def trip_key(trip):
+    return trip["route"], trip["name"], trip["arrival"], trip["departure"]
+
+
+def board_diff(old, new):
+    """Trips removed from and added to the board, or None if nothing changed."""
+    old_keys = {trip_key(trip) for trip in old["upcoming_trips"]}
+    new_keys = {trip_key(trip) for trip in new["upcoming_trips"]}
+    removed = [trip for trip in old["upcoming_trips"] if trip_key(trip) not in new_keys]
+    added = [trip for trip in new["upcoming_trips"] if trip_key(trip) not in old_keys]
+    if not removed and not added and old["stale"] == new["stale"]:
+        return None
+    return {"removed": removed, "added": added, "stale": new["stale"]}
+
+
+class BoardTopic:
+    """Subscribers of one stop and the task refreshing their board."""
+
+    def __init__(self, topics, stop_id):
+        self.topics = topics
+        self.stop_id = stop_id
+        self.subscribers = set()
+        self.board = None
+        self.task = None
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=settings.BOARD_STREAM_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        if self.board is not None:
+            queue.put_nowait(sse_event("board", public_board(self.board)))
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            self.task.cancel()
+            if self.topics.get(self.stop_id) is self:
+                del self.topics[self.stop_id]
+
+    def publish(self, message):
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                if self.board is None:
+                    # no board to catch up with yet, only errors: drop the oldest one
+                    queue.get_nowait()
+                    queue.put_nowait(message)
+                    continue
+                # a listener that fell behind gets the whole board instead of the missed diffs
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(sse_event("board", public_board(self.board)))
+
+    async def run(self):
+        while True:
+            try:
+                board = await aget_board(self.stop_id)
+            except UnknownStop:
+                self.publish(sse_event("error", {"error": "Unknown stop."}))
+            except BoardUnavailable as e:
+                self.publish(sse_event("error", {"error": str(e)}))
+            except Exception:
+                logger.exception("Refreshing the board of %s failed", self.stop_id)
+            else:
+                previous, self.board = self.board, board
+                if previous is None:
+                    self.publish(sse_event("board", public_board(board)))
+                else:
+                    diff = board_diff(previous, board)
+                    if diff is not None:
+                        self.publish(sse_event("diff", diff))
+            await asyncio.sleep(settings.BOARD_STREAM_INTERVAL)
+
+
+_topics = weakref.WeakKeyDictionary()
+
+
+def get_topic(stop_id):
+    """The topic of `stop_id` on the running event loop."""
+    topics = _topics.setdefault(asyncio.get_running_loop(), {})
+    topic = topics.get(stop_id)
+    if topic is None:
+        topic = topics[stop_id] = BoardTopic(topics, stop_id)
+    return topic
+
+
+async def board_events(stop_id):
+    """SSE stream of a stop's board: a full `board` event, then `diff` events.
+
+    Streams end after BOARD_STREAM_MAX_SECONDS; EventSource clients reconnect
+    on their own after the advertised retry delay.
+    """
+    topic = get_topic(stop_id)
+    queue = topic.subscribe()
+    deadline = time.monotonic() + settings.BOARD_STREAM_MAX_SECONDS
+    try:
+        yield f"retry: {settings.BOARD_STREAM_RETRY_MS}\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout=min(settings.BOARD_STREAM_KEEPALIVE, remaining))
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        topic.unsubscribe(queue)
@@ -0,0 +1,148 @@
+"""Station departure boards shared by the station page and the departures API.
+
+A board is computed at most once per stop and minute: it is built for the
+start of the minute and kept in `board_cache` under (stop_id, minute bucket).
+Boards come from the local GTFS store when it is authoritative, otherwise
+from OTP, falling back to the last good board or the scheduled times while
+OTP is down.
+"""
+import hashlib
+import json
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .cache import LRUCache
+from .gtfs import get_gtfs_store
+from .otp_client import get_async_otp_client, get_otp_client, OTPQueryError, OTPUnavailable
+from .stations import SCHEDULE_QUERY, schedule_cache, seconds_since_midnight, upcoming_trips
+from .stop_catalogue import stop_catalogue
+
+board_cache = LRUCache(settings.BOARD_CACHE_SIZE, ttl=60)
+
+
+class UnknownStop(Exception):
+    """Neither the GTFS store nor OTP know the stop."""
+
+
+class BoardUnavailable(Exception):
+    """OTP is unavailable and there is no board to fall back to."""
+
+    def __init__(self, stop_name=None):
+        super().__init__("Departures are temporarily unavailable")
+        self.stop_name = stop_name
+
+
+def minute_bucket(now):
+    return int(now.timestamp() // 60)
+
+
+def content_version(trips):
+    return hashlib.sha1(json.dumps(trips, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def make_board(stop_id, stop_name, trips, version, now, stale=False):
+    return {
+        "stop_id": stop_id,
+        "stop_name": stop_name,
+        "upcoming_trips": trips,
+        "stale": stale,
+        "version": version,
+        "minute": minute_bucket(now),
+    }
+
+
+def board_etag(board):
+    """Strong ETag of a board: changes with the minute, the feed or OTP answer, and staleness."""
+    tag = f'{board["stop_id"]}|{board["minute"]}|{board["version"]}|{int(board["stale"])}'
+    return '"%s"' % hashlib.sha1(tag.encode("utf-8")).hexdigest()[:32]
+
+
+def local_board(stop_id, now):
+    """Board from the GTFS store, or None when OTP should be asked instead."""
+    store = get_gtfs_store()
+    if store is None or settings.GTFS_REALTIME_OVERLAY:
+        return None
+    stop = store.stop(stop_id)
+    if stop is None:
+        raise UnknownStop(stop_id)
+    return make_board(stop_id, stop["name"], store.upcoming_trips(stop_id, now), store.version, now)
+
+
+def check_known(stop_id):
+    # QR codes pointing at stops OTP does not know can be answered without a round-trip
+    catalogue = stop_catalogue.peek()
+    if catalogue is not None and stop_id not in catalogue.by_id:
+        raise UnknownStop(stop_id)
+
+
+def otp_board(stop_id, data, now):
+    stop = data.get("stop")
+    if not stop:
+        raise UnknownStop(stop_id)
+    schedule_cache.set(stop_id, stop)
+    trips = upcoming_trips(stop, seconds_since_midnight(now))
+    return make_board(stop_id, stop["name"], trips, content_version(trips), now)
+
+
+def fallback_board(stop_id, now):
+    """Stale board while OTP is unavailable: last OTP answer, else scheduled times."""
+    cached_stop = schedule_cache.get(stop_id)
+    if cached_stop is not None:
+        trips = upcoming_trips(cached_stop, seconds_since_midnight(now))
+        return make_board(stop_id, cached_stop["name"], trips, content_version(trips), now, stale=True)
+
+    store = get_gtfs_store()
+    stop = store.stop(stop_id) if store is not None else None
+    if stop is not None:
+        return make_board(stop_id, stop["name"], store.upcoming_trips(stop_id, now), store.version, now, stale=True)
+
+    catalogue = stop_catalogue.peek()
+    known_stop = catalogue.by_id.get(stop_id) if catalogue is not None else None
+    raise BoardUnavailable(known_stop["name"] if known_stop else None)
+
+
+def get_board(stop_id, now=None):
+    """Board of `stop_id` for the current minute; raises UnknownStop or BoardUnavailable."""
+    now = (now or datetime.now()).replace(second=0, microsecond=0)
+    key = (stop_id, minute_bucket(now))
+    board = board_cache.get(key)
+    if board is not None:
+        return board
+
+    board = local_board(stop_id, now)
+    if board is None:
+        check_known(stop_id)
+        try:
+            data = get_otp_client().query(SCHEDULE_QUERY, {"stopId": stop_id}, name="stop_schedule")
+        except OTPUnavailable:
+            return fallback_board(stop_id, now)
+        except OTPQueryError:
+            data = {}
+        board = otp_board(stop_id, data, now)
+    board_cache.set(key, board)
+    return board
+
+
+async def aget_board(stop_id, now=None):
+    """`get_board()` for the async views."""
+    now = (now or datetime.now()).replace(second=0, microsecond=0)
+    key = (stop_id, minute_bucket(now))
+    board = board_cache.get(key)
+    if board is not None:
+        return board
+
+    # both may load the GTFS store (np.load) and build today's departure index
+    board = await sync_to_async(local_board, thread_sensitive=False)(stop_id, now)
+    if board is None:
+        check_known(stop_id)
+        try:
+            data = await get_async_otp_client().query(SCHEDULE_QUERY, {"stopId": stop_id}, name="stop_schedule")
+        except OTPUnavailable:
+            return await sync_to_async(fallback_board, thread_sensitive=False)(stop_id, now)
+        except OTPQueryError:
+            data = {}
+        board = otp_board(stop_id, data, now)
+    board_cache.set(key, board)
+    return board
@@ -0,0 +1,136 @@
+"""Columnar stop catalogue file shared by all workers of a host.
+
+Layout: 8-byte magic, little-endian uint32 header length, JSON header, then
+8-byte aligned sections: float64 `lat` and `lon` arrays, and for every string
+field a uint32 offset table (`<field>_offsets`, count + 1 entries) into a
+UTF-8 blob (`<field>_data`). Missing coordinates are stored as NaN and a
+missing code as an empty string.
+
+Writers replace the file with os.replace(), so readers see either the old or
+the new version. A reader that mapped the old file keeps using it until it
+drops its MappedCatalogue.
+"""
+import json
+import mmap
+import os
+import struct
+import time
+from collections.abc import Sequence
+
+import numpy as np
+
+# bumped when the meaning of a field changes (2: `id` is the GTFS id), so older files are ignored
+MAGIC = b"ATSTOPS2"
+STRING_FIELDS = ("id", "name", "code")
+ALIGNMENT = 8
+
+
+def _aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def file_identity(path):
+    """What changes when the file is replaced; None if there is no file."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+
+def write_catalogue(path, stops, version):
+    """Write `stops` (OTP stop dicts) to `path` atomically."""
+    coordinates = {
+        field: np.array([np.nan if stop.get(field) is None else stop[field] for stop in stops], dtype=np.float64)
+        for field in ("lat", "lon")
+    }
+    sections = dict(coordinates)
+    for field in STRING_FIELDS:
+        encoded = [(stop.get(field) or "").encode("utf-8") for stop in stops]
+        offsets = np.zeros(len(stops) + 1, dtype=np.uint32)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        sections[f"{field}_offsets"] = offsets
+        sections[f"{field}_data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    layout = {}
+    position = 0
+    for name, array in sections.items():
+        layout[name] = [position, array.dtype.str, int(array.size)]
+        position = _aligned(position + array.nbytes)
+    header = json.dumps({
+        "version": version,
+        "count": len(stops),
+        "written_at": time.time(),
+        "sections": layout,
+    }).encode("utf-8")
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header)) + header)
+        base = _aligned(f.tell())
+        for name, array in sections.items():
+            f.seek(base + layout[name][0])
+            f.write(array.tobytes())
+        # empty trailing sections (e.g. no stop has a code) still need their offset inside the file
+        f.truncate(base + position)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class MappedCatalogue(Sequence):
+    """Read-only, memory-mapped view of a catalogue file.
+
+    Behaves like the list of OTP stop dicts it was written from; every item
+    is decoded from the shared pages on access. `lats` and `lons` are
+    zero-copy arrays over the mapping.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = stat.st_dev, stat.st_ino, stat.st_mtime_ns
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a stop catalogue file")
+        (header_size,) = struct.unpack_from("<I", self._mmap, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        header = json.loads(self._mmap[header_start:header_start + header_size])
+        base = _aligned(header_start + header_size)
+
+        self.version = header["version"]
+        self.written_at = header["written_at"]
+        self.count = header["count"]
+        self._arrays = {
+            name: np.frombuffer(self._mmap, dtype=np.dtype(dtype), count=size, offset=base + offset)
+            for name, (offset, dtype, size) in header["sections"].items()
+        }
+        self.lats = self._arrays["lat"]
+        self.lons = self._arrays["lon"]
+
+    def __len__(self):
+        return self.count
+
+    def _string(self, field, i):
+        offsets = self._arrays[f"{field}_offsets"]
+        return self._arrays[f"{field}_data"][offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+    def ids(self):
+        return [self._string("id", i) for i in range(self.count)]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        lat, lon = self.lats[i], self.lons[i]
+        return {
+            "id": self._string("id", i),
+            "name": self._string("name", i),
+            "lat": None if np.isnan(lat) else float(lat),
+            "lon": None if np.isnan(lon) else float(lon),
+            "code": self._string("code", i) or None,
+        }
@@ -0,0 +1,89 @@
+"""Vectorized haversine kernels.
+
+Array counterparts of `geo.haversine()`: every function takes latitudes and
+longitudes in decimal degrees and returns distances in meters. Queries against
+many points (a stop array, a batch of `Search` origins) are evaluated in one
+NumPy pass instead of a Python loop.
+"""
+import numpy as np
+
+EARTH_RADIUS_M = 6371000  # Radius of Earth in meters
+
+# rows of the (queries x points) distance matrix evaluated at once
+CHUNK_ROWS = 256
+
+
+def as_coordinates(lats, lons):
+    return np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+
+
+def haversine_to_many(lat, lon, lats, lons):
+    """Distances from one point to every point of `lats`/`lons`."""
+    lats, lons = as_coordinates(lats, lons)
+    lat1 = np.radians(lat)
+    lat2 = np.radians(lats)
+    dlat = lat2 - lat1
+    dlon = np.radians(lons) - np.radians(lon)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def haversine_matrix(query_lats, query_lons, lats, lons):
+    """(len(queries), len(points)) matrix of distances."""
+    query_lats, query_lons = as_coordinates(query_lats, query_lons)
+    lats, lons = as_coordinates(lats, lons)
+    lat1 = np.radians(query_lats)[:, None]
+    lat2 = np.radians(lats)[None, :]
+    dlat = lat2 - lat1
+    dlon = np.radians(lons)[None, :] - np.radians(query_lons)[:, None]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def nearest(query_lats, query_lons, lats, lons):
+    """Index of and distance to the closest point for each query.
+
+    Ties resolve to the lowest index, like a linear scan would. The matrix is
+    built in blocks of CHUNK_ROWS queries to keep memory bounded.
+    """
+    query_lats, query_lons = as_coordinates(query_lats, query_lons)
+    count = len(query_lats)
+    indices = np.empty(count, dtype=np.intp)
+    distances = np.empty(count, dtype=np.float64)
+    if count == 0 or len(lats) == 0:
+        indices.fill(-1)
+        distances.fill(np.inf)
+        return indices, distances
+
+    for start in range(0, count, CHUNK_ROWS):
+        stop = start + CHUNK_ROWS
+        block = haversine_matrix(query_lats[start:stop], query_lons[start:stop], lats, lons)
+        best = np.argmin(block, axis=1)
+        indices[start:stop] = best
+        distances[start:stop] = block[np.arange(len(best)), best]
+    return indices, distances
+
+
+def top_k(lat, lon, lats, lons, k):
+    """Indices and distances of the `k` closest points, closest first."""
+    distances = haversine_to_many(lat, lon, lats, lons)
+    k = min(k, len(distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+    if k < len(distances):
+        candidates = np.argpartition(distances, k - 1)[:k]
+        # argpartition may pick any of several equally distant points at the boundary
+        boundary = distances[candidates].max()
+        candidates = np.flatnonzero(distances <= boundary)
+    else:
+        candidates = np.arange(len(distances))
+    order = candidates[np.lexsort((candidates, distances[candidates]))][:k]
+    return order, distances[order]
+
+
+def within_radius(lat, lon, lats, lons, radius_m):
+    """Indices and distances of points within `radius_m`, closest first."""
+    distances = haversine_to_many(lat, lon, lats, lons)
+    inside = np.flatnonzero(distances <= radius_m)
+    order = inside[np.argsort(distances[inside], kind="stable")]
+    return order, distances[order]
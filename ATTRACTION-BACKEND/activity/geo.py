@@ -0,0 +1,176 @@
+import heapq
+from math import radians, degrees, cos, sin, asin, sqrt, floor
+
+import numpy as np
+
+from .distance import EARTH_RADIUS_M, haversine_to_many
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    # Convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    # Haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    c = 2 * asin(sqrt(a))
+    return c * EARTH_RADIUS_M
+
+
+class StopIndex:
+    """Uniform lat/lon grid over the stops for nearest / radius lookups.
+
+    Candidates are always ranked by exact haversine distance, so the answers
+    are the ones a linear scan over the stop list would give (ties go to the
+    stop that comes first in the list). Cells are searched ring by ring around the query
+    and the search stops as soon as no unvisited cell can hold a closer stop.
+    """
+
+    def __init__(self, stops, cell_size=0.01):
+        self.cell_size = cell_size
+        self.cells = {}
+
+        # memory-mapped catalogues expose their coordinates as arrays (NaN when missing)
+        lats, lons = getattr(stops, "lats", None), getattr(stops, "lons", None)
+        if lats is None:
+            lats = np.array([np.nan if stop.get("lat") is None else stop["lat"] for stop in stops], dtype=np.float64)
+            lons = np.array([np.nan if stop.get("lon") is None else stop["lon"] for stop in stops], dtype=np.float64)
+        located = ~(np.isnan(lats) | np.isnan(lons))
+        if located.all():
+            self.stops = stops
+            self.lats, self.lons = lats, lons
+        else:
+            self.stops = [stops[i] for i in np.flatnonzero(located)]
+            self.lats, self.lons = lats[located], lons[located]
+
+        xs = np.floor(self.lons / cell_size).astype(np.int64).tolist()
+        ys = np.floor(self.lats / cell_size).astype(np.int64).tolist()
+        for position, cell in enumerate(zip(xs, ys)):
+            self.cells.setdefault(cell, []).append(position)
+
+        self.max_abs_lat = float(np.abs(self.lats).max()) if len(self.lats) else 0.0
+        if self.cells:
+            xs = [cx for cx, _ in self.cells]
+            ys = [cy for _, cy in self.cells]
+            self.bounds = (min(xs), min(ys), max(xs), max(ys))
+        else:
+            self.bounds = None
+
+    def __len__(self):
+        return len(self.stops)
+
+    def _cell(self, lat, lon):
+        return floor(lon / self.cell_size), floor(lat / self.cell_size)
+
+    def _lon_distance_floor(self, dlon_deg, lat):
+        """Smallest possible distance between two points `dlon_deg` apart in longitude."""
+        if dlon_deg <= 0:
+            return 0.0
+        if dlon_deg >= 180:
+            dlon_deg = 180
+        max_lat = radians(max(self.max_abs_lat, abs(lat)))
+        return 2 * EARTH_RADIUS_M * asin(min(1.0, cos(max_lat) * sin(radians(dlon_deg) / 2)))
+
+    def _ring_floor(self, lat, lon, cx, cy, r):
+        """Lower bound on the distance to any stop outside the (2r+1)^2 block around (cx, cy)."""
+        lat_gap = min(lat - (cy - r) * self.cell_size, (cy + r + 1) * self.cell_size - lat)
+        lon_gap = min(lon - (cx - r) * self.cell_size, (cx + r + 1) * self.cell_size - lon)
+        return min(radians(max(lat_gap, 0.0)) * EARTH_RADIUS_M, self._lon_distance_floor(lon_gap, lat))
+
+    def _ring(self, cx, cy, r):
+        min_x, min_y, max_x, max_y = self.bounds
+        x_lo, x_hi = max(cx - r, min_x), min(cx + r, max_x)
+        y_lo, y_hi = max(cy - r, min_y), min(cy + r, max_y)
+        if x_lo > x_hi or y_lo > y_hi:
+            return
+        cells = self.cells
+        for y in {cy - r, cy + r}:
+            if y_lo <= y <= y_hi:
+                for x in range(x_lo, x_hi + 1):
+                    yield from cells.get((x, y), ())
+        for x in {cx - r, cx + r}:
+            if x_lo <= x <= x_hi:
+                for y in range(max(y_lo, cy - r + 1), min(y_hi, cy + r - 1) + 1):
+                    yield from cells.get((x, y), ())
+
+    def _first_ring(self, cx, cy):
+        min_x, min_y, max_x, max_y = self.bounds
+        return max(min_x - cx, cx - max_x, min_y - cy, cy - max_y, 0)
+
+    def _last_ring(self, cx, cy):
+        min_x, min_y, max_x, max_y = self.bounds
+        return max(cx - min_x, max_x - cx, cy - min_y, max_y - cy)
+
+    def nearest_k(self, lat, lon, k):
+        """Return up to `k` (distance_m, stop) pairs, closest first."""
+        if not self.stops or k <= 0:
+            return []
+        cx, cy = self._cell(lat, lon)
+        best = []  # max-heap of (-distance, -position)
+        lats, lons = self.lats, self.lons
+        for r in range(self._first_ring(cx, cy), self._last_ring(cx, cy) + 1):
+            for position in self._ring(cx, cy, r):
+                candidate = (-haversine(lon, lat, float(lons[position]), float(lats[position])), -position)
+                if len(best) < k:
+                    heapq.heappush(best, candidate)
+                elif candidate > best[0]:
+                    heapq.heapreplace(best, candidate)
+            if len(best) == k and self._ring_floor(lat, lon, cx, cy, r) > -best[0][0]:
+                break
+        return [(-dist, self.stops[-position]) for dist, position in sorted(best, reverse=True)]
+
+    def nearest(self, lat, lon):
+        found = self.nearest_k(lat, lon, 1)
+        return found[0][1] if found else None
+
+    def within_radius(self, lat, lon, radius_m):
+        """Return (distance_m, stop) pairs within `radius_m`, closest first."""
+        if not self.stops or radius_m < 0:
+            return []
+        dlat = degrees(radius_m / EARTH_RADIUS_M)
+        max_lat = radians(min(max(self.max_abs_lat, abs(lat)), 89.999))
+        spread = sin(radius_m / (2 * EARTH_RADIUS_M)) / cos(max_lat)
+        dlon = 180.0 if spread >= 1 else degrees(2 * asin(spread))
+
+        min_x, min_y = self._cell(lat - dlat, lon - dlon)
+        max_x, max_y = self._cell(lat + dlat, lon + dlon)
+        b_min_x, b_min_y, b_max_x, b_max_y = self.bounds
+        candidates = []
+        for x in range(max(min_x, b_min_x), min(max_x, b_max_x) + 1):
+            for y in range(max(min_y, b_min_y), min(max_y, b_max_y) + 1):
+                candidates.extend(self.cells.get((x, y), ()))
+        if not candidates:
+            return []
+
+        # candidate sets can run into the hundreds, so rank them in one vectorized pass
+        candidates = np.array(candidates, dtype=np.intp)
+        distances = haversine_to_many(lat, lon, self.lats[candidates], self.lons[candidates])
+        inside = distances <= radius_m
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.lexsort((candidates, distances))
+        return [(float(distances[i]), self.stops[candidates[i]]) for i in order]
+
+    def within_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Return the stops inside the box, in stop list order."""
+        if not self.stops or min_lat > max_lat or min_lon > max_lon:
+            return []
+        min_x, min_y = self._cell(min_lat, min_lon)
+        max_x, max_y = self._cell(max_lat, max_lon)
+        b_min_x, b_min_y, b_max_x, b_max_y = self.bounds
+        min_x, min_y = max(min_x, b_min_x), max(min_y, b_min_y)
+        max_x, max_y = min(max_x, b_max_x), min(max_y, b_max_y)
+        if min_x > max_x or min_y > max_y:
+            return []
+
+        if (max_x - min_x + 1) * (max_y - min_y + 1) <= len(self.cells):
+            cells = (self.cells.get((x, y), ()) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1))
+        else:
+            # a box wider than the populated area: walk the occupied cells instead
+            cells = (
+                positions for (x, y), positions in self.cells.items()
+                if min_x <= x <= max_x and min_y <= y <= max_y
+            )
+        candidates = np.fromiter((position for positions in cells for position in positions), dtype=np.intp)
+        lats, lons = self.lats[candidates], self.lons[candidates]
+        inside = (min_lat <= lats) & (lats <= max_lat) & (min_lon <= lons) & (lons <= max_lon)
+        return [self.stops[position] for position in np.sort(candidates[inside])]
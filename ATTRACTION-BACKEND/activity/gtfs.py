@@ -0,0 +1,348 @@
+"""Static GTFS feed stored as NumPy arrays.
+
+`ingest_gtfs` turns a GTFS zip into one .npz file: stops, routes, trips and
+service calendars as column arrays, and stop_times grouped by stop (CSR
+layout: the departures of stop `i` are rows `stop_time_offsets[i]` to
+`stop_time_offsets[i + 1]`, sorted by arrival). `GTFSStore` reads that file
+and answers the stops list and station boards without asking OTP; boards
+come from a `DepartureIndex` of the current service day, rebuilt in the
+background when the day or the feed changes; a failed build is retried after
+GTFS_INDEX_RETRY_INTERVAL seconds, boards are scanned on the spot meanwhile.
+"""
+import csv
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+import zipfile
+from datetime import datetime
+from functools import cached_property
+
+import numpy as np
+from django.conf import settings
+
+from .geo import StopIndex
+from .stations import MIDNIGHT_SECONDS, clock, seconds_since_midnight
+
+logger = logging.getLogger(__name__)
+
+# calendar.txt weekday columns, in date.weekday() order
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+class GTFSError(Exception):
+    """The feed is missing a required file or column."""
+
+
+def _read_table(archive, name, required=True):
+    """Rows of a feed file as dicts; an absent optional file yields no rows."""
+    try:
+        raw = archive.open(name)
+    except KeyError:
+        if required:
+            raise GTFSError(f"{name} is missing from the feed")
+        return []
+    with raw, io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def _column(rows, name, table):
+    try:
+        return [row[name] for row in rows]
+    except KeyError:
+        raise GTFSError(f"{table} has no {name} column")
+
+
+def parse_gtfs_time(value):
+    """Seconds since midnight of a GTFS HH:MM:SS (hours may exceed 23); None if blank."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def _date_number(value):
+    return int(value.strip())
+
+
+def build_arrays(archive, feed_id):
+    """Column arrays of an open GTFS zip, as stored by `ingest()`."""
+    stops = _read_table(archive, "stops.txt")
+    routes = _read_table(archive, "routes.txt")
+    trips = _read_table(archive, "trips.txt")
+    stop_times = _read_table(archive, "stop_times.txt")
+    calendar = _read_table(archive, "calendar.txt", required=False)
+    calendar_dates = _read_table(archive, "calendar_dates.txt", required=False)
+
+    stop_ids = _column(stops, "stop_id", "stops.txt")
+    stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+    route_index = {route_id: i for i, route_id in enumerate(_column(routes, "route_id", "routes.txt"))}
+    trip_index = {trip_id: i for i, trip_id in enumerate(_column(trips, "trip_id", "trips.txt"))}
+
+    service_ids = []
+    service_index = {}
+    for service_id in [row["service_id"] for row in calendar] + _column(trips, "service_id", "trips.txt") + [
+        row["service_id"] for row in calendar_dates
+    ]:
+        if service_id not in service_index:
+            service_index[service_id] = len(service_ids)
+            service_ids.append(service_id)
+
+    service_days = np.zeros((len(service_ids), 7), dtype=bool)
+    service_start = np.zeros(len(service_ids), dtype=np.int32)
+    service_end = np.zeros(len(service_ids), dtype=np.int32)
+    for row in calendar:
+        i = service_index[row["service_id"]]
+        service_days[i] = [row.get(day, "0").strip() == "1" for day in WEEKDAYS]
+        service_start[i] = _date_number(row["start_date"])
+        service_end[i] = _date_number(row["end_date"])
+
+    arrivals, departures, time_trips, time_stops = [], [], [], []
+    for row in stop_times:
+        arrival = parse_gtfs_time(row.get("arrival_time"))
+        departure = parse_gtfs_time(row.get("departure_time"))
+        if arrival is None and departure is None:
+            continue  # untimed stop, OTP interpolates these
+        stop = stop_index.get(row["stop_id"])
+        trip = trip_index.get(row["trip_id"])
+        if stop is None or trip is None:
+            continue
+        arrivals.append(arrival if arrival is not None else departure)
+        departures.append(departure if departure is not None else arrival)
+        time_trips.append(trip)
+        time_stops.append(stop)
+
+    time_stops = np.asarray(time_stops, dtype=np.int32)
+    arrivals = np.asarray(arrivals, dtype=np.int32)
+    order = np.lexsort((arrivals, time_stops))
+    offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(time_stops, minlength=len(stop_ids)), out=offsets[1:])
+
+    return {
+        "feed_id": np.asarray(feed_id),
+        "stop_id": np.asarray(stop_ids, dtype=str),
+        "stop_name": np.asarray(_column(stops, "stop_name", "stops.txt"), dtype=str),
+        "stop_code": np.asarray([row.get("stop_code", "") for row in stops], dtype=str),
+        "stop_lat": np.asarray([float(row["stop_lat"] or "nan") for row in stops], dtype=np.float64),
+        "stop_lon": np.asarray([float(row["stop_lon"] or "nan") for row in stops], dtype=np.float64),
+        "route_short_name": np.asarray([row.get("route_short_name", "") for row in routes], dtype=str),
+        "route_long_name": np.asarray([row.get("route_long_name", "") for row in routes], dtype=str),
+        "trip_route": np.asarray([route_index.get(row["route_id"], -1) for row in trips], dtype=np.int32),
+        "trip_service": np.asarray([service_index[row["service_id"]] for row in trips], dtype=np.int32),
+        "trip_headsign": np.asarray([row.get("trip_headsign", "") for row in trips], dtype=str),
+        "service_id": np.asarray(service_ids, dtype=str),
+        "service_days": service_days,
+        "service_start": service_start,
+        "service_end": service_end,
+        "exception_service": np.asarray([service_index[row["service_id"]] for row in calendar_dates], dtype=np.int32),
+        "exception_date": np.asarray([_date_number(row["date"]) for row in calendar_dates], dtype=np.int32),
+        "exception_type": np.asarray([int(row["exception_type"]) for row in calendar_dates], dtype=np.int8),
+        "stop_time_offsets": offsets,
+        "stop_time_arrival": arrivals[order],
+        "stop_time_departure": np.asarray(departures, dtype=np.int32)[order],
+        "stop_time_trip": np.asarray(time_trips, dtype=np.int32)[order],
+    }
+
+
+def feed_version(path):
+    """Content hash of a feed file, used to tell feeds apart."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def ingest(feed_path, store_path, feed_id):
+    """Convert the GTFS zip at `feed_path` and atomically replace `store_path`."""
+    with zipfile.ZipFile(feed_path) as archive:
+        arrays = build_arrays(archive, feed_id)
+    arrays["feed_version"] = np.asarray(feed_version(feed_path))
+
+    directory = os.path.dirname(os.path.abspath(store_path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{store_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, store_path)
+    return GTFSStore(arrays)
+
+
+class GTFSStore:
+    """Read-only view of an ingested feed."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.feed_id = str(arrays["feed_id"])
+        self.version = str(arrays["feed_version"])
+        self.stop_time_offsets = arrays["stop_time_offsets"]
+        self.stop_time_arrival = arrays["stop_time_arrival"]
+        self.stop_time_departure = arrays["stop_time_departure"]
+        self.stop_time_trip = arrays["stop_time_trip"]
+        self.trip_service = arrays["trip_service"]
+        self.trip_route = arrays["trip_route"]
+
+        # stops in the shape the stop catalogue has them, ids being the GTFS ids OTP uses
+        # ("Feed:StopId"), so either source answers /stops with ids the other resolves
+        self.stops = [
+            {
+                "id": f"{self.feed_id}:{stop_id}",
+                "name": str(name),
+                "lat": None if np.isnan(lat) else float(lat),
+                "lon": None if np.isnan(lon) else float(lon),
+                "code": str(code) or None,
+            }
+            for stop_id, name, lat, lon, code in zip(
+                arrays["stop_id"], arrays["stop_name"], arrays["stop_lat"], arrays["stop_lon"], arrays["stop_code"]
+            )
+        ]
+        self.stop_index = {stop["id"]: i for i, stop in enumerate(self.stops)}
+
+        self._day_index = None
+        self._building = None
+        self._next_attempt = 0.0
+        self._index_lock = threading.Lock()
+
+    @cached_property
+    def index(self):
+        return StopIndex(self.stops)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            return cls({name: npz[name] for name in npz.files})
+
+    def stop(self, stop_id):
+        index = self.stop_index.get(stop_id)
+        return None if index is None else self.stops[index]
+
+    def active_services(self, day):
+        """Boolean mask over services running on `day`."""
+        day_number = day.year * 10000 + day.month * 100 + day.day
+        active = (
+            self.arrays["service_days"][:, day.weekday()]
+            & (self.arrays["service_start"] <= day_number)
+            & (day_number <= self.arrays["service_end"])
+        )
+        on_day = self.arrays["exception_date"] == day_number
+        services = self.arrays["exception_service"]
+        active[services[on_day & (self.arrays["exception_type"] == 1)]] = True
+        active[services[on_day & (self.arrays["exception_type"] == 2)]] = False
+        return active
+
+    def board_entries(self, rows):
+        """Station board entries for stop_time rows."""
+        routes = self.trip_route[self.stop_time_trip[rows]]
+        return [
+            {
+                "route": str(self.arrays["route_short_name"][route]) if route >= 0 else "",
+                "name": str(self.arrays["route_long_name"][route]) if route >= 0 else "",
+                "arrival": clock(int(self.stop_time_arrival[row])),
+                "departure": clock(int(self.stop_time_departure[row])),
+            }
+            for row, route in zip(rows, routes)
+        ]
+
+    def upcoming_trips(self, stop_id, now=None):
+        """Scheduled departures from `now` until midnight, shaped like `stations.upcoming_trips()`."""
+        index = self.stop_index.get(stop_id)
+        if index is None:
+            return []
+        now = now or datetime.now()
+        day_index = self.departure_index(now.date())
+        if day_index is not None:
+            return day_index.upcoming(index, seconds_since_midnight(now))
+        return self.scan_upcoming(index, now)
+
+    def scan_upcoming(self, index, now):
+        """`upcoming_trips()` without a day index: filters the stop's services on the spot."""
+        start, end = self.stop_time_offsets[index], self.stop_time_offsets[index + 1]
+        arrivals = self.stop_time_arrival[start:end]
+        first = start + np.searchsorted(arrivals, seconds_since_midnight(now), side="left")
+        last = start + np.searchsorted(arrivals, MIDNIGHT_SECONDS, side="right")
+
+        trips = self.stop_time_trip[first:last]
+        running = self.active_services(now.date())[self.trip_service[trips]]
+        return self.board_entries(np.flatnonzero(running) + first)
+
+    def departure_index(self, day):
+        """The DepartureIndex of `day`, or None while it is being built in the background."""
+        day_index = self._day_index
+        if day_index is not None and day_index.day == day:
+            return day_index
+        with self._index_lock:
+            if self._building != day and time.monotonic() >= self._next_attempt:
+                self._building = day
+                threading.Thread(
+                    target=self._build_index, args=(day,), name="gtfs-departure-index", daemon=True
+                ).start()
+        return None
+
+    def _build_index(self, day):
+        try:
+            day_index = DepartureIndex(self, day)
+        except Exception:
+            logger.exception("Building the departure index for %s failed", day)
+            day_index = None
+        with self._index_lock:
+            if day_index is not None:
+                self._day_index = day_index
+            else:
+                # a failing build would fail again right away: back off instead of rebuilding per request
+                self._next_attempt = time.monotonic() + settings.GTFS_INDEX_RETRY_INTERVAL
+            self._building = None
+
+
+class DepartureIndex:
+    """Departures of every stop on one service day.
+
+    Only stop times of services running that day are kept, in the store's
+    stop-then-arrival order, so the board of a stop from a given time until
+    midnight is a binary search on its arrival seconds plus a list slice of
+    preformatted entries.
+    """
+
+    def __init__(self, store, day):
+        self.day = day
+        offsets = store.stop_time_offsets
+        running = store.active_services(day)[store.trip_service[store.stop_time_trip]]
+        rows = np.flatnonzero(running & (store.stop_time_arrival <= MIDNIGHT_SECONDS))
+
+        stop_of_row = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        self.offsets = np.zeros(len(offsets), dtype=np.int64)
+        np.cumsum(np.bincount(stop_of_row[rows], minlength=len(offsets) - 1), out=self.offsets[1:])
+        self.arrivals = store.stop_time_arrival[rows]
+        self.entries = store.board_entries(rows)
+
+    def upcoming(self, stop_index, now_seconds):
+        start, end = self.offsets[stop_index], self.offsets[stop_index + 1]
+        first = start + int(np.searchsorted(self.arrivals[start:end], now_seconds, side="left"))
+        return self.entries[first:end]
+
+
+_store = None
+_store_key = None
+_store_lock = threading.Lock()
+
+
+def get_gtfs_store():
+    """This worker's GTFS store, reloaded when the file changes; None without one."""
+    global _store, _store_key
+    path = settings.GTFS_STORE_PATH
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
+    if _store_key != key:
+        with _store_lock:
+            if _store_key != key:
+                try:
+                    _store = GTFSStore.load(path)
+                    _store_key = key
+                    _store.departure_index(datetime.now().date())  # start building today's boards
+                except (OSError, ValueError, KeyError):
+                    logger.exception("Could not load GTFS store %s", path)
+    return _store
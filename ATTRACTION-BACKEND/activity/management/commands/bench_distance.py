@@ -0,0 +1,63 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from activity import distance
+from activity.geo import haversine
+
+# Rende / Cosenza service area
+LAT_RANGE = (39.25, 39.40)
+LON_RANGE = (16.15, 16.30)
+
+
+class Command(BaseCommand):
+    help = "Microbenchmark of the scalar haversine() against the vectorized kernels in activity.distance"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stops", type=int, default=3000, help="number of synthetic stops")
+        parser.add_argument("--queries", type=int, default=200, help="number of query points")
+        parser.add_argument("--repeat", type=int, default=3, help="best-of repetitions")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        stops = [(rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)) for _ in range(options["stops"])]
+        queries = [(rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)) for _ in range(options["queries"])]
+        lats, lons = distance.as_coordinates([s[0] for s in stops], [s[1] for s in stops])
+        query_lats, query_lons = distance.as_coordinates([q[0] for q in queries], [q[1] for q in queries])
+
+        def scalar():
+            found = []
+            for q_lat, q_lon in queries:
+                best, best_dist = -1, float("inf")
+                for i, (lat, lon) in enumerate(stops):
+                    dist = haversine(q_lon, q_lat, lon, lat)
+                    if dist < best_dist:
+                        best, best_dist = i, dist
+                found.append(best)
+            return found
+
+        def per_query():
+            return [int(distance.top_k(q_lat, q_lon, lats, lons, 1)[0][0]) for q_lat, q_lon in queries]
+
+        def batched():
+            return distance.nearest(query_lats, query_lons, lats, lons)[0].tolist()
+
+        expected = None
+        baseline = None
+        for label, fn in (("scalar loop", scalar), ("numpy per query", per_query), ("numpy batched", batched)):
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                result = fn()
+                timings.append(time.perf_counter() - start)
+            best = min(timings)
+            if expected is None:
+                expected, baseline = result, best
+            mismatches = sum(1 for a, b in zip(result, expected) if a != b)
+            self.stdout.write(
+                f"{label:<16} {best * 1000:9.2f} ms total  "
+                f"{best / len(queries) * 1e6:9.1f} us/query  "
+                f"x{baseline / best:6.1f}  mismatches={mismatches}"
+            )
@@ -0,0 +1,61 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from activity import polyline
+
+
+def collect_polylines(node, found):
+    """Encoded polylines of a recorded OTP plan (`legGeometry.points`) or plan-trip response (`geometry`)."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in ("points", "geometry") and isinstance(value, str):
+                found.append(value)
+            else:
+                collect_polylines(value, found)
+    elif isinstance(node, list):
+        for value in node:
+            collect_polylines(value, found)
+    return found
+
+
+class Command(BaseCommand):
+    help = "Benchmark of activity.polyline.simplify() on recorded itineraries"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="JSON files with recorded OTP plans or plan-trip responses")
+        parser.add_argument("--tolerance", type=float, action="append",
+                            help="Douglas-Peucker tolerance in meters (repeatable, default 1 5 20)")
+        parser.add_argument("--precision", type=int, default=polyline.OTP_PRECISION)
+        parser.add_argument("--repeat", type=int, default=3, help="best-of repetitions")
+
+    def handle(self, *args, **options):
+        encoded = []
+        for path in options["paths"]:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    collect_polylines(json.load(f), encoded)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read {path}: {e}")
+        if not encoded:
+            raise CommandError("No encoded polylines found.")
+
+        points_in = sum(len(polyline.decode(line)) for line in encoded)
+        bytes_in = sum(len(line) for line in encoded)
+        self.stdout.write(f"{len(encoded)} polylines, {points_in} points, {bytes_in} bytes")
+
+        for tolerance in options["tolerance"] or [1.0, 5.0, 20.0]:
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                simplified = [polyline.simplify(line, tolerance, options["precision"]) for line in encoded]
+                timings.append(time.perf_counter() - start)
+            best = min(timings)
+            points_out = sum(len(polyline.decode(line, options["precision"])) for line in simplified)
+            bytes_out = sum(len(line) for line in simplified)
+            self.stdout.write(
+                f"tolerance {tolerance:6.1f} m  {best * 1000:9.2f} ms total  "
+                f"{best / len(encoded) * 1e6:9.1f} us/polyline  "
+                f"points {points_out / points_in:6.1%}  bytes {bytes_out / bytes_in:6.1%}"
+            )
@@ -0,0 +1,31 @@
+import time
+import zipfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from activity.gtfs import GTFSError, ingest
+
+
+class Command(BaseCommand):
+    help = "Convert a GTFS zip into the local store used for the stops list and station boards"
+
+    def add_arguments(self, parser):
+        parser.add_argument("feed", help="path of the GTFS zip")
+        parser.add_argument("--output", default=None, help="store path (default: settings.GTFS_STORE_PATH)")
+        parser.add_argument("--feed-id", default=None,
+                            help="OTP feed id prefixed to stop ids (default: settings.GTFS_FEED_ID)")
+
+    def handle(self, *args, **options):
+        output = options["output"] or settings.GTFS_STORE_PATH
+        feed_id = options["feed_id"] or settings.GTFS_FEED_ID
+        start = time.perf_counter()
+        try:
+            store = ingest(options["feed"], output, feed_id)
+        except (OSError, zipfile.BadZipFile, GTFSError, ValueError) as e:
+            raise CommandError(f"Cannot ingest {options['feed']}: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Ingested feed {store.version}: {len(store.stops)} stops, "
+            f"{len(store.trip_service)} trips, {len(store.stop_time_arrival)} stop times "
+            f"into {output} in {time.perf_counter() - start:.1f}s"
+        ))
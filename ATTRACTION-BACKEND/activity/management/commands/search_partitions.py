@@ -0,0 +1,84 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+from django.utils import timezone
+
+from activity.search_partitions import (
+    PartitioningError,
+    add_months,
+    check_partitioned,
+    create_partition,
+    detach_partition,
+    detached_partitions,
+    drop_partition,
+    export_partition,
+    month_start,
+    monthly_partitions,
+    partition_name,
+)
+
+
+class Command(BaseCommand):
+    help = "Create upcoming monthly Search partitions and archive the ones past the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ahead", type=int, default=None,
+                            help="months to create ahead of the current one (default: settings.SEARCH_PARTITIONS_AHEAD)")
+        parser.add_argument("--retain", type=int, default=None,
+                            help="months kept before the current one (default: settings.SEARCH_RETENTION_MONTHS)")
+        parser.add_argument("--archive-dir", default=None,
+                            help="where archived months are written (default: settings.SEARCH_ARCHIVE_DIR)")
+        parser.add_argument("--dry-run", action="store_true", help="only print what would be done")
+
+    def handle(self, *args, **options):
+        ahead = settings.SEARCH_PARTITIONS_AHEAD if options["ahead"] is None else options["ahead"]
+        retain = settings.SEARCH_RETENTION_MONTHS if options["retain"] is None else options["retain"]
+        archive_dir = options["archive_dir"] or settings.SEARCH_ARCHIVE_DIR
+        dry_run = options["dry_run"]
+        if ahead < 0 or retain < 1:
+            raise CommandError("--ahead must be 0 or more and --retain at least 1")
+
+        try:
+            check_partitioned()
+            existing = monthly_partitions()
+            detached = detached_partitions()
+        except PartitioningError as e:
+            raise CommandError(str(e))
+
+        current = month_start(timezone.now().date())  # UTC, like the partition bounds
+        for offset in range(ahead + 1):
+            month = add_months(current, offset)
+            if month in existing:
+                continue
+            self.stdout.write(f"{'Would create' if dry_run else 'Creating'} {partition_name(month)}")
+            if not dry_run:
+                try:
+                    create_partition(month)
+                except DatabaseError as e:
+                    raise CommandError(f"Cannot create {partition_name(month)}: {e}")
+
+        oldest_kept = add_months(current, -retain)
+        # months detached by an earlier run whose export failed are archived whatever their age
+        expired = {month: name for month, name in existing.items() if month < oldest_kept}
+        expired.update(detached)
+        for month, name in sorted(expired.items()):
+            path = os.path.join(archive_dir, f"{name}.npz")
+            if dry_run:
+                self.stdout.write(f"Would archive {name} to {path} and drop it")
+                continue
+            start = time.perf_counter()
+            try:
+                # detached first: nothing can be written to the month while it is exported
+                if month not in detached:
+                    detach_partition(name)
+                rows = export_partition(name, path)
+                drop_partition(name)
+            except (OSError, DatabaseError) as e:
+                raise CommandError(f"Cannot archive {name}: {e}")
+            self.stdout.write(self.style.SUCCESS(
+                f"Archived {rows} searches of {month:%Y-%m} to {path} and dropped {name} "
+                f"in {time.perf_counter() - start:.1f}s"
+            ))
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-17 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity', '0013_booking_co2_saved_kg'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['user', 'time'], name='booking_user_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='search',
+            index=models.Index(fields=['user', '-requested_at'], name='search_user_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='search',
+            index=models.Index(condition=models.Q(('anonymous_session_key__isnull', False)), fields=['anonymous_session_key'], name='search_anon_session_idx'),
+        ),
+    ]
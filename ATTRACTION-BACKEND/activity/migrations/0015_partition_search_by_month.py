@@ -0,0 +1,123 @@
+"""Partition activity_search by month of `requested_at` (PostgreSQL only).
+
+The rows are copied into a new table partitioned by range, with one
+partition per month from the oldest search to three months ahead and a
+default partition for anything else; `manage.py search_partitions` creates
+the following months. A partitioned table's primary key has to include the
+partition key, so it becomes (id, requested_at); ids still come from a single
+sequence. Other databases keep the plain table.
+"""
+from datetime import date, datetime, timezone
+
+from django.conf import settings
+from django.db import migrations
+
+MONTHS_AHEAD = 3
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def names(table):
+    return {
+        "old": f"{table}_unpartitioned",
+        "partitioned": f"{table}_partitioned",
+        "sequence": f"{table}_row_id_seq",
+        "pkey": f"{table}_pkey",
+        "user_fk": f"{table}_user_id_fk",
+    }
+
+
+def add_constraints(schema_editor, Search, User, primary_key):
+    quote = schema_editor.quote_name
+    table = Search._meta.db_table
+    name = names(table)
+    schema_editor.execute(
+        f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name['pkey'])} PRIMARY KEY ({primary_key})"
+    )
+    schema_editor.execute(
+        f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name['user_fk'])} FOREIGN KEY (user_id) "
+        f"REFERENCES {quote(User._meta.db_table)} (id) DEFERRABLE INITIALLY DEFERRED"
+    )
+    # the index Django keeps for the foreign key, under the name it expects
+    schema_editor.execute(schema_editor._create_index_sql(Search, fields=[Search._meta.get_field("user")]))
+    for index in Search._meta.indexes:
+        schema_editor.add_index(Search, index)
+
+
+def partition_search(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    Search = apps.get_model("activity", "Search")
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    quote = schema_editor.quote_name
+    table = Search._meta.db_table
+    name = names(table)
+
+    schema_editor.execute(f"ALTER TABLE {quote(table)} RENAME TO {quote(name['old'])}")
+    schema_editor.execute(
+        f"CREATE TABLE {quote(table)} (LIKE {quote(name['old'])} INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (requested_at)"
+    )
+    # left behind, already in use, when the migration was reversed before
+    schema_editor.execute(f"CREATE SEQUENCE IF NOT EXISTS {quote(name['sequence'])}")
+    schema_editor.execute(f"ALTER SEQUENCE {quote(name['sequence'])} OWNED BY {quote(table)}.id")
+    schema_editor.execute(
+        f"ALTER TABLE {quote(table)} ALTER COLUMN id SET DEFAULT nextval('{name['sequence']}'::regclass)"
+    )
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"SELECT min(requested_at) FROM {quote(name['old'])}")
+        oldest = cursor.fetchone()[0]
+    now = datetime.now(timezone.utc)
+    month = date((oldest or now).year, (oldest or now).month, 1)
+    last = add_months(date(now.year, now.month, 1), MONTHS_AHEAD)
+    while month <= last:
+        schema_editor.execute(
+            f"CREATE TABLE {quote(f'{table}_p{month:%Y%m}')} PARTITION OF {quote(table)} "
+            "FOR VALUES FROM (%s) TO (%s)",
+            [
+                datetime.combine(month, datetime.min.time(), tzinfo=timezone.utc),
+                datetime.combine(add_months(month, 1), datetime.min.time(), tzinfo=timezone.utc),
+            ],
+        )
+        month = add_months(month, 1)
+    schema_editor.execute(f"CREATE TABLE {quote(f'{table}_default')} PARTITION OF {quote(table)} DEFAULT")
+
+    schema_editor.execute(f"INSERT INTO {quote(table)} SELECT * FROM {quote(name['old'])}")
+    schema_editor.execute(
+        f"SELECT setval('{name['sequence']}', COALESCE((SELECT max(id) FROM {quote(table)}), 0) + 1, false)"
+    )
+    schema_editor.execute(f"DROP TABLE {quote(name['old'])}")
+    add_constraints(schema_editor, Search, User, "id, requested_at")
+
+
+def unpartition_search(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    Search = apps.get_model("activity", "Search")
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    quote = schema_editor.quote_name
+    table = Search._meta.db_table
+    name = names(table)
+
+    schema_editor.execute(f"ALTER TABLE {quote(table)} RENAME TO {quote(name['partitioned'])}")
+    schema_editor.execute(f"CREATE TABLE {quote(table)} (LIKE {quote(name['partitioned'])} INCLUDING DEFAULTS)")
+    schema_editor.execute(f"ALTER SEQUENCE {quote(name['sequence'])} OWNED BY {quote(table)}.id")
+    schema_editor.execute(f"INSERT INTO {quote(table)} SELECT * FROM {quote(name['partitioned'])}")
+    schema_editor.execute(f"DROP TABLE {quote(name['partitioned'])}")
+    add_constraints(schema_editor, Search, User, "id")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('activity', '0014_search_booking_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_search, unpartition_search),
+    ]
@@ -15,6 +15,18 @@ class Search(models.Model):
     requested_at = models.DateTimeField(default=timezone.now)
     modes = models.TextField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # recent searches of a user (TrackUserActivityView)
+            models.Index(fields=["user", "-requested_at"], name="search_user_recent_idx"),
+            # anonymous searches claimed at login; most rows belong to a user and stay out of it
+            models.Index(
+                fields=["anonymous_session_key"],
+                name="search_anon_session_idx",
+                condition=models.Q(anonymous_session_key__isnull=False),
+            ),
+        ]
+
     def __str__(self):
         return f"Search from ({self.from_lat}, {self.from_lon}) to ({self.to_lat}, {self.to_lon}) on {self.trip_date}"
 
@@ -62,6 +74,12 @@ class Booking(models.Model):
     # computed CO2 saved in kilograms compared to baseline (car) for this booking (optional)
     co2_saved_kg = models.FloatField(null=True, blank=True, default=None)
 
+    class Meta:
+        indexes = [
+            # a user's bookings, by time
+            models.Index(fields=["user", "time"], name="booking_user_time_idx"),
+        ]
+
     def __str__(self):
         return f"Booking by {self.user} from {self.origin} to {self.destination} at {self.time}"
 
@@ -0,0 +1,530 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class OTPError(Exception):
+    """Base class for failures talking to OpenTripPlanner."""
+
+
+class OTPUnavailable(OTPError):
+    """OTP could not be reached, timed out or answered with an HTTP error."""
+
+
+class CircuitOpen(OTPUnavailable):
+    """OTP was not called because the circuit breaker is open."""
+
+
+class OTPQueryError(OTPError):
+    """OTP answered, but with GraphQL errors."""
+
+    def __init__(self, errors):
+        super().__init__("OTP returned GraphQL errors")
+        self.errors = errors
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms, failed):
+        self.count += 1
+        self.failures += int(failed)
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "coalesced": self.coalesced,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 1),
+        }
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls that share a key into one execution.
+
+    The first caller runs the function; callers arriving while it is in
+    flight wait for it and receive the same result object (or exception),
+    so results must be treated as read-only. A waiting caller gives up with
+    OTPUnavailable once its own `timeout` runs out; the call goes on for
+    the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        """Return (result, shared) where `shared` is True for callers that waited.
+
+        `timeout` bounds how long a caller waits for another one's call, in
+        seconds; None waits for as long as that call takes.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise OTPUnavailable("Timed out waiting for an identical OTP query")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class CircuitBreaker:
+    """Stops calling OTP after `failure_threshold` consecutive failures.
+
+    While open every call fails at once with CircuitOpen. After
+    `reset_timeout` seconds the breaker turns half-open and lets up to
+    `half_open_max_calls` trial requests through: a success closes it again,
+    a failure reopens it for another `reset_timeout`.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold, reset_timeout, half_open_max_calls=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Raise CircuitOpen unless a request may go upstream now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN:
+                remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+                if remaining > 0:
+                    raise CircuitOpen(f"OTP circuit open, retrying in {remaining:.0f}s")
+                self._state = self.HALF_OPEN
+                self._trials = 0
+            if self._trials >= self.half_open_max_calls:
+                raise CircuitOpen("OTP circuit half-open, trial request in flight")
+            self._trials += 1
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("OTP circuit closed")
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def release_trial(self):
+        """Give back the slot of a call that ended without telling anything about OTP."""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning("OTP circuit opened after %d consecutive failures", self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+def _coalesce_key(query, variables):
+    return " ".join(query.split()), json.dumps(variables, sort_keys=True)
+
+
+class QueryStatsMixin:
+    def _init_stats(self):
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _record(self, name, elapsed_ms, failed):
+        with self._stats_lock:
+            self._stats.setdefault(name, QueryStats()).record(elapsed_ms, failed)
+        logger.info("OTP %s query took %.1f ms%s", name, elapsed_ms, " (failed)" if failed else "")
+
+    def _record_coalesced(self, name):
+        with self._stats_lock:
+            self._stats.setdefault(name, QueryStats()).coalesced += 1
+
+    def _record_outcome(self, failed):
+        # GraphQL errors still mean OTP is up; only transport failures count
+        if self.breaker is None:
+            return
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def stats(self):
+        with self._stats_lock:
+            return {name: stats.as_dict() for name, stats in self._stats.items()}
+
+
+# answers worth another attempt: OTP or its proxy is restarting or overloaded
+RETRY_STATUSES = frozenset({502, 503, 504})
+
+
+def _failed_to_connect(error):
+    """True when a requests ConnectionError never reached OTP (refused, unreachable, connect timeout)."""
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(reason, ConnectTimeoutError)
+
+
+class OTPClient(QueryStatsMixin):
+    """GraphQL client for the OTP router with a pooled keep-alive session.
+
+    Connection and read timeouts, the pool size and the retry policy come from
+    settings. Every query has a deadline, `request_deadline` seconds after it
+    starts unless the caller passes its own: each attempt's timeouts are
+    capped by the time left, and connection errors and 502/503/504 answers
+    are retried with exponential backoff, at most `max_retries` times and
+    only while the backoff still fits before the deadline. Read timeouts are
+    not retried so a slow plan query cannot multiply the caller's wait. Every
+    query is timed per `name`.
+
+    Identical queries (same normalized document and variables) issued while
+    one is already in flight wait for that answer, up to their own deadline,
+    instead of going upstream. With a `breaker`, queries fail fast with
+    CircuitOpen during OTP outages.
+    """
+
+    def __init__(self, url, connect_timeout, read_timeout, max_retries, backoff_factor, pool_size, breaker=None,
+                 request_deadline=None):
+        self.url = url
+        self.breaker = breaker
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.request_deadline = request_deadline
+        # retries are ours (see _post), so they can be fitted into each query's deadline
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._init_stats()
+        self._flight = SingleFlight()
+
+    def query(self, query, variables=None, name="query", timeout=None, coalesce=True, deadline=None):
+        """Run a GraphQL document and return its `data` object.
+
+        `timeout` is the (connect, read) timeout of one attempt, `deadline` the
+        time.monotonic() by which the whole query, retries included, must end.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.request_deadline if self.request_deadline else math.inf
+        if not coalesce:
+            return self._execute(query, variables, name, timeout, deadline)
+
+        key = _coalesce_key(query, variables)
+        # a caller joining a query already in flight still gives up at its own deadline
+        wait = None if deadline == math.inf else max(0.0, deadline - time.monotonic())
+        data, shared = self._flight.do(key, lambda: self._execute(query, variables, name, timeout, deadline), wait)
+        if shared:
+            self._record_coalesced(name)
+        return data
+
+    @property
+    def coalesced(self):
+        return self._flight.coalesced
+
+    def _execute(self, query, variables, name, timeout, deadline):
+        payload = {"query": query}
+        if variables is not None:
+            payload["variables"] = variables
+
+        if self.breaker is not None:
+            self.breaker.before_call()
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = self._post(payload, timeout or self.timeout, deadline)
+            response.raise_for_status()
+            result = response.json()
+            failed = False
+        except requests.exceptions.RequestException as e:
+            raise OTPUnavailable(str(e)) from e
+        except ValueError as e:
+            raise OTPUnavailable(f"Invalid JSON from OTP: {e}") from e
+        finally:
+            self._record(name, (time.perf_counter() - start) * 1000, failed)
+            self._record_outcome(failed)
+
+        if "errors" in result:
+            raise OTPQueryError(result["errors"])
+        return result.get("data") or {}
+
+    def _post(self, payload, timeout, deadline):
+        """POST `payload`, retrying within `deadline`; returns the last response."""
+        connect_timeout, read_timeout = timeout
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout("OTP request deadline exceeded")
+            attempt_timeout = (min(connect_timeout, remaining), min(read_timeout, remaining))
+            try:
+                response = self.session.post(self.url, json=payload, timeout=attempt_timeout)
+            except requests.exceptions.ConnectionError as e:
+                # once the request reached OTP it may be planning already: only connect failures are retried
+                if not _failed_to_connect(e) or not self._back_off(attempt, deadline):
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or not self._back_off(attempt, deadline):
+                    return response
+                response.close()
+
+    def _back_off(self, attempt, deadline):
+        """Sleep before retry `attempt + 1`; False when no retry is left or it would miss the deadline."""
+        if attempt >= self.max_retries:
+            return False
+        delay = self.backoff_factor * 2 ** attempt
+        # the next attempt needs some time of its own after the sleep
+        if time.monotonic() + delay >= deadline:
+            return False
+        time.sleep(delay)
+        return True
+
+
+class AsyncOTPClient(QueryStatsMixin):
+    """asyncio counterpart of OTPClient for the async views.
+
+    Built on an httpx.AsyncClient bound to one event loop, so a single ASGI
+    worker can keep hundreds of OTP requests waiting without a thread each.
+    Connection attempts are retried; identical in-flight queries share one
+    upstream request.
+    """
+
+    def __init__(self, url, connect_timeout, read_timeout, max_retries, max_connections, breaker=None):
+        self.url = url
+        self.breaker = breaker
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        transport = httpx.AsyncHTTPTransport(
+            retries=max_retries,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self.client = httpx.AsyncClient(
+            transport=transport,
+            timeout=self.timeout,
+            headers={"Content-Type": "application/json"},
+        )
+        self._init_stats()
+        self._inflight = {}
+        self.coalesced = 0
+
+    async def query(self, query, variables=None, name="query", timeout=None, coalesce=True):
+        """Run a GraphQL document and return its `data` object."""
+        if not coalesce:
+            return await self._execute(query, variables, name, timeout)
+
+        key = _coalesce_key(query, variables)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._execute(query, variables, name, timeout))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _task: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+            self._record_coalesced(name)
+        # a cancelled waiter must not cancel the request other callers share
+        return await asyncio.shield(task)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _execute(self, query, variables, name, timeout):
+        payload = {"query": query}
+        if variables is not None:
+            payload["variables"] = variables
+
+        if self.breaker is not None:
+            self.breaker.before_call()
+        start = time.perf_counter()
+        failed = None
+        try:
+            response = await self.client.post(self.url, json=payload, timeout=timeout or self.timeout)
+            response.raise_for_status()
+            result = response.json()
+            failed = False
+        except httpx.HTTPError as e:
+            failed = True
+            raise OTPUnavailable(str(e) or e.__class__.__name__) from e
+        except ValueError as e:
+            failed = True
+            raise OTPUnavailable(f"Invalid JSON from OTP: {e}") from e
+        finally:
+            if failed is None:
+                # cancelled by the caller (deadline, disconnect): no verdict on OTP, and
+                # the CancelledError propagates untouched
+                if self.breaker is not None:
+                    self.breaker.release_trial()
+            else:
+                self._record(name, (time.perf_counter() - start) * 1000, failed)
+                self._record_outcome(failed)
+
+        if "errors" in result:
+            raise OTPQueryError(result["errors"])
+        return result.get("data") or {}
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_batch_executor = None
+_batch_executor_pid = None
+_async_clients = weakref.WeakKeyDictionary()
+_breaker = None
+_breaker_pid = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """Circuit breaker shared by the sync and async clients of this worker."""
+    global _breaker, _breaker_pid
+    pid = os.getpid()
+    if _breaker is None or _breaker_pid != pid:
+        with _breaker_lock:
+            if _breaker is None or _breaker_pid != pid:
+                _breaker = CircuitBreaker(
+                    failure_threshold=settings.OTP_CIRCUIT_FAILURE_THRESHOLD,
+                    reset_timeout=settings.OTP_CIRCUIT_RESET_TIMEOUT,
+                    half_open_max_calls=settings.OTP_CIRCUIT_HALF_OPEN_CALLS,
+                )
+                _breaker_pid = pid
+    return _breaker
+
+
+def get_otp_client():
+    """Return this worker's client, creating a fresh pool after a fork."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = OTPClient(
+                    settings.OTP_GRAPHQL_URL,
+                    connect_timeout=settings.OTP_CONNECT_TIMEOUT,
+                    read_timeout=settings.OTP_READ_TIMEOUT,
+                    max_retries=settings.OTP_MAX_RETRIES,
+                    backoff_factor=settings.OTP_RETRY_BACKOFF,
+                    pool_size=settings.OTP_POOL_SIZE,
+                    breaker=get_circuit_breaker(),
+                    request_deadline=settings.OTP_REQUEST_DEADLINE,
+                )
+                _client_pid = pid
+    return _client
+
+
+def get_otp_executor():
+    """Thread pool used to issue independent OTP queries of one request concurrently."""
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _client_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(max_workers=settings.OTP_POOL_SIZE, thread_name_prefix="otp")
+                _executor_pid = pid
+    return _executor
+
+
+def get_batch_executor():
+    """Thread pool shared by the batch plans of this worker.
+
+    Kept apart from get_otp_executor() so that batches, however many arrive
+    at once, never hold more than PLAN_BATCH_WORKERS OTP queries between them
+    and leave the interactive requests' pool alone.
+    """
+    global _batch_executor, _batch_executor_pid
+    pid = os.getpid()
+    if _batch_executor is None or _batch_executor_pid != pid:
+        with _client_lock:
+            if _batch_executor is None or _batch_executor_pid != pid:
+                _batch_executor = ThreadPoolExecutor(
+                    max_workers=settings.PLAN_BATCH_WORKERS, thread_name_prefix="otp-batch"
+                )
+                _batch_executor_pid = pid
+    return _batch_executor
+
+
+def get_async_otp_client():
+    """Return the async client bound to the running event loop.
+
+    Under ASGI that is the worker's loop; under WSGI every async view runs on
+    a loop of its own, which `close_async_otp_client()` has to clean up.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncOTPClient(
+            settings.OTP_GRAPHQL_URL,
+            connect_timeout=settings.OTP_CONNECT_TIMEOUT,
+            read_timeout=settings.OTP_READ_TIMEOUT,
+            max_retries=settings.OTP_MAX_RETRIES,
+            max_connections=settings.OTP_ASYNC_MAX_CONNECTIONS,
+            breaker=get_circuit_breaker(),
+        )
+    return client
+
+
+async def close_async_otp_client():
+    """Close the running loop's client, if it has one."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
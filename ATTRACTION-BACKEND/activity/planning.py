@@ -0,0 +1,384 @@
+"""Trip planning logic shared by the sync and async plan-trip views.
+
+Nothing in here talks to OTP or the database: views fetch the plan with
+whichever client fits their execution model and hand the raw GraphQL data to
+`shape_plan()`.
+"""
+import hashlib
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import polyline
+from .cache import LRUCache
+
+PLAN_ITINERARY_FIELDS = """
+        itineraries {
+            duration
+            walkDistance
+            legs {
+                mode
+                startTime
+                endTime
+                distance
+                from { name }
+                to { name }
+                trip {
+                    routeShortName
+                    tripHeadsign
+                    route {
+                        id
+                        shortName
+                        longName
+                        agency { id name }
+                    }
+                }
+                legGeometry { points }
+                steps {
+                    distance
+                    streetName
+                }
+            }
+        }
+"""
+
+
+def build_plan_query(with_transport_modes=False):
+    modes_variable = ", $transportModes: [TransportMode]" if with_transport_modes else ""
+    modes_argument = ",\n        transportModes: $transportModes" if with_transport_modes else ""
+    return (
+        "query PlanTrip(\n"
+        "    $fromLat: Float!, $fromLon: Float!,\n"
+        "    $toLat: Float!, $toLon: Float!,\n"
+        f"    $date: String!, $time: String!{modes_variable}\n"
+        ") {\n"
+        "    plan(\n"
+        "        from: { lat: $fromLat, lon: $fromLon },\n"
+        "        to: { lat: $toLat, lon: $toLon },\n"
+        "        date: $date,\n"
+        f"        time: $time{modes_argument}\n"
+        "    ) {"
+        + PLAN_ITINERARY_FIELDS +
+        "    }\n"
+        "}\n"
+    )
+
+
+PLAN_QUERY = build_plan_query()
+PLAN_QUERY_WITH_MODES = build_plan_query(with_transport_modes=True)
+
+# OTP transportModes sent for each mode filter, so OTP only computes matching
+# itineraries; "ALL" keeps OTP's default mode set. shape_plan() still applies
+# the mode filter to whatever comes back.
+TRANSPORT_MODES = {
+    "WALK": [{"mode": "WALK"}],
+    "BUS": [{"mode": "BUS"}, {"mode": "WALK"}],
+    "BICYCLE": [{"mode": "BICYCLE"}],
+    "SCOOTER": [{"mode": "SCOOTER", "qualifier": "RENT"}, {"mode": "WALK"}],
+}
+
+# shaped OTP options per PlanRequest.cache_key(); the closest stations depend on
+# each request's exact coordinates, so they are looked up again on every request
+plan_cache = LRUCache(settings.PLAN_CACHE_SIZE, ttl=settings.PLAN_CACHE_TTL)
+itinerary_store = LRUCache(settings.ITINERARY_STORE_SIZE, ttl=settings.ITINERARY_STORE_TTL)
+
+# leg fields left out of summary plans and served by the itinerary detail endpoint
+DETAIL_LEG_FIELDS = ("geometry", "walk_steps")
+
+
+class PlanRequestError(ValueError):
+    """The trip request passed serializer validation but cannot be planned."""
+
+
+class PlanRequest:
+    """Validated PlanTripSerializer data with the time defaults resolved."""
+
+    def __init__(self, data):
+        self.data = data
+        mode_filter = data.get('mode')
+        if not mode_filter:
+            raise PlanRequestError("Mode is required and cannot be empty.")
+        self.mode_filter = mode_filter.strip().upper()
+
+        time_str = data.get('time', None)
+        req_time_str = data.get('requested_time', None)
+
+        if not time_str or (isinstance(time_str, str) and time_str.lower() == 'timenow'):
+            time_str = datetime.now().strftime("%H:%M:%S")
+
+        if not req_time_str or (isinstance(req_time_str, str) and req_time_str.lower() == 'timenow'):
+            req_time_str = datetime.now().strftime("%H:%M:%S")
+
+        try:
+            datetime.strptime(time_str, "%H:%M:%S")
+            datetime.strptime(req_time_str, "%H:%M:%S")
+        except ValueError:
+            raise PlanRequestError("Time must be in HH:MM:SS format.")
+
+        self.time_str = time_str
+        self.req_time_str = req_time_str
+        self.date_str = data.get('date').strftime("%Y-%m-%d")
+        self.req_date_str = data.get('requested_date').strftime("%Y-%m-%d")
+
+    def query(self):
+        return PLAN_QUERY_WITH_MODES if self.mode_filter in TRANSPORT_MODES else PLAN_QUERY
+
+    def variables(self):
+        variables = {
+            "fromLat": self.data['fromLat'],
+            "fromLon": self.data['fromLon'],
+            "toLat": self.data['toLat'],
+            "toLon": self.data['toLon'],
+            "date": self.date_str,
+            "time": self.time_str,
+        }
+        if self.mode_filter in TRANSPORT_MODES:
+            variables["transportModes"] = TRANSPORT_MODES[self.mode_filter]
+        return variables
+
+    def cache_key(self):
+        """Near-duplicate trip requests share a key: coordinates are rounded to
+        PLAN_CACHE_COORD_PRECISION decimals and the departure time falls into
+        PLAN_CACHE_TIME_BUCKET-second buckets."""
+        precision = settings.PLAN_CACHE_COORD_PRECISION
+        hours, minutes, seconds = (int(part) for part in self.time_str.split(":"))
+        time_bucket = (hours * 3600 + minutes * 60 + seconds) // settings.PLAN_CACHE_TIME_BUCKET
+        return (
+            round(self.data['fromLat'], precision),
+            round(self.data['fromLon'], precision),
+            round(self.data['toLat'], precision),
+            round(self.data['toLon'], precision),
+            self.date_str,
+            time_bucket,
+            self.mode_filter,
+        )
+
+    def search_fields(self):
+        """Search model fields for this request (without user / session key)."""
+        trip_datetime_naive = datetime.strptime(f"{self.date_str} {self.time_str}", "%Y-%m-%d %H:%M:%S")
+        req_datetime_naive = datetime.strptime(f"{self.req_date_str} {self.req_time_str}", "%Y-%m-%d %H:%M:%S")
+        return {
+            "from_lat": self.data['fromLat'],
+            "from_lon": self.data['fromLon'],
+            "to_lat": self.data['toLat'],
+            "to_lon": self.data['toLon'],
+            "trip_date": timezone.make_aware(trip_datetime_naive),
+            "requested_at": timezone.make_aware(req_datetime_naive),
+            "modes": self.mode_filter,
+        }
+
+
+def closest_stations(snapshot, data):
+    stop_index = snapshot.index
+    return (
+        stop_index.nearest(data['fromLat'], data['fromLon']),
+        stop_index.nearest(data['toLat'], data['toLon']),
+    )
+
+
+def shape_plan(result, mode_filter, from_stop, to_stop):
+    """Turn the OTP `plan` answer into the plan-trip response body."""
+    return plan_response(shape_options(result, mode_filter), from_stop, to_stop)
+
+
+def plan_response(options, from_stop, to_stop):
+    return {
+        "fromStationName": from_stop['name'] if from_stop else None,
+        "toStationName": to_stop['name'] if to_stop else None,
+        "options": options
+    }
+
+
+def shape_options(result, mode_filter):
+    """Itineraries of the OTP `plan` answer, grouped by primary mode."""
+    itineraries = (result.get("plan") or {}).get("itineraries", [])
+    options = {"walk": [], "bus": [], "bicycle": [], "scooter": [], "other": []}
+
+    for idx, itinerary in enumerate(itineraries, start=1):
+        legs = itinerary.get("legs", []) or []
+        modes_in_itinerary = {(leg.get("mode") or "").upper() for leg in legs}
+
+        if mode_filter != "ALL":
+            if mode_filter == "WALK" and modes_in_itinerary != {"WALK"}:
+                continue
+            elif mode_filter == "BUS" and "BUS" not in modes_in_itinerary:
+                continue
+            elif mode_filter == "BICYCLE" and "BICYCLE" not in modes_in_itinerary:
+                continue
+            elif mode_filter == "SCOOTER" and "SCOOTER" not in modes_in_itinerary:
+                continue
+            elif mode_filter not in modes_in_itinerary:
+                continue
+
+        itinerary_total_m = int(round(sum((leg.get("distance") or 0) for leg in legs)))
+        walk_total_m = int(round(itinerary.get("walkDistance") or 0))
+
+        legs_out = []
+        for leg in legs:
+            mode = (leg.get("mode") or "UNKNOWN").lower()
+            start_ts = leg.get("startTime")
+            end_ts = leg.get("endTime")
+            from_name = leg.get("from", {}).get("name") or "Unknown stop"
+            to_name = leg.get("to", {}).get("name") or "Unknown stop"
+            geometry = (leg.get("legGeometry") or {}).get("points")
+            leg_distance_m = int(round(leg.get("distance") or 0))
+
+            if start_ts and end_ts:
+                start_dt = datetime.fromtimestamp(start_ts / 1000)
+                end_dt = datetime.fromtimestamp(end_ts / 1000)
+                duration_s = int((end_ts - start_ts) / 1000)
+                duration_str = f"{duration_s // 60}m {duration_s % 60}s"
+                start_time_iso = start_dt.isoformat()
+                end_time_iso = end_dt.isoformat()
+            else:
+                duration_s = 0
+                duration_str = "N/A"
+                start_time_iso = None
+                end_time_iso = None
+
+            leg_obj = {
+                "type": mode,
+                "from": from_name,
+                "to": to_name,
+                "duration": duration_str,
+                "duration_s": duration_s,
+                "start_time": start_time_iso,
+                "end_time": end_time_iso,
+                "geometry": geometry,
+                "distance_m": leg_distance_m,
+            }
+
+            if mode == "bus":
+                bus_trip = leg.get("trip") or {}
+                route_info = bus_trip.get("route") or {}
+                agency_info = route_info.get("agency") or {}
+
+                authority_id = agency_info.get("id")
+                authority_name = agency_info.get("name")
+
+                leg_obj.update({
+                    "route_short": bus_trip.get("routeShortName"),
+                    "route_long": route_info.get("longName"),
+                    "headsign": bus_trip.get("tripHeadsign"),
+                    "authority_id": authority_id,
+                    "authority_name": authority_name,
+                    "bus_name": (
+                        f"Bus {bus_trip.get('routeShortName') or ''} - {bus_trip.get('tripHeadsign') or ''}".strip()
+                        or authority_name
+                    ),
+                })
+
+            if mode == "walk" and leg.get("steps"):
+                leg_obj["walk_steps"] = [
+                    {"streetName": st.get("streetName"), "distance_m": int(round(st.get("distance") or 0))}
+                    for st in (leg.get("steps") or [])
+                ]
+
+            legs_out.append(leg_obj)
+
+        # ---- Segments aggregation ----
+        segments = []
+        for lg in legs_out:
+            if not segments or segments[-1]["mode"] != lg["type"]:
+                seg = {
+                    "mode": lg["type"],
+                    "from": lg["from"],
+                    "to": lg["to"],
+                    "distance_m": lg["distance_m"],
+                    "duration_s": lg["duration_s"],
+                    "legs_count": 1,
+                }
+                if lg["type"] == "bus":
+                    seg["routes"] = [lg.get("route_short")] if lg.get("route_short") else []
+                segments.append(seg)
+            else:
+                segments[-1]["to"] = lg["to"]
+                segments[-1]["distance_m"] += lg["distance_m"]
+                segments[-1]["duration_s"] += lg["duration_s"]
+                segments[-1]["legs_count"] += 1
+                if lg["type"] == "bus" and lg.get("route_short"):
+                    routes = segments[-1].setdefault("routes", [])
+                    if lg["route_short"] not in routes:
+                        routes.append(lg["route_short"])
+
+        # ---- Primary mode ----
+        primary_mode = "other"
+        if modes_in_itinerary == {"WALK"}:
+            primary_mode = "walk"
+        elif "BUS" in modes_in_itinerary:
+            primary_mode = "bus"
+        elif "BICYCLE" in modes_in_itinerary:
+            primary_mode = "bicycle"
+        elif "SCOOTER" in modes_in_itinerary:
+            primary_mode = "scooter"
+
+        options[primary_mode].append({
+            "option": idx,
+            "total_distance_m": itinerary_total_m,
+            "walk_distance_m": walk_total_m,
+            "legs": legs_out,
+            "segments": segments
+        })
+
+    return options
+
+
+def simplify_plan_geometry(response_data, tolerance_m=0, precision=polyline.OTP_PRECISION):
+    """Copy of a plan-trip response with every leg geometry simplified to
+    `tolerance_m` meters and re-encoded at `precision`."""
+    options = {}
+    for primary_mode, mode_options in response_data["options"].items():
+        options[primary_mode] = [
+            {
+                **option,
+                "legs": [
+                    {**leg, "geometry": polyline.simplify(leg["geometry"], tolerance_m, precision)}
+                    if leg.get("geometry") else leg
+                    for leg in option["legs"]
+                ],
+            }
+            for option in mode_options
+        ]
+    return {**response_data, "options": options, "geometry_precision": precision}
+
+
+def itinerary_id(option):
+    """Content-derived id, so the same itinerary keeps its id across cached answers."""
+    digest = hashlib.sha1(json.dumps(option, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:20]
+
+
+def summarize_plan(response_data):
+    """Plan-trip response without leg geometry and walk steps.
+
+    Every option gets an `itinerary_id`; the stripped fields are kept in
+    `itinerary_store` until the client asks for them.
+    """
+    options = {}
+    for primary_mode, mode_options in response_data["options"].items():
+        options[primary_mode] = []
+        for option in mode_options:
+            option_id = itinerary_id(option)
+            itinerary_store.set(option_id, {
+                "itinerary_id": option_id,
+                "legs": [
+                    {
+                        "type": leg["type"],
+                        "from": leg["from"],
+                        "to": leg["to"],
+                        **{field: leg[field] for field in DETAIL_LEG_FIELDS if field in leg},
+                    }
+                    for leg in option["legs"]
+                ],
+            })
+            options[primary_mode].append({
+                **option,
+                "itinerary_id": option_id,
+                "legs": [
+                    {key: value for key, value in leg.items() if key not in DETAIL_LEG_FIELDS}
+                    for leg in option["legs"]
+                ],
+            })
+    return {**response_data, "options": options}
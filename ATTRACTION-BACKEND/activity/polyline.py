@@ -0,0 +1,113 @@
+"""Encoded polyline decoding, simplification and re-encoding.
+
+OTP returns leg geometry in Google's encoded polyline format at precision 5.
+`simplify()` decodes it, drops the points a Douglas–Peucker pass with a
+tolerance in meters deems redundant and re-encodes the rest at the requested
+precision. All steps work on NumPy arrays; none of them mutate their input.
+"""
+import numpy as np
+
+from .distance import EARTH_RADIUS_M
+
+OTP_PRECISION = 5
+
+# 5-bit chunks needed for any zigzag-encoded coordinate delta up to precision 7
+MAX_CHUNKS = 8
+
+
+def decode(encoded, precision=OTP_PRECISION):
+    """(n, 2) array of (lat, lon) from an encoded polyline."""
+    chars = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if chars.size == 0:
+        return np.empty((0, 2), dtype=np.float64)
+
+    # every value is a run of 5-bit chunks, least significant first; the 0x20
+    # bit is set on all chunks but the last one of a value
+    ends = np.flatnonzero((chars & 0x20) == 0)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    value_of_char = np.repeat(np.arange(ends.size), ends - starts + 1)
+    shifts = 5 * (np.arange(value_of_char.size) - starts[value_of_char])
+    values = np.add.reduceat((chars[:value_of_char.size] & 0x1f) << shifts, starts)
+
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / 10 ** precision
+
+
+def encode(points, precision=OTP_PRECISION):
+    """Encoded polyline of an (n, 2) array of (lat, lon)."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if points.shape[0] == 0:
+        return ""
+
+    scaled = np.round(points * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    chunks = (values[:, None] >> (5 * np.arange(MAX_CHUNKS))) & 0x1f
+    bit_lengths = np.zeros(values.size, dtype=np.int64)
+    nonzero = values > 0
+    bit_lengths[nonzero] = np.floor(np.log2(values[nonzero])).astype(np.int64) + 1
+    counts = np.maximum(1, -(-bit_lengths // 5))
+    positions = np.arange(MAX_CHUNKS)[None, :]
+    chunks |= np.where(positions < counts[:, None] - 1, 0x20, 0)
+    return (chunks[positions < counts[:, None]] + 63).astype(np.uint8).tobytes().decode("ascii")
+
+
+def _project(points):
+    """Equirectangular projection to meters around the polyline's mean latitude."""
+    lat0 = np.radians(points[:, 0].mean())
+    y = np.radians(points[:, 0]) * EARTH_RADIUS_M
+    x = np.radians(points[:, 1]) * EARTH_RADIUS_M * np.cos(lat0)
+    return np.column_stack((x, y))
+
+
+def _segment_distances(xy, first, last):
+    """Distances of the points strictly between `first` and `last` to that segment."""
+    a = xy[first]
+    ab = xy[last] - a
+    ap = xy[first + 1:last] - a
+    length_sq = ab @ ab
+    if length_sq == 0:
+        return np.hypot(ap[:, 0], ap[:, 1])
+    t = np.clip(ap @ ab / length_sq, 0, 1)
+    offset = ap - t[:, None] * ab
+    return np.hypot(offset[:, 0], offset[:, 1])
+
+
+def douglas_peucker(points, tolerance_m):
+    """Boolean mask of the points kept by Douglas–Peucker at `tolerance_m` meters."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    n = points.shape[0]
+    keep = np.zeros(n, dtype=bool)
+    if n <= 2 or tolerance_m <= 0:
+        keep[:] = True
+        return keep
+
+    xy = _project(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _segment_distances(xy, first, last)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def simplify(encoded, tolerance_m=0, precision=OTP_PRECISION, source_precision=OTP_PRECISION):
+    """Re-encode `encoded` at `precision` after Douglas–Peucker at `tolerance_m`.
+
+    A tolerance of 0 keeps every point and only changes the precision.
+    """
+    if not encoded:
+        return encoded
+    points = decode(encoded, source_precision)
+    if tolerance_m > 0:
+        points = points[douglas_peucker(points, tolerance_m)]
+    return encode(points, precision)
@@ -0,0 +1,144 @@
+"""Write-behind logging of trip searches.
+
+Trip planning only queues its Search row; a background thread writes the
+queue with bulk_create() once SEARCH_LOG_BATCH_SIZE rows are waiting or
+every SEARCH_LOG_FLUSH_INTERVAL seconds, and once more when the worker exits.
+The queue holds at most SEARCH_LOG_MAX_PENDING rows: past that new searches
+are dropped and counted rather than slowing requests down.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from .models import Search
+
+logger = logging.getLogger(__name__)
+
+
+class SearchLog:
+    def __init__(self, max_pending, batch_size, flush_interval):
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._reported_drops = 0
+
+    def add(self, **fields):
+        """Queue one Search row; returns False if it was dropped."""
+        self._ensure_thread()
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending.append(Search(**fields))
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+        return True
+
+    def flush(self):
+        """Write every queued row now."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = list(self._pending), deque()
+                new_drops, self._reported_drops = self.dropped - self._reported_drops, self.dropped
+            if new_drops:
+                logger.warning("Search log full, dropped %d searches", new_drops)
+            if not rows:
+                return 0
+            try:
+                Search.objects.bulk_create(rows, batch_size=self.batch_size)
+            except (InterfaceError, OperationalError):
+                # the connection, not the rows: keep them for the next flush
+                self._requeue(rows)
+                logger.warning("Writing %d searches failed, will retry", len(rows), exc_info=True)
+                return 0
+            except Exception:
+                self.failed += len(rows)
+                logger.exception("Writing %d searches failed", len(rows))
+                return 0
+            self.written += len(rows)
+            return len(rows)
+
+    def _requeue(self, rows):
+        with self._lock:
+            room = max(0, self.max_pending - len(self._pending))
+            self.dropped += max(0, len(rows) - room)
+            self._pending.extendleft(reversed(rows[:room]))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+            }
+
+    def _ensure_thread(self):
+        # a forked worker inherits the queue but not the thread
+        pid = os.getpid()
+        if self._thread_pid == pid:
+            return
+        with self._lock:
+            if self._thread_pid == pid:
+                return
+            self._thread_pid = pid
+        threading.Thread(target=self._run, name="search-log", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception:
+                logger.exception("Search log flush failed")
+            finally:
+                try:
+                    close_old_connections()
+                except Exception:
+                    logger.exception("Closing the search log connection failed")
+
+
+search_log = SearchLog(
+    max_pending=settings.SEARCH_LOG_MAX_PENDING,
+    batch_size=settings.SEARCH_LOG_BATCH_SIZE,
+    flush_interval=settings.SEARCH_LOG_FLUSH_INTERVAL,
+)
+
+
+def log_search(**fields):
+    """Record a trip search, through the write-behind queue when it is enabled."""
+    if settings.SEARCH_LOG_WRITE_BEHIND:
+        search_log.add(**fields)
+    else:
+        Search.objects.create(**fields)
+
+
+async def alog_search(**fields):
+    """`log_search()` for the async views."""
+    if settings.SEARCH_LOG_WRITE_BEHIND:
+        search_log.add(**fields)
+    else:
+        await Search.objects.acreate(**fields)
+
+
+def flush_searches():
+    if settings.SEARCH_LOG_WRITE_BEHIND:
+        search_log.flush()
+
+
+atexit.register(flush_searches)
@@ -0,0 +1,194 @@
+"""Monthly range partitions of the Search table (PostgreSQL).
+
+Migration 0015 turns activity_search into a table partitioned by
+`requested_at`, one `activity_search_pYYYYMM` partition per month plus
+`activity_search_default` for anything outside them. `manage.py
+search_partitions` keeps partitions a few months ahead and archives months
+past the retention period: each one is detached first, so searches still
+dated in that month go to the default partition instead of a table being
+archived, then exported to a compressed columnar .npz file and dropped once
+the export is written. A month whose export failed stays detached until the
+next run archives it.
+"""
+import os
+import re
+from datetime import date, datetime, timezone
+
+import numpy as np
+from django.db import connection, transaction
+
+from .models import Search
+
+TABLE = Search._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITION_NAME = re.compile(rf"^{TABLE}_p(\d{{4}})(\d{{2}})$")
+ARCHIVE_COLUMNS = (
+    "id", "user_id", "anonymous_session_key", "from_lat", "from_lon",
+    "to_lat", "to_lon", "trip_date", "requested_at", "modes",
+)
+FETCH_SIZE = 10000
+
+
+class PartitioningError(Exception):
+    pass
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{TABLE}_p{month:%Y%m}"
+
+
+def is_partitioned():
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = %s AND pg_table_is_visible(c.oid)",
+            [TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def check_partitioned():
+    if not is_partitioned():
+        raise PartitioningError(f"{TABLE} is not partitioned (PostgreSQL only, see migration 0015)")
+
+
+def _by_month(names):
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def monthly_partitions():
+    """{first day of month: partition name} of the attached monthly partitions."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [TABLE],
+        )
+        return _by_month(row[0] for row in cursor.fetchall())
+
+
+def detached_partitions():
+    """{first day of month: table name} of monthly tables detached but not archived yet."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relname FROM pg_class "
+            "WHERE relkind = 'r' AND NOT relispartition AND relname LIKE %s AND pg_table_is_visible(oid)",
+            [f"{TABLE}\\_p%"],
+        )
+        return _by_month(row[0] for row in cursor.fetchall())
+
+
+def month_bounds(month):
+    return (
+        datetime.combine(month, datetime.min.time(), tzinfo=timezone.utc),
+        datetime.combine(add_months(month, 1), datetime.min.time(), tzinfo=timezone.utc),
+    )
+
+
+def create_partition(month):
+    """Create the partition of `month`, moving its rows out of the default partition.
+
+    requested_at comes from the client, so searches dated past the created
+    partitions wait in the default one; PostgreSQL refuses a new partition
+    while the default holds rows that belong to it.
+    """
+    quote = connection.ops.quote_name
+    name, default, table = quote(partition_name(month)), quote(DEFAULT_PARTITION), quote(TABLE)
+    start, end = month_bounds(month)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL, to_regclass(%s) IS NOT NULL",
+                       [partition_name(month), DEFAULT_PARTITION])
+        exists, has_default = cursor.fetchone()
+        if exists:
+            return
+        waiting = False
+        if has_default:
+            cursor.execute(
+                f"SELECT EXISTS (SELECT 1 FROM {default} WHERE requested_at >= %s AND requested_at < %s)",
+                [start, end],
+            )
+            waiting = cursor.fetchone()[0]
+        if waiting:
+            # deferred foreign key checks would block the ALTER TABLEs below
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {default}")
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", [start, end])
+        if waiting:
+            cursor.execute(
+                f"WITH moved AS (DELETE FROM {default} WHERE requested_at >= %s AND requested_at < %s RETURNING *) "
+                f"INSERT INTO {table} SELECT * FROM moved",
+                [start, end],
+            )
+            cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT")
+
+
+def _microseconds(value):
+    return int(value.timestamp() * 1_000_000)
+
+
+def export_partition(name, path):
+    """Write one partition to `path` as a compressed .npz; returns the row count.
+
+    Datetimes are stored as UTC epoch microseconds, a missing user as -1 and
+    missing strings as "".
+    """
+    quote = connection.ops.quote_name
+    columns = {column: [] for column in ARCHIVE_COLUMNS}
+    with transaction.atomic(), connection.chunked_cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(map(quote, ARCHIVE_COLUMNS))} FROM {quote(name)} ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                for column, value in zip(ARCHIVE_COLUMNS, row):
+                    columns[column].append(value)
+
+    arrays = {
+        "id": np.array(columns["id"], dtype=np.int64),
+        "user_id": np.array([-1 if value is None else value for value in columns["user_id"]], dtype=np.int64),
+        "anonymous_session_key": np.array([value or "" for value in columns["anonymous_session_key"]], dtype=str),
+        "modes": np.array([value or "" for value in columns["modes"]], dtype=str),
+    }
+    for column in ("from_lat", "from_lon", "to_lat", "to_lon"):
+        arrays[column] = np.array(columns[column], dtype=np.float64)
+    for column in ("trip_date", "requested_at"):
+        arrays[column] = np.array([_microseconds(value) for value in columns[column]], dtype=np.int64)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, table=np.array(name), **arrays)
+    os.replace(tmp_path, path)
+    return len(arrays["id"])
+
+
+def detach_partition(name):
+    quote = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        # deferred foreign key checks of rows written in this transaction would block the DETACH
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute(f"ALTER TABLE {quote(TABLE)} DETACH PARTITION {quote(name)}")
+
+
+def drop_partition(name):
+    """Drop a detached partition, once its archive is written."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {connection.ops.quote_name(name)}")
@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import Search, FavoritePlace, Booking, Feedback
 from django.contrib.auth import get_user_model
@@ -63,6 +64,12 @@ class PlanTripSerializer(serializers.Serializer):
     requested_date= serializers.DateField()
     requested_time = serializers.CharField()
     mode = serializers.CharField()  # required by default
+    # leave leg geometry and walk steps out; fetch them per itinerary later
+    summary = serializers.BooleanField(required=False, default=False)
+    # optional leg geometry simplification (meters, typically chosen by map zoom)
+    # and polyline precision of the returned geometry
+    geometry_tolerance = serializers.FloatField(required=False, min_value=0)
+    geometry_precision = serializers.IntegerField(required=False, min_value=1, max_value=7)
 
     def validate_mode(self, value):
         allowed_modes = ['all', 'bus', 'walk', 'bicycle', 'scooter']
@@ -70,3 +77,79 @@ class PlanTripSerializer(serializers.Serializer):
             raise serializers.ValidationError(f"Mode must be one of {allowed_modes}")
         return value.lower()
 
+
+
+class PlanPairSerializer(serializers.Serializer):
+    fromLat = serializers.FloatField()
+    fromLon = serializers.FloatField()
+    toLat = serializers.FloatField()
+    toLon = serializers.FloatField()
+
+
+class PointSerializer(serializers.Serializer):
+    lat = serializers.FloatField()
+    lon = serializers.FloatField()
+
+
+class PlanTripBatchSerializer(serializers.Serializer):
+    """Either explicit `pairs` or every combination of `origins` x `destinations`."""
+    pairs = PlanPairSerializer(many=True, required=False)
+    origins = PointSerializer(many=True, required=False)
+    destinations = PointSerializer(many=True, required=False)
+    date = serializers.DateField()
+    time = serializers.CharField(required=False, default='timenow')
+    mode = serializers.CharField()
+    summary = serializers.BooleanField(required=False, default=False)
+
+    validate_mode = PlanTripSerializer.validate_mode
+
+    def validate(self, attrs):
+        pairs = attrs.get('pairs')
+        origins = attrs.pop('origins', None)
+        destinations = attrs.pop('destinations', None)
+        if pairs is None:
+            if not origins or not destinations:
+                raise serializers.ValidationError("Provide either pairs or both origins and destinations.")
+            pairs = [
+                {"fromLat": o["lat"], "fromLon": o["lon"], "toLat": d["lat"], "toLon": d["lon"]}
+                for o in origins for d in destinations
+            ]
+        elif origins or destinations:
+            raise serializers.ValidationError("Provide either pairs or origins and destinations, not both.")
+
+        if not pairs:
+            raise serializers.ValidationError("At least one origin/destination pair is required.")
+        if len(pairs) > settings.PLAN_BATCH_MAX_PAIRS:
+            raise serializers.ValidationError(f"At most {settings.PLAN_BATCH_MAX_PAIRS} pairs per request.")
+        attrs['pairs'] = pairs
+        return attrs
+
+
+class StopQuerySerializer(serializers.Serializer):
+    """Query parameters of the stops list: a bbox or a center and radius, plus paging."""
+    bbox = serializers.CharField(required=False, help_text="minLon,minLat,maxLon,maxLat")
+    lat = serializers.FloatField(required=False, min_value=-90, max_value=90)
+    lon = serializers.FloatField(required=False, min_value=-180, max_value=180)
+    radius = serializers.FloatField(required=False, min_value=0, max_value=settings.STOPS_MAX_RADIUS)
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=settings.STOPS_PAGE_MAX)
+    cursor = serializers.CharField(required=False)
+    since = serializers.CharField(required=False, help_text="catalogue version the client already has")
+
+    def validate_bbox(self, value):
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(","))
+        except ValueError:
+            raise serializers.ValidationError("bbox must be minLon,minLat,maxLon,maxLat.")
+        if min_lon > max_lon or min_lat > max_lat:
+            raise serializers.ValidationError("bbox minimums must not exceed its maximums.")
+        return min_lat, min_lon, max_lat, max_lon
+
+    def validate(self, attrs):
+        center = [name for name in ('lat', 'lon', 'radius') if name in attrs]
+        if center and len(center) != 3:
+            raise serializers.ValidationError("lat, lon and radius go together.")
+        if center and 'bbox' in attrs:
+            raise serializers.ValidationError("Provide either bbox or lat/lon/radius, not both.")
+        if 'since' in attrs and (center or 'bbox' in attrs):
+            raise serializers.ValidationError("since only applies to the full stop list.")
+        return attrs
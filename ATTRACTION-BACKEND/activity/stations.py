@@ -0,0 +1,125 @@
+"""Stop list filtering and departure-board shaping shared by the stop views."""
+import base64
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from .cache import LRUCache
+
+SCHEDULE_QUERY = """
+query ($stopId: String!) {
+  stop(id: $stopId) {
+    name
+    stoptimesWithoutPatterns (numberOfDepartures: 300) {
+      scheduledArrival
+      realtimeArrival
+      scheduledDeparture
+      realtimeDeparture
+      trip {
+        route {
+          shortName
+          longName
+        }
+      }
+    }
+  }
+}
+"""
+
+MIDNIGHT_SECONDS = 86400
+
+# last good OTP `stop` answer per stop id, the fallback while OTP is unavailable
+schedule_cache = LRUCache(settings.SCHEDULE_STALE_CACHE_SIZE, ttl=settings.SCHEDULE_STALE_TTL)
+
+
+def in_rende_or_cosenza(stop):
+    lat = stop.get("lat")
+    lon = stop.get("lon")
+    if not lat or not lon:
+        return False
+
+    in_cosenza = 39.28 <= lat <= 39.32 and 16.22 <= lon <= 16.28
+    in_rende = 39.30 <= lat <= 39.38 and 16.17 <= lon <= 16.26
+    return in_cosenza or in_rende
+
+
+def region_stops(stops):
+    """Stops inside the Rende and Cosenza service area."""
+    return [stop for stop in stops if in_rende_or_cosenza(stop)]
+
+
+class InvalidCursor(ValueError):
+    """The paging cursor is malformed or belongs to another stop list version."""
+
+
+def encode_cursor(version, offset):
+    raw = json.dumps({"v": version, "o": offset}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, version):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offset = int(data["o"])
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor("Invalid cursor.")
+    if data.get("v") != version or offset < 0:
+        raise InvalidCursor("The stop list changed, start again without a cursor.")
+    return offset
+
+
+def query_stops(index, version, query):
+    """One page of the stops matching a validated StopQuerySerializer query.
+
+    Radius results come closest first with a `distance_m`, bbox results in
+    catalogue order. Cursors are tied to `version`, so paging never mixes two
+    catalogue versions.
+    """
+    if "bbox" in query:
+        matches = index.within_bbox(*query["bbox"])
+    else:
+        matches = [
+            {**stop, "distance_m": round(distance, 1)}
+            for distance, stop in index.within_radius(query["lat"], query["lon"], query["radius"])
+        ]
+
+    offset = decode_cursor(query["cursor"], version) if query.get("cursor") else 0
+    limit = query.get("limit", settings.STOPS_PAGE_SIZE)
+    end = offset + limit
+    return {
+        "stops": matches[offset:end],
+        "count": len(matches),
+        "next_cursor": encode_cursor(version, end) if end < len(matches) else None,
+    }
+
+
+def seconds_since_midnight(now=None):
+    now = now or datetime.now()
+    return now.hour * 3600 + now.minute * 60 + now.second
+
+
+def clock(seconds):
+    """H:MM for seconds since midnight."""
+    return str(timedelta(seconds=seconds))[:-3]
+
+
+def upcoming_trips(stop, now_seconds):
+    """Departures of an OTP `stop` from `now_seconds` until midnight, soonest first."""
+    filtered = [
+        t for t in stop.get("stoptimesWithoutPatterns", [])
+        if t["realtimeArrival"] is not None and now_seconds <= t["realtimeArrival"] <= MIDNIGHT_SECONDS
+    ]
+    filtered = sorted(filtered, key=lambda t: t["realtimeArrival"])
+
+    trips = []
+    for t in filtered:
+        arrival_sec = t["realtimeArrival"] or t["scheduledArrival"]
+        departure_sec = t["realtimeDeparture"] or t["scheduledDeparture"]
+        trips.append({
+            "route": t["trip"]["route"]["shortName"],
+            "name": t["trip"]["route"]["longName"],
+            "arrival": clock(arrival_sec),
+            "departure": clock(departure_sec)
+        })
+    return trips
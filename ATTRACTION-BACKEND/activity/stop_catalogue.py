@@ -0,0 +1,217 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections.abc import Mapping
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .catalogue_file import MappedCatalogue, file_identity, write_catalogue
+from .geo import StopIndex
+from .otp_client import get_otp_client
+
+logger = logging.getLogger(__name__)
+
+# stops are identified by their GTFS id ("Feed:StopId"), the id station URLs,
+# the schedule query and the local GTFS store use, rather than OTP's Relay id
+STOPS_QUERY = """
+query {
+  stops {
+    id: gtfsId
+    name
+    lat
+    lon
+    code
+  }
+}
+"""
+
+
+def fetch_stops():
+    return get_otp_client().query(STOPS_QUERY, name="stops").get("stops") or []
+
+
+def stops_version(stops):
+    # identical across workers that loaded the same stop list
+    return hashlib.sha1(json.dumps(stops, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class MappedStopsById(Mapping):
+    """`by_id` of a mapped catalogue: only positions are kept, stops are decoded on access."""
+
+    def __init__(self, stops):
+        self.stops = stops
+        self.positions = {stop_id: i for i, stop_id in enumerate(stops.ids())}
+
+    def __getitem__(self, stop_id):
+        return self.stops[self.positions[stop_id]]
+
+    def __contains__(self, stop_id):
+        return stop_id in self.positions
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+
+class StopSnapshot:
+    """Immutable view of the stop list as it was at `loaded_at`, with its spatial index."""
+
+    def __init__(self, stops, loaded_at, version=None):
+        self.stops = stops
+        self.loaded_at = loaded_at
+        if isinstance(stops, MappedCatalogue):
+            self.by_id = MappedStopsById(stops)
+        else:
+            self.by_id = {stop["id"]: stop for stop in stops}
+        self.index = StopIndex(stops)
+        self.version = version or stops_version(stops)
+
+
+class StopCatalogue:
+    """Per-worker stop list shared by the trip planner, stops list and station page.
+
+    The first call to `get()` loads the catalogue synchronously. Afterwards
+    readers always get the current snapshot immediately; once it is older
+    than `ttl` seconds a single background thread replaces it. A failed
+    refresh keeps serving the previous snapshot, flagged by `stale`, and is
+    retried after `retry_interval` seconds.
+
+    With a `path`, the catalogue is shared through a memory-mapped file (see
+    catalogue_file): a worker starts from the file instead of querying OTP,
+    whichever worker refreshes first publishes the new version there, and the
+    others swap it in on their next `get()` after at most `check_interval`
+    seconds, without a restart.
+    """
+
+    def __init__(self, fetch, ttl, retry_interval=30, path=None, check_interval=5):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.path = path
+        self.check_interval = check_interval
+        self._file = None
+        self._next_check = 0.0
+        self._snapshot = None
+        self._load_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._refreshing = False
+        self._next_attempt = 0.0
+        self.stale = False
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._load_lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load()
+                return self._snapshot
+
+        now = time.monotonic()
+        if self.path and now >= self._next_check:
+            self._next_check = now + self.check_interval
+            snapshot = self._swap_in_published(snapshot)
+        if now - snapshot.loaded_at >= self.ttl and now >= self._next_attempt:
+            self._refresh_in_background()
+        return snapshot
+
+    async def aget(self):
+        """`get()` for async callers.
+
+        The first load and the periodic check for a newly published file
+        (which may map and index it) run in a thread; otherwise `get()` only
+        returns the current snapshot and is called on the event loop.
+        """
+        if self._snapshot is not None and not (self.path and time.monotonic() >= self._next_check):
+            return self.get()
+        return await sync_to_async(self.get, thread_sensitive=False)()
+
+    def peek(self):
+        """Return the current snapshot without ever triggering a load."""
+        return self._snapshot
+
+    def invalidate(self):
+        self._snapshot = None
+        self._file = None
+        self.stale = False
+
+    def _load(self):
+        if self._snapshot is None and self.path:
+            # start from whatever another worker published, however old: get() refreshes it
+            snapshot = self._map_file()
+            if snapshot is not None:
+                return snapshot
+        stops = self.fetch()
+        if self.path:
+            try:
+                write_catalogue(self.path, stops, stops_version(stops))
+            except OSError:
+                logger.warning("Could not publish the stop catalogue to %s", self.path, exc_info=True)
+            else:
+                snapshot = self._map_file()
+                if snapshot is not None:
+                    return snapshot
+        return StopSnapshot(stops, time.monotonic())
+
+    def _map_file(self):
+        try:
+            stops = MappedCatalogue(self.path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            logger.warning("Ignoring unreadable stop catalogue file %s", self.path, exc_info=True)
+            return None
+        self._file = stops.identity
+        age = max(0.0, time.time() - stops.written_at)
+        return StopSnapshot(stops, time.monotonic() - age, version=stops.version)
+
+    def _swap_in_published(self, snapshot):
+        """Pick up a catalogue file another worker wrote since this one was mapped."""
+        identity = file_identity(self.path)
+        # a refresh holding the lock publishes its own snapshot; never wait for it
+        if identity is None or identity == self._file or not self._load_lock.acquire(blocking=False):
+            return snapshot
+        try:
+            if file_identity(self.path) != self._file:
+                published = self._map_file()
+                if published is not None and published.loaded_at >= snapshot.loaded_at:
+                    self._snapshot = published
+            return self._snapshot
+        finally:
+            self._load_lock.release()
+
+    def _refresh_in_background(self):
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="stop-catalogue-refresh", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            with self._load_lock:
+                published = self._map_file() if self.path and file_identity(self.path) != self._file else None
+                if published is not None and time.monotonic() - published.loaded_at < self.ttl:
+                    self._snapshot = published
+                else:
+                    self._snapshot = self._load()
+            self.stale = False
+        except Exception:
+            logger.warning("Stop catalogue refresh failed, serving previous snapshot", exc_info=True)
+            self.stale = True
+            self._next_attempt = time.monotonic() + self.retry_interval
+        finally:
+            with self._state_lock:
+                self._refreshing = False
+
+
+stop_catalogue = StopCatalogue(
+    fetch_stops,
+    ttl=settings.OTP_STOP_CATALOGUE_TTL,
+    path=settings.OTP_STOP_CATALOGUE_PATH,
+    check_interval=settings.OTP_STOP_CATALOGUE_CHECK_INTERVAL,
+)
@@ -0,0 +1,97 @@
+"""Stops of one web-mercator map tile (z/x/y), clustered at low zoom.
+
+Below STOPS_TILE_CLUSTER_MAX_ZOOM (inclusive) each tile is split into a
+STOPS_TILE_GRID x STOPS_TILE_GRID grid and every grid cell holding more than
+one stop becomes a cluster `{"lat", "lon", "count"}` at the stops' centroid;
+lone stops are returned as they are. Above it every stop is returned. Tiles
+are rendered once per catalogue version.
+"""
+from math import atan, degrees, floor, pi, sinh
+
+import numpy as np
+from django.conf import settings
+
+from .cache import LRUCache
+from .stops_payload import StopsPayload
+
+MAX_ZOOM = 22
+MAX_MERCATOR_LAT = 85.05112878
+
+tile_cache = LRUCache(settings.STOPS_TILE_CACHE_SIZE)
+
+
+class InvalidTile(ValueError):
+    pass
+
+
+def tile_lat(y, zoom):
+    return degrees(atan(sinh(pi * (1 - 2 * y / 2 ** zoom))))
+
+
+def tile_bounds(zoom, x, y):
+    """(min_lat, min_lon, max_lat, max_lon) of a tile."""
+    n = 2 ** zoom
+    return tile_lat(y + 1, zoom), x / n * 360.0 - 180.0, tile_lat(y, zoom), (x + 1) / n * 360.0 - 180.0
+
+
+def tile_coordinates(lats, lons, zoom):
+    """Fractional tile x / y of the points at `zoom`."""
+    n = 2 ** zoom
+    lats = np.radians(np.clip(lats, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+    xs = (np.asarray(lons) + 180.0) / 360.0 * n
+    ys = (1 - np.log(np.tan(lats) + 1 / np.cos(lats)) / pi) / 2 * n
+    return xs, ys
+
+
+def validate_tile(zoom, x, y):
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise InvalidTile(f"Zoom must be between 0 and {MAX_ZOOM}.")
+    if not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        raise InvalidTile("Tile outside the map at this zoom.")
+
+
+def build_tile(index, zoom, x, y):
+    min_lat, min_lon, max_lat, max_lon = tile_bounds(zoom, x, y)
+    stops = index.within_bbox(min_lat, min_lon, max_lat, max_lon)
+    if not stops:
+        return [], []
+    lats = np.array([stop["lat"] for stop in stops], dtype=np.float64)
+    lons = np.array([stop["lon"] for stop in stops], dtype=np.float64)
+    xs, ys = tile_coordinates(lats, lons, zoom)
+    # tiles share their edges; a stop on one belongs to the tile right / below it only
+    own = (np.floor(xs) == x) & (np.floor(ys) == y)
+    if zoom > settings.STOPS_TILE_CLUSTER_MAX_ZOOM:
+        return [], [stop for stop, keep in zip(stops, own) if keep]
+
+    grid = settings.STOPS_TILE_GRID
+    cells = {}
+    for position in np.flatnonzero(own):
+        cell = (floor((xs[position] - x) * grid), floor((ys[position] - y) * grid))
+        cells.setdefault(cell, []).append(position)
+    clusters, singles = [], []
+    for cell in sorted(cells):
+        positions = cells[cell]
+        if len(positions) == 1:
+            singles.append(stops[positions[0]])
+        else:
+            clusters.append({
+                "lat": round(float(lats[positions].mean()), 6),
+                "lon": round(float(lons[positions].mean()), 6),
+                "count": len(positions),
+            })
+    return clusters, singles
+
+
+def tile_payload(catalogue, zoom, x, y, stale=False):
+    """Cached payload of one tile of `catalogue`; raises InvalidTile."""
+    validate_tile(zoom, x, y)
+    key = (catalogue.version, zoom, x, y, stale)
+    payload = tile_cache.get(key)
+    if payload is None:
+        clusters, stops = build_tile(catalogue.index, zoom, x, y)
+        data = {"version": catalogue.version, "z": zoom, "x": x, "y": y, "clusters": clusters, "stops": stops}
+        if stale:
+            data["stale"] = True
+        payload = StopsPayload(data)
+        tile_cache.set(key, payload)
+    return payload
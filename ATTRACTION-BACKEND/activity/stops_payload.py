@@ -0,0 +1,132 @@
+"""Stops list rendered once per catalogue version.
+
+The Rende/Cosenza stop list only changes with the catalogue, so its JSON is
+built once per (version, stale) and kept as raw, gzip and, when the optional
+`brotli` package is installed, brotli bytes. The ETag is a hash of the JSON,
+suffixed with the encoding (`"<hash>-gzip"`, `"<hash>-br"`) for compressed
+bodies so caches never mix them up. The encoding is negotiated from
+Accept-Encoding, q-values included (`br;q=0` refuses brotli).
+
+`?since=<version>` answers with the changes from that version:
+`{"version", "since", "changed": [stop, ...], "removed": [stop_id, ...]}`.
+When `since` is no longer remembered the full `{"version", "stops"}` list is
+returned instead, so clients replace their copy whenever `stops` is present.
+"""
+import gzip
+import hashlib
+import json
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+from .cache import LRUCache
+from .stations import region_stops
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+# version -> {stop_id: stop} of the region, to diff later versions against
+region_versions = LRUCache(settings.STOPS_PAYLOAD_VERSIONS)
+payload_cache = LRUCache(settings.STOPS_PAYLOAD_CACHE_SIZE)
+
+
+def accepted_encodings(header):
+    """{content-coding: q} of an Accept-Encoding header; malformed q-values count as 0."""
+    accepted = {}
+    for part in header.split(","):
+        coding, *params = (piece.strip() for piece in part.split(";"))
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.lower()] = q
+    return accepted
+
+
+def negotiate_encoding(header, available):
+    """The acceptable coding of `available` with the highest q (earlier ones win ties), or None."""
+    accepted = accepted_encodings(header)
+    best, best_q = None, 0.0
+    for name in available:
+        q = accepted.get(name, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+class StopsPayload:
+    """One JSON body in every encoding we serve, with their ETags."""
+
+    def __init__(self, data):
+        self.body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha1(self.body).hexdigest()[:32]
+        self.encoded = {"gzip": gzip.compress(self.body, compresslevel=9)}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body)
+        # each encoding is a different representation, with an ETag of its own
+        self.etag = '"%s"' % digest
+        self.etags = {encoding: '"%s-%s"' % (digest, encoding) for encoding in self.encoded}
+
+    def response(self, request):
+        available = [name for name in ("br", "gzip") if name in self.encoded]
+        encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""), available)
+        etag = self.etag if encoding is None else self.etags[encoding]
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = HttpResponseNotModified()
+        elif encoding is None:
+            response = HttpResponse(self.body, content_type="application/json")
+        else:
+            response = HttpResponse(self.encoded[encoding], content_type="application/json")
+            response["Content-Encoding"] = encoding
+        response["ETag"] = etag
+        patch_vary_headers(response, ("Accept-Encoding",))
+        response["Cache-Control"] = "no-cache"
+        return response
+
+
+def region_by_id(catalogue):
+    stops = region_versions.get(catalogue.version)
+    if stops is None:
+        stops = {stop["id"]: stop for stop in region_stops(catalogue.stops)}
+        region_versions.set(catalogue.version, stops)
+    return stops
+
+
+def stops_payload(catalogue, since=None, stale=False):
+    """Cached payload of the region stops of `catalogue`, or of its changes since `since`."""
+    current = region_by_id(catalogue)
+    previous = None
+    if since is not None and since != catalogue.version:
+        previous = region_versions.get(since)
+
+    key = (catalogue.version, since if previous is not None or since == catalogue.version else None, stale)
+    payload = payload_cache.get(key)
+    if payload is not None:
+        return payload
+
+    if since == catalogue.version:
+        data = {"version": catalogue.version, "since": since, "changed": [], "removed": []}
+    elif previous is not None:
+        data = {
+            "version": catalogue.version,
+            "since": since,
+            "changed": [stop for stop_id, stop in current.items() if previous.get(stop_id) != stop],
+            "removed": [stop_id for stop_id in previous if stop_id not in current],
+        }
+    else:
+        data = {"version": catalogue.version, "stops": list(current.values())}
+    if stale:
+        data["stale"] = True
+    payload = StopsPayload(data)
+    payload_cache.set(key, payload)
+    return payload
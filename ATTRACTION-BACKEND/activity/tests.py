@@ -1,3 +1,1577 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import httpx
+import numpy as np
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.core.signals import request_started
+from django.db import InterfaceError, connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import distance, polyline
+from .board_stream import BoardTopic, sse_event
+from .boards import UnknownStop, check_known
+from .geo import StopIndex, haversine
+from .cache import LRUCache
+from .catalogue_file import MappedCatalogue, file_identity, write_catalogue
+from .gtfs import DepartureIndex, GTFSStore, get_gtfs_store, parse_gtfs_time
+from .models import Booking, Search
+from .otp_client import (
+    AsyncOTPClient,
+    CircuitBreaker,
+    CircuitOpen,
+    OTPClient,
+    OTPUnavailable,
+    SingleFlight,
+    _async_clients,
+    get_async_otp_client,
+)
+from .search_log import SearchLog
+from .planning import (
+    PLAN_QUERY,
+    PLAN_QUERY_WITH_MODES,
+    TRANSPORT_MODES,
+    PlanRequest,
+    build_plan_query,
+    summarize_plan,
+)
+from .serializers import PlanTripSerializer
+from .search_partitions import (
+    add_months,
+    create_partition,
+    detached_partitions,
+    export_partition,
+    is_partitioned,
+    monthly_partitions,
+    month_start,
+)
+from .stop_catalogue import StopCatalogue, StopSnapshot, fetch_stops
+from .stop_tiles import InvalidTile, build_tile, tile_bounds, tile_coordinates, tile_payload
+from .stops_payload import StopsPayload, negotiate_encoding
+from .warmup import warm_up_on_first_request
+
+# 2026-10-19 is a Monday; weekday service WK is cancelled on 2026-10-20 and
+# the extra service EX only runs that day.
+SAMPLE_FEED = {
+    "stops.txt": (
+        "stop_id,stop_code,stop_name,stop_lat,stop_lon\n"
+        "S1,101,Cosenza Autostazione,39.2990,16.2530\n"
+        "S2,102,Rende Unical,39.3560,16.2260\n"
+        "FAR,,Napoli Centrale,40.8530,14.2720\n"
+    ),
+    "routes.txt": (
+        "route_id,route_short_name,route_long_name,route_type\n"
+        "R5,5,Cosenza - Unical,3\n"
+    ),
+    "trips.txt": (
+        "route_id,service_id,trip_id,trip_headsign\n"
+        "R5,WK,T1,Unical\n"
+        "R5,WK,T2,Unical\n"
+        "R5,EX,T3,Unical\n"
+    ),
+    "stop_times.txt": (
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "T2,09:00:00,09:01:00,S1,1\n"
+        "T2,09:20:00,09:20:00,S2,2\n"
+        "T1,08:00:00,08:01:00,S1,1\n"
+        "T1,,,FAR,2\n"
+        "T1,08:20:00,08:20:00,S2,3\n"
+        "T3,10:00:00,10:00:00,S1,1\n"
+        "T3,25:10:00,25:10:00,S2,2\n"
+    ),
+    "calendar.txt": (
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+        "WK,1,1,1,1,1,0,0,20260101,20261231\n"
+    ),
+    "calendar_dates.txt": (
+        "service_id,date,exception_type\n"
+        "WK,20261020,2\n"
+        "EX,20261020,1\n"
+    ),
+}
+
+
+# stops as OTP knows them: Relay `id` and GTFS `gtfsId`
+OTP_STOPS = [
+    {"id": "U3RvcDoxOlMx", "gtfsId": "1:S1", "name": "Cosenza Autostazione", "lat": 39.2990, "lon": 16.2530, "code": "101"},
+    {"id": "U3RvcDoxOlMy", "gtfsId": "1:S2", "name": "Rende Unical", "lat": 39.3560, "lon": 16.2260, "code": "102"},
+]
+
+
+def fake_otp_stops_query(query, *args, **kwargs):
+    """Answer a `stops { ... }` query the way OTP would, aliases included."""
+    tokens = re.search(r"stops\s*{([^}]*)}", query).group(1).split()
+    selection = []
+    while tokens:
+        token = tokens.pop(0)
+        selection.append((token[:-1], tokens.pop(0)) if token.endswith(":") else (token, token))
+    return {"stops": [{alias: stop[field] for alias, field in selection} for stop in OTP_STOPS]}
+
+
+def wait_until(condition, timeout=5):
+    """Poll `condition` until it holds or `timeout` seconds pass; returns its last value."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class GTFSStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.feed_path = os.path.join(self.tmp, "feed.zip")
+        with zipfile.ZipFile(self.feed_path, "w") as archive:
+            for name, content in SAMPLE_FEED.items():
+                archive.writestr(name, content)
+        self.store_path = os.path.join(self.tmp, "store", "feed.npz")
+        call_command("ingest_gtfs", self.feed_path, output=self.store_path, feed_id="1", stdout=io.StringIO())
+
+    def load(self):
+        return GTFSStore.load(self.store_path)
+
+    def test_parse_gtfs_time(self):
+        self.assertEqual(parse_gtfs_time("08:01:30"), 8 * 3600 + 90)
+        self.assertEqual(parse_gtfs_time("25:10:00"), 25 * 3600 + 600)
+        self.assertIsNone(parse_gtfs_time(""))
+
+    def test_stops_use_otp_ids(self):
+        store = self.load()
+        self.assertEqual(len(store.stops), 3)
+        self.assertEqual(store.stop("1:S1"), {
+            "id": "1:S1", "name": "Cosenza Autostazione", "lat": 39.299, "lon": 16.253, "code": "101",
+        })
+        self.assertIsNone(store.stop("1:FAR")["code"])
+        self.assertIsNone(store.stop("S1"))
+
+    def test_weekday_departures_in_order(self):
+        trips = self.load().upcoming_trips("1:S1", now=datetime(2026, 10, 19, 7, 0))
+        self.assertEqual([(t["route"], t["arrival"], t["departure"]) for t in trips], [
+            ("5", "8:00", "8:01"),
+            ("5", "9:00", "9:01"),
+        ])
+        self.assertEqual(trips[0]["name"], "Cosenza - Unical")
+
+    def test_departures_start_at_now(self):
+        trips = self.load().upcoming_trips("1:S1", now=datetime(2026, 10, 19, 8, 30))
+        self.assertEqual([t["arrival"] for t in trips], ["9:00"])
+
+    def test_calendar_exceptions(self):
+        store = self.load()
+        self.assertEqual([t["arrival"] for t in store.upcoming_trips("1:S1", now=datetime(2026, 10, 20, 7, 0))], ["10:00"])
+        self.assertEqual(store.upcoming_trips("1:S1", now=datetime(2026, 10, 24, 7, 0)), [])
+
+    def test_untimed_and_after_midnight_stop_times_are_skipped(self):
+        store = self.load()
+        self.assertEqual(store.upcoming_trips("1:FAR", now=datetime(2026, 10, 19, 0, 0)), [])
+        self.assertEqual(store.upcoming_trips("1:S2", now=datetime(2026, 10, 20, 0, 0)), [])
+
+    def test_departure_index_matches_scan(self):
+        store = self.load()
+        for day in (date(2026, 10, 19), date(2026, 10, 20), date(2026, 10, 24)):
+            day_index = DepartureIndex(store, day)
+            for stop_id, index in store.stop_index.items():
+                for hour in range(0, 24, 2):
+                    now = datetime.combine(day, datetime.min.time()).replace(hour=hour, minute=30)
+                    self.assertEqual(day_index.upcoming(index, hour * 3600 + 1800), store.scan_upcoming(index, now))
+
+    def test_departure_index_is_built_in_background(self):
+        store = self.load()
+        day = date(2026, 10, 19)
+        self.assertIsNone(store.departure_index(day))
+        for _ in range(200):
+            if store.departure_index(day) is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(store.departure_index(day).day, day)
+        self.assertEqual([t["arrival"] for t in store.upcoming_trips("1:S1", now=datetime(2026, 10, 19, 8, 30))], ["9:00"])
+
+    @override_settings(GTFS_INDEX_RETRY_INTERVAL=300)
+    def test_failed_departure_index_is_retried_after_a_backoff(self):
+        store = self.load()
+        day = date(2026, 10, 19)
+        clock = mock.Mock()
+        clock.monotonic.return_value = 1000.0
+        with mock.patch("activity.gtfs.time", clock), \
+                mock.patch("activity.gtfs.DepartureIndex", side_effect=MemoryError) as build, \
+                self.assertLogs("activity.gtfs", "ERROR"):
+            self.assertIsNone(store.departure_index(day))
+            self.assertTrue(wait_until(lambda: store._building is None))
+
+            # boards keep being scanned on the spot, without a rebuild per request
+            for _ in range(5):
+                self.assertIsNone(store.departure_index(day))
+                self.assertEqual([t["arrival"] for t in store.upcoming_trips("1:S1", now=datetime(2026, 10, 19, 8, 30))], ["9:00"])
+            self.assertEqual(build.call_count, 1)
+
+            build.side_effect = DepartureIndex
+            clock.monotonic.return_value += 300
+            self.assertIsNone(store.departure_index(day))
+            self.assertTrue(wait_until(lambda: store.departure_index(day) is not None))
+        self.assertEqual(build.call_count, 2)
+
+    def test_missing_file_is_rejected(self):
+        broken = os.path.join(self.tmp, "broken.zip")
+        with zipfile.ZipFile(broken, "w") as archive:
+            archive.writestr("stops.txt", SAMPLE_FEED["stops.txt"])
+        with self.assertRaisesMessage(CommandError, "routes.txt is missing"):
+            call_command("ingest_gtfs", broken, output=os.path.join(self.tmp, "x.npz"), stdout=io.StringIO())
+
+    def test_views_answer_from_store_without_otp(self):
+        with override_settings(GTFS_STORE_PATH=self.store_path, GTFS_REALTIME_OVERLAY=False), \
+                mock.patch("activity.otp_client.OTPClient.query", side_effect=AssertionError("OTP called")):
+            self.assertIsNotNone(get_gtfs_store())
+
+            response = self.client.get(reverse("stops-list"))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([stop["id"] for stop in response.json()["stops"]], ["1:S1", "1:S2"])
+
+            response = self.client.get(reverse("stop_schedule", args=["1:S1"]))
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, "Cosenza Autostazione")
+
+            response = self.client.get(reverse("stop_schedule", args=["1:NOPE"]))
+            self.assertContains(response, "Unknown Stop")
+
+    def test_store_and_otp_catalogue_share_stop_ids(self):
+        catalogue = StopCatalogue(fetch_stops, ttl=600)
+        with mock.patch("activity.stop_catalogue.get_otp_client") as client, \
+                mock.patch("activity.views.stop_catalogue", catalogue), \
+                mock.patch("activity.boards.stop_catalogue", catalogue):
+            client.return_value.query.side_effect = fake_otp_stops_query
+            with override_settings(GTFS_STORE_PATH=os.path.join(self.tmp, "missing.npz")):
+                self.assertIsNone(get_gtfs_store())
+                from_otp = self.client.get(reverse("stops-list")).json()["stops"]
+            with override_settings(GTFS_STORE_PATH=self.store_path, GTFS_REALTIME_OVERLAY=False):
+                from_store = self.client.get(reverse("stops-list")).json()["stops"]
+
+                self.assertEqual([stop["id"] for stop in from_otp], [stop["id"] for stop in from_store])
+                self.assertEqual(from_otp, from_store)
+                for stop in from_otp:
+                    check_known(stop["id"])
+                    self.assertEqual(self.client.get(reverse("stop_departures", args=[stop["id"]])).status_code, 200)
+
+    def test_departures_conditional_get(self):
+        with override_settings(GTFS_STORE_PATH=self.store_path, GTFS_REALTIME_OVERLAY=False), \
+                mock.patch("activity.boards.datetime") as clock:
+            # both requests fall in the same minute, hence the same board
+            clock.now.return_value = datetime(2026, 10, 19, 7, 0, 30)
+            url = reverse("stop_departures", args=["1:S1"])
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["stop_name"], "Cosenza Autostazione")
+            self.assertTrue(response["ETag"].startswith('"'))
+            self.assertIn("max-age=", response["Cache-Control"])
+
+            repeat = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(repeat.status_code, 304)
+            self.assertEqual(repeat["ETag"], response["ETag"])
+            self.assertEqual(repeat.content, b"")
+
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+            self.assertEqual(self.client.get(reverse("stop_departures", args=["1:NOPE"])).status_code, 404)
+
+    def test_without_store(self):
+        with override_settings(GTFS_STORE_PATH=os.path.join(self.tmp, "missing.npz")):
+            self.assertIsNone(get_gtfs_store())
+
+
+@skipUnless(connection.vendor == "postgresql", "query plans are checked on PostgreSQL")
+class QueryPlanTests(TestCase):
+    """The hot Search / Booking queries are answered from the indexes of migration 0014."""
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.user = User.objects.create_user(username="rider", email="rider@example.com", password="x")
+        other = User.objects.create_user(username="other", email="other@example.com", password="x")
+        now = timezone.now()
+        Search.objects.bulk_create(
+            [Search(user=cls.user, requested_at=now - timedelta(minutes=i)) for i in range(50)]
+            + [Search(user=other, requested_at=now - timedelta(minutes=i)) for i in range(50)]
+            + [Search(anonymous_session_key=f"session{i}") for i in range(50)]
+        )
+        Booking.objects.bulk_create([
+            Booking(user=cls.user, origin="A", destination="B", time=now + timedelta(hours=i), mode="BUS")
+            for i in range(50)
+        ])
+
+    def setUp(self):
+        # the test tables are tiny; make the planner show which index it would use on real ones
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, index_name):
+        # on the partitioned Search table the plan names each partition's copy of the index
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %s::regclass",
+                [index_name],
+            )
+            names = [index_name] + [row[0] for row in cursor.fetchall()]
+        plan = queryset.explain()
+        self.assertTrue(any(name in plan for name in names), plan)
+
+    def test_recent_searches_of_a_user(self):
+        self.assertUsesIndex(Search.objects.filter(user=self.user).order_by("-requested_at")[:5], "search_user_recent_idx")
+
+    def test_anonymous_searches_of_a_session(self):
+        self.assertUsesIndex(
+            Search.objects.filter(anonymous_session_key="session7", user__isnull=True),
+            "search_anon_session_idx",
+        )
+
+    def test_bookings_of_a_user_by_time(self):
+        self.assertUsesIndex(Booking.objects.filter(user=self.user).order_by("time"), "booking_user_time_idx")
+
+
+@skipUnless(connection.vendor == "postgresql", "Search is only partitioned on PostgreSQL")
+class SearchPartitionTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.current = month_start(timezone.now().date())
+
+    def test_rows_land_in_monthly_partitions(self):
+        self.assertTrue(is_partitioned())
+        self.assertIn(self.current, monthly_partitions())
+        search = Search.objects.create(anonymous_session_key="abc")
+        Search.objects.filter(pk=search.pk).update(requested_at=timezone.now() - timedelta(days=3 * 365))
+        self.assertEqual(Search.objects.get(pk=search.pk).anonymous_session_key, "abc")
+
+    def test_new_partition_takes_its_rows_from_the_default_partition(self):
+        month = add_months(self.current, 20)
+        requested_at = timezone.make_aware(datetime.combine(month, datetime.min.time()) + timedelta(days=3))
+        search = Search.objects.create(anonymous_session_key="future", requested_at=requested_at)
+
+        call_command("search_partitions", ahead=20, retain=12, archive_dir=self.tmp, stdout=io.StringIO())
+
+        self.assertIn(month, monthly_partitions())
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM activity_search_p{month:%Y%m} WHERE id = %s", [search.pk])
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute("SELECT count(*) FROM activity_search_default")
+            self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertEqual(Search.objects.get(pk=search.pk).anonymous_session_key, "future")
+
+    def test_command_creates_and_archives_partitions(self):
+        old_month = add_months(self.current, -14)
+        create_partition(old_month)
+        requested_at = timezone.make_aware(datetime.combine(old_month, datetime.min.time()) + timedelta(days=2))
+        Search.objects.bulk_create([Search(from_lat=39.3, requested_at=requested_at) for _ in range(3)])
+
+        call_command("search_partitions", ahead=6, retain=12, archive_dir=self.tmp, stdout=io.StringIO())
+
+        partitions = monthly_partitions()
+        self.assertNotIn(old_month, partitions)
+        self.assertIn(add_months(self.current, 6), partitions)
+        self.assertEqual(Search.objects.filter(requested_at=requested_at).count(), 0)
+        with np.load(os.path.join(self.tmp, f"activity_search_p{old_month:%Y%m}.npz")) as archive:
+            self.assertEqual(len(archive["id"]), 3)
+            self.assertEqual(archive["user_id"].tolist(), [-1, -1, -1])
+            self.assertEqual(archive["requested_at"][0], int(requested_at.timestamp() * 1_000_000))
+
+    def old_month_with_rows(self):
+        month = add_months(self.current, -14)
+        create_partition(month)
+        requested_at = timezone.make_aware(datetime.combine(month, datetime.min.time()) + timedelta(days=2))
+        Search.objects.bulk_create([Search(from_lat=39.3, requested_at=requested_at) for _ in range(3)])
+        return month, requested_at
+
+    def test_searches_written_during_the_export_are_kept(self):
+        month, requested_at = self.old_month_with_rows()
+        late = requested_at + timedelta(hours=1)
+
+        def export_while_writing(name, path):
+            # a client-dated search for the month arrives while it is being archived
+            Search.objects.create(anonymous_session_key="late", requested_at=late)
+            return export_partition(name, path)
+
+        with mock.patch("activity.management.commands.search_partitions.export_partition",
+                        side_effect=export_while_writing):
+            call_command("search_partitions", ahead=0, retain=12, archive_dir=self.tmp, stdout=io.StringIO())
+
+        self.assertNotIn(month, monthly_partitions())
+        with np.load(os.path.join(self.tmp, f"activity_search_p{month:%Y%m}.npz")) as archive:
+            self.assertEqual(len(archive["id"]), 3)
+        self.assertEqual(Search.objects.get(requested_at=late).anonymous_session_key, "late")
+
+    def test_failed_export_keeps_the_month_until_the_next_run(self):
+        month, requested_at = self.old_month_with_rows()
+        name = f"activity_search_p{month:%Y%m}"
+
+        with mock.patch("activity.management.commands.search_partitions.export_partition",
+                        side_effect=OSError("disk full")):
+            with self.assertRaises(CommandError):
+                call_command("search_partitions", ahead=0, retain=12, archive_dir=self.tmp, stdout=io.StringIO())
+        self.assertEqual(detached_partitions(), {month: name})
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {name}")
+            self.assertEqual(cursor.fetchone()[0], 3)
+
+        call_command("search_partitions", ahead=0, retain=12, archive_dir=self.tmp, stdout=io.StringIO())
+        self.assertEqual(detached_partitions(), {})
+        with np.load(os.path.join(self.tmp, f"{name}.npz")) as archive:
+            self.assertEqual(len(archive["id"]), 3)
+
+
+class SearchLogTests(SimpleTestCase):
+    def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("condition not reached")
+
+    def test_connection_errors_keep_rows_and_the_writer_alive(self):
+        log = SearchLog(max_pending=10, batch_size=1, flush_interval=0.01)
+        written = []
+        errors = [InterfaceError("connection already closed"), RuntimeError("unexpected")]
+
+        def bulk_create(rows, batch_size=None):
+            if errors:
+                raise errors.pop(0)
+            written.append([row.from_lat for row in rows])
+
+        with mock.patch.object(Search.objects, "bulk_create", side_effect=bulk_create):
+            log.add(from_lat=1.0)
+            self.wait_for(lambda: log.stats()["failed"] == 1)  # requeued, then lost to the unexpected error
+            log.add(from_lat=2.0)
+            self.wait_for(lambda: log.stats()["written"] == 1)
+            log.add(from_lat=3.0)
+            self.wait_for(lambda: log.stats()["written"] == 2)
+        self.assertEqual(written, [[2.0], [3.0]])
+        self.assertEqual(log.stats()["pending"], 0)
+        self.assertEqual(log.stats()["dropped"], 0)
+
+    def test_full_queue_drops_and_counts(self):
+        log = SearchLog(max_pending=2, batch_size=100, flush_interval=60)
+        results = [log.add(from_lat=float(i)) for i in range(4)]
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual(log.stats()["dropped"], 2)
+
+
+class AsyncOTPClientTests(SimpleTestCase):
+    def test_wsgi_request_closes_its_async_client(self):
+        clients = []
+
+        async def board(stop_id):
+            clients.append(get_async_otp_client())
+            raise UnknownStop(stop_id)
+
+        with mock.patch("activity.async_views.aget_board", side_effect=board):
+            response = self.client.get(reverse("stop_departures_async", args=["1:S1"]))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(clients), 1)
+        self.assertTrue(clients[0].client.is_closed)
+        self.assertEqual(len(_async_clients), 0)
+
+
+class BoardTopicTests(SimpleTestCase):
+    def test_full_queue_without_a_board_drops_the_oldest_event(self):
+        topic = BoardTopic({}, "1:S1")
+        queue = asyncio.Queue(maxsize=2)
+        topic.subscribers.add(queue)
+
+        for n in range(3):
+            topic.publish(sse_event("error", {"error": n}))
+
+        self.assertEqual(
+            [queue.get_nowait() for _ in range(queue.qsize())],
+            [sse_event("error", {"error": 1}), sse_event("error", {"error": 2})],
+        )
+
+
+class StopsPayloadTests(SimpleTestCase):
+    def test_each_encoding_has_its_own_etag(self):
+        payload = StopsPayload({"version": "v1", "stops": []})
+        factory = RequestFactory()
+
+        plain = payload.response(factory.get("/"))
+        gzipped = payload.response(factory.get("/", HTTP_ACCEPT_ENCODING="gzip"))
+        self.assertEqual(gzipped["Content-Encoding"], "gzip")
+        self.assertEqual(gzipped["ETag"], plain["ETag"][:-1] + '-gzip"')
+        self.assertIn("Accept-Encoding", gzipped["Vary"])
+
+        # a cached gzip body is not a valid copy of the identity one, and vice versa
+        self.assertEqual(payload.response(factory.get("/", HTTP_IF_NONE_MATCH=gzipped["ETag"])).status_code, 200)
+        repeat = payload.response(factory.get("/", HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=gzipped["ETag"]))
+        self.assertEqual(repeat.status_code, 304)
+        self.assertEqual(repeat["ETag"], gzipped["ETag"])
+        self.assertIn("Accept-Encoding", repeat["Vary"])
+
+
+    def test_q_values_are_honored(self):
+        available = ("br", "gzip")
+        self.assertEqual(negotiate_encoding("gzip, deflate, br", available), "br")
+        self.assertEqual(negotiate_encoding("br;q=0, gzip", available), "gzip")
+        self.assertEqual(negotiate_encoding("BR; Q=0 , GZIP", available), "gzip")
+        self.assertEqual(negotiate_encoding("br;q=0.5, gzip;q=0.8", available), "gzip")
+        self.assertEqual(negotiate_encoding("br;q=0.8, gzip;q=0.8", available), "br")
+        self.assertEqual(negotiate_encoding("*;q=0.1, br;q=0", available), "gzip")
+        self.assertEqual(negotiate_encoding("*", available), "br")
+        self.assertIsNone(negotiate_encoding("br;q=0, gzip;q=0", available))
+        self.assertIsNone(negotiate_encoding("gzip;q=oops, identity", available))
+        self.assertIsNone(negotiate_encoding("", available))
+        self.assertIsNone(negotiate_encoding("br", ("gzip",)))
+
+    def test_refused_encoding_gets_the_identity_body(self):
+        payload = StopsPayload({"version": "v1", "stops": []})
+        response = payload.response(RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip;q=0, identity"))
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response.content, payload.body)
+        self.assertEqual(response["ETag"], payload.etag)
+
+
+class StopIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        # around Rende/Cosenza, with a few stops OTP returns without coordinates
+        self.stops = [
+            {"id": f"1:S{n}", "lat": float(lat), "lon": float(lon)}
+            for n, (lat, lon) in enumerate(zip(rng.uniform(39.2, 39.45, 500), rng.uniform(16.1, 16.4, 500)))
+        ]
+        for stop in self.stops[::50]:
+            stop["lat"] = None
+        self.index = StopIndex(self.stops)
+        self.queries = [(39.33, 16.24), (39.2, 16.1), (39.5, 16.5), (38.9, 16.25), (41.9, 12.5)]
+        self.queries += [tuple(point) for point in rng.uniform((39.2, 16.1), (39.45, 16.4), (20, 2))]
+
+    def scan(self, lat, lon):
+        """(distance_m, stop) of every located stop, closest first, as a linear scan finds them."""
+        located = [stop for stop in self.stops if stop["lat"] is not None]
+        return sorted(((haversine(lon, lat, stop["lon"], stop["lat"]), stop) for stop in located),
+                      key=lambda pair: pair[0])
+
+    def assertSameStops(self, found, expected):
+        self.assertEqual([stop["id"] for _, stop in found], [stop["id"] for _, stop in expected])
+        for (found_distance, _), (expected_distance, _) in zip(found, expected):
+            self.assertAlmostEqual(found_distance, expected_distance, places=3)
+
+    def test_nearest_k_matches_linear_scan(self):
+        for lat, lon in self.queries:
+            scan = self.scan(lat, lon)
+            for k in (1, 5, 40, 1000):
+                self.assertSameStops(self.index.nearest_k(lat, lon, k), scan[:k])
+
+    def test_within_radius_matches_linear_scan(self):
+        for lat, lon in self.queries:
+            scan = self.scan(lat, lon)
+            for radius in (0, 300, 2500, 20000):
+                self.assertSameStops(
+                    self.index.within_radius(lat, lon, radius),
+                    [pair for pair in scan if pair[0] <= radius],
+                )
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_identical_calls_share_one_execution(self):
+        flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return {"data": "plan"}
+
+        def run():
+            return flight.do("plan", fetch)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [pool.submit(run) for _ in range(8)]
+            # let every follower find the leader's call in flight before it returns
+            deadline = time.monotonic() + 5
+            while flight.coalesced < 7 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.coalesced, 7)
+        self.assertEqual(sorted(shared for _, shared in results), [False] + [True] * 7)
+        self.assertTrue(all(result is results[0][0] for result, _ in results))
+
+    def test_followers_get_the_leaders_error_and_later_calls_run_again(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise OTPUnavailable("down")
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            futures = [pool.submit(flight.do, "plan", fail) for _ in range(3)]
+            deadline = time.monotonic() + 5
+            while flight.coalesced < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for future in futures:
+                self.assertRaises(OTPUnavailable, future.result)
+
+        self.assertEqual(flight.do("plan", lambda: "again"), ("again", False))
+
+    def test_follower_gives_up_at_its_timeout(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return "plan"
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            leader = pool.submit(flight.do, "plan", slow)
+            started.wait(5)
+            begin = time.monotonic()
+            with self.assertRaises(OTPUnavailable):
+                flight.do("plan", slow, timeout=0.05)
+            self.assertLess(time.monotonic() - begin, 1)
+            release.set()
+            # the leader's call is unaffected
+            self.assertEqual(leader.result(), ("plan", False))
+
+    def test_coalesced_otp_query_waits_until_the_callers_deadline(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_post(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return otp_response(200, b'{"data": {"plan": 1}}')
+
+        client = OTPClient("http://otp.invalid/graphql", 1, 10, 0, 0, 1, request_deadline=12)
+        client.session.post = mock.Mock(side_effect=slow_post)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            leader = pool.submit(client.query, "{ plan }")
+            started.wait(5)
+            with self.assertRaises(OTPUnavailable):
+                client.query("{ plan }", deadline=time.monotonic() + 0.05)
+            release.set()
+            self.assertEqual(leader.result(), {"plan": 1})
+        self.assertEqual(client.session.post.call_count, 1)
+
+
+def otp_response(status_code, body=b'{"data": {}}'):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response.raw = io.BytesIO(body)
+    return response
+
+
+class OTPClientDeadlineTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch(
+            "activity.otp_client.time", monotonic=lambda: self.now, perf_counter=time.perf_counter, sleep=self.sleep
+        )
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def make_client(self, post, max_retries=2, backoff=1, request_deadline=12):
+        client = OTPClient("http://otp.invalid/graphql", 3, 10, max_retries, backoff, 1, request_deadline=request_deadline)
+        client.session.post = mock.Mock(side_effect=post)
+        return client
+
+    def test_attempt_timeouts_are_capped_by_the_time_left(self):
+        client = self.make_client(lambda *args, **kwargs: otp_response(200))
+        client.query("{ a }", deadline=self.now + 2)
+        self.assertEqual(client.session.post.call_args.kwargs["timeout"], (2, 2))
+
+        client.query("{ b }")
+        self.assertEqual(client.session.post.call_args.kwargs["timeout"], (3, 10))
+
+    def test_status_retries_are_capped(self):
+        client = self.make_client(lambda *args, **kwargs: otp_response(503), request_deadline=60)
+        with self.assertRaises(OTPUnavailable):
+            client.query("{ a }")
+        self.assertEqual(client.session.post.call_count, 3)
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def test_retries_stop_before_the_deadline(self):
+        def refused(*args, **kwargs):
+            self.now += 0.5
+            raise requests.exceptions.ConnectTimeout("connect timed out")
+
+        client = self.make_client(refused, max_retries=5, request_deadline=3)
+        with self.assertRaises(OTPUnavailable):
+            client.query("{ a }")
+        # 0.5 s attempt, 1 s backoff, 0.5 s attempt: a 2 s backoff would end past the deadline
+        self.assertEqual(client.session.post.call_count, 2)
+        self.assertEqual(self.sleeps, [1])
+        timeouts = [call.kwargs["timeout"] for call in client.session.post.call_args_list]
+        self.assertEqual(timeouts, [(3, 3), (1.5, 1.5)])
+
+    def test_retry_recovers_within_the_deadline(self):
+        answers = [otp_response(502), otp_response(200, b'{"data": {"a": 1}}')]
+        client = self.make_client(lambda *args, **kwargs: answers.pop(0))
+        self.assertEqual(client.query("{ a }"), {"a": 1})
+        self.assertEqual(client.session.post.call_count, 2)
+
+    def test_errors_after_the_request_reached_otp_are_not_retried(self):
+        for error in (requests.exceptions.ReadTimeout("read timed out"), requests.exceptions.ConnectionError("reset")):
+            client = self.make_client(mock.Mock(side_effect=error))
+            with self.assertRaises(OTPUnavailable):
+                client.query("{ a }")
+            self.assertEqual(client.session.post.call_count, 1)
+
+    def test_expired_deadline_never_calls_otp(self):
+        client = self.make_client(lambda *args, **kwargs: otp_response(200))
+        with self.assertRaises(OTPUnavailable):
+            client.query("{ a }", deadline=self.now)
+        client.session.post.assert_not_called()
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch("activity.otp_client.time", monotonic=lambda: self.now, perf_counter=time.perf_counter)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, half_open_max_calls=1)
+
+    def failing_client(self):
+        client = OTPClient("http://otp.invalid/graphql", 1, 1, 0, 0, 1, breaker=self.breaker)
+        client.session.post = mock.Mock(side_effect=requests.ConnectionError("refused"))
+        return client
+
+    def run_async_queries(self, post, count):
+        """Run `count` AsyncOTPClient queries whose POST is `post`; cancel the ones still pending."""
+        async def run():
+            client = AsyncOTPClient("http://otp.invalid/graphql", 1, 1, 0, 1, breaker=self.breaker)
+            client.client.post = post
+            tasks = [asyncio.ensure_future(client.query("{ a }", name="a", coalesce=False)) for _ in range(count)]
+            await asyncio.sleep(0)
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            await client.aclose()
+            return results
+        return asyncio.run(run())
+
+    def test_cancelled_async_queries_are_not_failures(self):
+        async def hanging_post(*args, **kwargs):
+            await asyncio.Event().wait()
+
+        results = self.run_async_queries(hanging_post, 5)
+        self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results))
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        # a cancelled half-open trial gives its slot back to the next request
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 30
+        self.run_async_queries(hanging_post, 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.before_call()
+
+    def test_async_transport_errors_are_failures(self):
+        async def refused_post(*args, **kwargs):
+            raise httpx.ConnectError("refused")
+
+        results = self.run_async_queries(refused_post, 3)
+        self.assertTrue(all(isinstance(result, OTPUnavailable) for result in results))
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_closed_open_half_open_closed(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.before_call()
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpen, self.breaker.before_call)
+
+        # after the reset timeout one trial goes through; a failed trial reopens the circuit
+        self.now += 30
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.before_call()
+        self.assertRaises(CircuitOpen, self.breaker.before_call)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpen, self.breaker.before_call)
+
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.before_call()
+        self.breaker.before_call()
+
+    def test_open_circuit_fails_fast_without_calling_otp(self):
+        client = self.failing_client()
+        for _ in range(3):
+            self.assertRaises(OTPUnavailable, client.query, "{ a }", coalesce=False)
+        self.assertEqual(client.session.post.call_count, 3)
+
+        self.assertRaises(CircuitOpen, client.query, "{ a }", coalesce=False)
+        self.assertEqual(client.session.post.call_count, 3)
+
+    def test_open_circuit_answers_503(self):
+        client = self.failing_client()
+        for _ in range(3):
+            self.breaker.record_failure()
+        body = {"pairs": [{"fromLat": 39.31, "fromLon": 16.21, "toLat": 39.37, "toLon": 16.27}],
+                "date": "2026-10-19", "time": "08:00:00", "mode": "bus"}
+
+        with mock.patch("activity.views.get_otp_client", return_value=client), \
+                mock.patch("activity.views.stop_catalogue.get", return_value=mock.Mock()):
+            response = self.client.post(reverse("plan-trip-batch"), body, content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        result = response.json()["results"][0]
+        self.assertEqual(result["status"], 503)
+        self.assertIn("circuit open", result["error"])
+        client.session.post.assert_not_called()
+
+
+@override_settings(WORKER_WARMUP=True)
+class WarmUpTests(SimpleTestCase):
+    def test_first_request_of_each_process_starts_the_warm_up(self):
+        warm_up_on_first_request()
+        self.addCleanup(request_started.disconnect, dispatch_uid="activity.warmup")
+        with mock.patch("activity.warmup.threading.Thread") as thread, \
+                mock.patch("activity.warmup._started_pid", None), \
+                mock.patch("activity.warmup.os.getpid", return_value=101) as getpid:
+            request_started.send(sender=None)
+            request_started.send(sender=None)
+            self.assertEqual(thread.return_value.start.call_count, 1)
+
+            getpid.return_value = 102  # a forked worker
+            request_started.send(sender=None)
+            self.assertEqual(thread.return_value.start.call_count, 2)
+
+
+class CheckKnownTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        client = mock.patch("activity.stop_catalogue.get_otp_client")
+        client.start().return_value.query.side_effect = fake_otp_stops_query
+        self.addCleanup(client.stop)
+
+    def test_station_ids_pass_with_a_loaded_catalogue(self):
+        for path in (None, os.path.join(self.tmp, "stop_catalogue.bin")):
+            catalogue = StopCatalogue(fetch_stops, ttl=600, path=path)
+            with mock.patch("activity.boards.stop_catalogue", catalogue):
+                self.assertIsNone(catalogue.peek())
+                check_known("1:S1")  # nothing loaded yet: OTP decides
+
+                catalogue.get()
+                check_known("1:S1")
+                check_known("1:S2")
+                self.assertRaises(UnknownStop, check_known, "1:NOPE")
+                self.assertRaises(UnknownStop, check_known, "U3RvcDoxOlMx")
+
+
+# two stops 100 m apart, both inside one PLAN_CACHE_COORD_PRECISION cell, and a destination
+PLAN_STOPS = [
+    {"id": "1:A", "name": "Cosenza Piazza Fera", "lat": 39.3000, "lon": 16.2500, "code": None},
+    {"id": "1:B", "name": "Cosenza Via Roma", "lat": 39.3009, "lon": 16.2500, "code": None},
+    {"id": "1:C", "name": "Rende Unical", "lat": 39.3560, "lon": 16.2260, "code": None},
+]
+OTP_PLAN = {"plan": {"itineraries": [{
+    "walkDistance": 420.4,
+    "legs": [{
+        "mode": "WALK", "distance": 420.4, "startTime": 1792393200000, "endTime": 1792393500000,
+        "from": {"name": "Origin"}, "to": {"name": "Destination"},
+        "legGeometry": {"points": "_p~iF~ps|U_ulLnnqC_mqNvxq`@"},
+        "steps": [{"streetName": "Corso Mazzini", "distance": 420.4}],
+    }],
+}]}}
+
+
+@override_settings(SEARCH_LOG_WRITE_BEHIND=False)
+class PlanCacheTests(TestCase):
+    def setUp(self):
+        self.otp = mock.Mock()
+        self.otp.query.return_value = OTP_PLAN
+        self.cache = LRUCache(2, ttl=300)
+        for target, value in (
+            ("activity.views.get_otp_client", mock.Mock(return_value=self.otp)),
+            ("activity.views.stop_catalogue", StopCatalogue(lambda: PLAN_STOPS, ttl=600)),
+            ("activity.views.plan_cache", self.cache),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def plan(self, from_lat, to_lat=39.3560, **extra):
+        response = self.client.post(reverse("plan-trip"), {
+            "fromLat": from_lat, "fromLon": 16.2500, "toLat": to_lat, "toLon": 16.2260,
+            "date": "2026-10-19", "time": "08:00:00",
+            "requested_date": "2026-10-19", "requested_time": "08:00:00",
+            "mode": "walk", **extra,
+        }, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_cache_hit_reuses_options_but_not_stations(self):
+        first = self.plan(39.3001)
+        second = self.plan(39.30049)  # same rounded key, closer to the other stop
+
+        self.assertEqual(self.otp.query.call_count, 1)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(first["options"], second["options"])
+        self.assertEqual(first["fromStationName"], "Cosenza Piazza Fera")
+        self.assertEqual(second["fromStationName"], "Cosenza Via Roma")
+        self.assertEqual(second["toStationName"], "Rende Unical")
+
+    def test_evicted_plans_are_asked_again(self):
+        for to_lat in (39.35, 39.36, 39.37, 39.35):
+            self.plan(39.3001, to_lat=to_lat)
+        self.assertEqual(self.otp.query.call_count, 4)
+        self.assertEqual(self.cache.evictions, 2)
+        self.assertEqual(self.cache.hits, 0)
+
+        self.plan(39.3001, to_lat=39.35)
+        self.assertEqual(self.otp.query.call_count, 4)
+
+    def test_geometry_options_apply_to_cached_plans(self):
+        raw = self.plan(39.3001)
+        simplified = self.plan(39.3001, geometry_tolerance=500000, geometry_precision=6)
+
+        self.assertEqual(self.otp.query.call_count, 1)
+        leg, = raw["options"]["walk"][0]["legs"]
+        self.assertEqual(leg["geometry"], "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        leg, = simplified["options"]["walk"][0]["legs"]
+        self.assertEqual(leg["geometry"], polyline.encode([(38.5, -120.2), (43.252, -126.453)], 6))
+
+    def test_cache_hit_still_records_the_search(self):
+        self.plan(39.3001)
+        self.plan(39.30049)
+
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(
+            sorted(Search.objects.values_list("from_lat", flat=True)), [39.3001, 39.30049]
+        )
+
+
+class PolylineTests(SimpleTestCase):
+    # Google's reference example
+    ENCODED = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    POINTS = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+    def test_decode_and_encode_round_trip(self):
+        np.testing.assert_allclose(polyline.decode(self.ENCODED), self.POINTS)
+        self.assertEqual(polyline.encode(self.POINTS), self.ENCODED)
+        self.assertEqual(polyline.encode(polyline.decode(self.ENCODED)), self.ENCODED)
+
+        precise = polyline.encode(self.POINTS, precision=6)
+        np.testing.assert_allclose(polyline.decode(precise, precision=6), self.POINTS)
+        self.assertEqual(polyline.simplify(self.ENCODED, precision=6), precise)
+
+        self.assertEqual(polyline.encode([]), "")
+        self.assertEqual(polyline.decode("").shape, (0, 2))
+        self.assertEqual(polyline.simplify(""), "")
+
+    def test_douglas_peucker_keeps_endpoints_and_drops_collinear_points(self):
+        straight = [(39.30, 16.25), (39.31, 16.25), (39.32, 16.25), (39.33, 16.25)]
+        self.assertEqual(polyline.douglas_peucker(straight, 1).tolist(), [True, False, False, True])
+
+        # the middle point lies about 860 m east of the line between its neighbours
+        detour = [(39.30, 16.25), (39.31, 16.26), (39.32, 16.25)]
+        self.assertEqual(polyline.douglas_peucker(detour, 500).tolist(), [True, True, True])
+        self.assertEqual(polyline.douglas_peucker(detour, 1000).tolist(), [True, False, True])
+        self.assertEqual(polyline.douglas_peucker(detour, 0).tolist(), [True, True, True])
+
+        self.assertEqual(polyline.simplify(polyline.encode(straight), 1), polyline.encode([straight[0], straight[-1]]))
+
+    def test_geometry_serializer_fields(self):
+        base = {
+            "fromLat": 39.3, "fromLon": 16.25, "toLat": 39.35, "toLon": 16.22,
+            "date": "2026-10-19", "time": "08:00:00",
+            "requested_date": "2026-10-19", "requested_time": "08:00:00", "mode": "bus",
+        }
+        serializer = PlanTripSerializer(data={**base, "geometry_tolerance": "12.5", "geometry_precision": "6"})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertEqual(serializer.validated_data["geometry_tolerance"], 12.5)
+        self.assertEqual(serializer.validated_data["geometry_precision"], 6)
+
+        serializer = PlanTripSerializer(data=base)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertNotIn("geometry_tolerance", serializer.validated_data)
+        self.assertNotIn("geometry_precision", serializer.validated_data)
+
+        for field, value in (("geometry_tolerance", -1), ("geometry_precision", 0), ("geometry_precision", 8)):
+            serializer = PlanTripSerializer(data={**base, field: value})
+            self.assertFalse(serializer.is_valid())
+            self.assertIn(field, serializer.errors)
+
+
+class DistanceTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        lats = list(rng.uniform(39.2, 39.45, 40))
+        lons = list(rng.uniform(16.1, 16.4, 40))
+        # exact duplicates of points 0 and 5 for ties, and points either side of the antimeridian
+        lats += [lats[5], lats[0], -16.5, -16.5, -16.6]
+        lons += [lons[5], lons[0], 179.99, -179.99, 179.5]
+        self.lats, self.lons = np.array(lats), np.array(lons)
+        self.queries = [(39.33, 16.24), (self.lats[5], self.lons[5]), (self.lats[0], self.lons[0]),
+                        (-16.5, 180.0), (-16.5, -179.999), (0.0, 0.0)]
+
+    def scan(self, lat, lon):
+        """(distance, index) of every point, closest first, ties by index."""
+        return sorted((haversine(lon, lat, p_lon, p_lat), i) for i, (p_lat, p_lon) in enumerate(zip(self.lats, self.lons)))
+
+    def assertMatchesScan(self, indices, distances, expected):
+        self.assertEqual(indices.tolist(), [i for _, i in expected])
+        np.testing.assert_allclose(distances, [d for d, _ in expected], rtol=1e-9, atol=1e-6)
+
+    def test_haversine_to_many_and_matrix(self):
+        for lat, lon in self.queries:
+            expected = [haversine(lon, lat, p_lon, p_lat) for p_lat, p_lon in zip(self.lats, self.lons)]
+            np.testing.assert_allclose(distance.haversine_to_many(lat, lon, self.lats, self.lons), expected, atol=1e-6)
+        matrix = distance.haversine_matrix([q[0] for q in self.queries], [q[1] for q in self.queries], self.lats, self.lons)
+        self.assertEqual(matrix.shape, (len(self.queries), len(self.lats)))
+        for row, (lat, lon) in zip(matrix, self.queries):
+            np.testing.assert_allclose(row, distance.haversine_to_many(lat, lon, self.lats, self.lons))
+
+        # a few hundred meters across the antimeridian, not half the planet
+        self.assertLess(distance.haversine_to_many(-16.5, 179.99, [-16.5], [-179.99])[0], 2200)
+
+    def test_nearest(self):
+        query_lats, query_lons = zip(*self.queries)
+        with mock.patch("activity.distance.CHUNK_ROWS", 4):  # several blocks
+            indices, distances = distance.nearest(query_lats, query_lons, self.lats, self.lons)
+        for index, dist, (lat, lon) in zip(indices, distances, self.queries):
+            self.assertMatchesScan(np.array([index]), np.array([dist]), self.scan(lat, lon)[:1])
+        self.assertEqual(indices[1], 5)  # tie with the duplicate at 40 goes to the lower index
+        self.assertEqual(indices[2], 0)
+
+        indices, distances = distance.nearest([39.3], [16.2], [], [])
+        self.assertEqual(indices.tolist(), [-1])
+        self.assertEqual(distances.tolist(), [np.inf])
+        self.assertEqual(distance.nearest([], [], self.lats, self.lons)[0].size, 0)
+
+    def test_top_k(self):
+        for lat, lon in self.queries:
+            for k in (1, 2, 7, len(self.lats), len(self.lats) + 10):
+                self.assertMatchesScan(*distance.top_k(lat, lon, self.lats, self.lons, k), self.scan(lat, lon)[:k])
+        indices, distances = distance.top_k(self.lats[5], self.lons[5], self.lats, self.lons, 2)
+        self.assertEqual(indices.tolist(), [5, 40])
+        self.assertEqual(distance.top_k(39.3, 16.2, [], [], 3)[0].size, 0)
+        self.assertEqual(distance.top_k(39.3, 16.2, self.lats, self.lons, 0)[0].size, 0)
+
+    def test_within_radius(self):
+        for lat, lon in self.queries:
+            for radius in (0, 1000, 5000, 20000, 3000000):
+                expected = [pair for pair in self.scan(lat, lon) if pair[0] <= radius]
+                self.assertMatchesScan(*distance.within_radius(lat, lon, self.lats, self.lons, radius), expected)
+        self.assertEqual(distance.within_radius(39.3, 16.2, [], [], 1000)[0].size, 0)
+        indices, _ = distance.within_radius(-16.5, 180.0, self.lats, self.lons, 2000)
+        self.assertEqual(sorted(indices.tolist()), [42, 43])
+
+
+def grid_stops(prefix="G", size=5):
+    """size x size stops 0.01 degrees apart around Cosenza, in row order."""
+    return [
+        {"id": f"1:{prefix}{row}{col}", "name": f"Stop {row}/{col}",
+         "lat": 39.30 + row * 0.01, "lon": 16.20 + col * 0.01, "code": None}
+        for row in range(size) for col in range(size)
+    ]
+
+
+class StopQueryTests(SimpleTestCase):
+    def setUp(self):
+        self.use_stops(grid_stops())
+        settings_override = override_settings(GTFS_STORE_PATH=os.path.join(tempfile.gettempdir(), "no-feed.npz"))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def use_stops(self, stops):
+        patcher = mock.patch("activity.views.stop_catalogue", StopCatalogue(lambda: stops, ttl=600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        return self.client.get(reverse("stops-list"), params)
+
+    def pages(self, **params):
+        stops, cursor = [], None
+        while True:
+            response = self.get(**params, **({"cursor": cursor} if cursor else {}))
+            self.assertEqual(response.status_code, 200, response.content)
+            page = response.json()
+            self.assertLessEqual(len(page["stops"]), params["limit"])
+            stops += page["stops"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return stops, page["count"]
+
+    def test_bbox_pages_in_catalogue_order(self):
+        # rows 1-3, columns 1-3 of the grid
+        stops, count = self.pages(bbox="16.205,39.305,16.235,39.335", limit=4)
+        self.assertEqual(count, 9)
+        self.assertEqual([stop["id"] for stop in stops], [f"1:G{row}{col}" for row in (1, 2, 3) for col in (1, 2, 3)])
+
+    def test_radius_pages_closest_first(self):
+        center = {"lat": 39.32, "lon": 16.22}
+        stops, count = self.pages(**center, radius=1500, limit=2)
+        self.assertEqual(count, 9)  # the centre, its 4 neighbours at ~1.1 km and 4 diagonals at ~1.4 km
+        self.assertEqual(stops[0]["id"], "1:G22")
+        distances = [stop["distance_m"] for stop in stops]
+        self.assertEqual(distances, sorted(distances))
+        for stop in stops:
+            self.assertAlmostEqual(stop["distance_m"], haversine(16.22, 39.32, stop["lon"], stop["lat"]), delta=0.1)
+
+    def test_cursor_of_another_catalogue_version_is_rejected(self):
+        cursor = self.get(bbox="16.19,39.29,16.25,39.35", limit=5).json()["next_cursor"]
+        self.assertIsNotNone(cursor)
+        self.use_stops(grid_stops(prefix="H"))
+
+        response = self.get(bbox="16.19,39.29,16.25,39.35", limit=5, cursor=cursor)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "The stop list changed, start again without a cursor.")
+        response = self.get(bbox="16.19,39.29,16.25,39.35", limit=5, cursor="not-a-cursor")
+        self.assertEqual(response.json()["error"], "Invalid cursor.")
+
+    def test_invalid_queries(self):
+        for params in (
+            {"bbox": "16.2,39.3,16.3"},
+            {"bbox": "16.3,39.3,16.2,39.4"},  # minLon > maxLon
+            {"bbox": "16.2,39.4,16.3,39.3"},  # minLat > maxLat
+            {"bbox": "16.2,39.3,16.3,39.4", "lat": 39.3, "lon": 16.2, "radius": 100},
+            {"lat": 39.3, "lon": 16.2},
+            {"lat": 39.3, "lon": 16.2, "radius": settings.STOPS_MAX_RADIUS + 1},
+            {"lat": 39.3, "lon": 16.2, "radius": -1},
+            {"bbox": "16.2,39.3,16.3,39.4", "limit": settings.STOPS_PAGE_MAX + 1},
+            {"bbox": "16.2,39.3,16.3,39.4", "limit": 0},
+        ):
+            with self.subTest(**params):
+                self.assertEqual(self.get(**params).status_code, 400)
+
+        self.assertEqual(self.get(lat=39.3, lon=16.2, radius=settings.STOPS_MAX_RADIUS).status_code, 200)
+
+
+class CatalogueFileTests(SimpleTestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.path = os.path.join(self.data_dir, "cache", "stop_catalogue.bin")
+
+    def test_write_and_map(self):
+        # as STOPS_QUERY returns them: the GTFS id aliased to `id`
+        stops = [
+            {"id": stop["gtfsId"], "name": stop["name"], "lat": stop["lat"], "lon": stop["lon"], "code": stop["code"]}
+            for stop in OTP_STOPS
+        ]
+        stops.append({"id": "1:X", "name": "Senza coordinate", "lat": None, "lon": None, "code": None})
+        write_catalogue(self.path, stops, "v1")
+
+        mapped = MappedCatalogue(self.path)
+        self.assertEqual(mapped.version, "v1")
+        self.assertEqual(list(mapped), stops)
+        self.assertEqual(mapped[-1], stops[-1])
+        self.assertEqual(mapped.ids(), [stop["id"] for stop in stops])
+        np.testing.assert_array_equal(mapped.lats[:2], [39.2990, 39.3560])
+        self.assertEqual(mapped.identity, file_identity(self.path))
+
+    def test_workers_share_and_swap_published_catalogues(self):
+        published = {"stops": grid_stops(size=2)}
+        first = StopCatalogue(lambda: published["stops"], ttl=0, path=self.path, check_interval=0)
+        second_fetch = mock.Mock(side_effect=AssertionError("the second worker maps the file"))
+        second = StopCatalogue(second_fetch, ttl=600, path=self.path, check_interval=0)
+
+        # the first worker fetches and publishes, the second one maps what was published
+        snapshot = first.get()
+        self.assertIsInstance(snapshot.stops, MappedCatalogue)
+        self.assertEqual(second.get().version, snapshot.version)
+        self.assertEqual(sorted(second.get().by_id), sorted(stop["id"] for stop in published["stops"]))
+
+        # the first worker refreshes (ttl=0) and republishes; the second swaps the new file in
+        published["stops"] = grid_stops(prefix="H", size=3)
+        first.get()
+        self.assertTrue(wait_until(lambda: first.peek().version != snapshot.version))
+        self.assertTrue(wait_until(lambda: second.get().version == first.peek().version))
+        self.assertIn("1:H22", second.get().by_id)
+        self.assertEqual(len(second.get().stops), 9)
+        second_fetch.assert_not_called()
+
+
+class StopTileTests(SimpleTestCase):
+    def setUp(self):
+        self.catalogue = StopSnapshot(grid_stops(), time.monotonic())
+        cache_patch = mock.patch("activity.stop_tiles.tile_cache", LRUCache(8))
+        self.tile_cache = cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+    def assertBounds(self, bounds, expected):
+        for value, expected_value in zip(bounds, expected):
+            self.assertAlmostEqual(value, expected_value, places=6)
+
+    def test_tile_bounds(self):
+        self.assertBounds(tile_bounds(0, 0, 0), (-85.051129, -180, 85.051129, 180))
+        self.assertBounds(tile_bounds(1, 1, 1), (-85.051129, 0, 0, 180))
+        # the tile holding Cosenza at zoom 10
+        self.assertBounds(tile_bounds(10, 558, 390), (39.095963, 16.171875, 39.368279, 16.523438))
+
+    def test_tile_coordinates_invert_tile_bounds(self):
+        min_lat, min_lon, max_lat, max_lon = tile_bounds(10, 558, 390)
+        xs, ys = tile_coordinates(np.array([max_lat, min_lat]), np.array([min_lon, max_lon]), 10)
+        np.testing.assert_allclose(xs, [558, 559])
+        np.testing.assert_allclose(ys, [390, 391])
+
+    def test_invalid_tiles(self):
+        with self.assertRaises(InvalidTile):
+            tile_payload(self.catalogue, 23, 0, 0)
+        with self.assertRaises(InvalidTile):
+            tile_payload(self.catalogue, 1, 2, 0)
+
+    @override_settings(STOPS_TILE_CLUSTER_MAX_ZOOM=15, STOPS_TILE_GRID=1)
+    def test_one_cell_clusters_the_whole_tile(self):
+        clusters, stops = build_tile(self.catalogue.index, 10, 558, 390)
+        self.assertEqual(stops, [])
+        self.assertEqual(clusters, [{"lat": 39.32, "lon": 16.22, "count": 25}])
+
+    @override_settings(STOPS_TILE_CLUSTER_MAX_ZOOM=15, STOPS_TILE_GRID=64)
+    def test_grid_cells_cluster_their_stops(self):
+        clusters, stops = build_tile(self.catalogue.index, 10, 558, 390)
+        # cells are ~0.0055 degrees wide: stops 0.01 apart never share one, so nothing clusters
+        self.assertEqual(clusters, [])
+        self.assertEqual(len(stops), 25)
+
+        with override_settings(STOPS_TILE_GRID=16):
+            clusters, stops = build_tile(self.catalogue.index, 10, 558, 390)
+        self.assertTrue(clusters)
+        self.assertEqual(sum(cluster["count"] for cluster in clusters) + len(stops), 25)
+        self.assertTrue(all(cluster["count"] > 1 for cluster in clusters))
+
+    @override_settings(STOPS_TILE_CLUSTER_MAX_ZOOM=9)
+    def test_every_stop_above_the_cluster_zoom(self):
+        clusters, stops = build_tile(self.catalogue.index, 10, 558, 390)
+        self.assertEqual(clusters, [])
+        self.assertEqual([stop["id"] for stop in stops], [stop["id"] for stop in grid_stops()])
+
+    @override_settings(STOPS_TILE_CLUSTER_MAX_ZOOM=0)
+    def test_a_stop_on_a_shared_edge_belongs_to_one_tile(self):
+        edge = {"id": "1:E", "name": "Greenwich", "lat": 10.0, "lon": 0.0, "code": None}
+        index = StopIndex([edge])
+        self.assertEqual(build_tile(index, 1, 0, 0), ([], []))
+        self.assertEqual(build_tile(index, 1, 1, 0), ([], [edge]))
+
+    def test_tiles_are_cached_per_catalogue_version(self):
+        with mock.patch("activity.stop_tiles.build_tile", wraps=build_tile) as build:
+            first = tile_payload(self.catalogue, 10, 558, 390)
+            self.assertIs(tile_payload(self.catalogue, 10, 558, 390), first)
+            self.assertEqual(build.call_count, 1)
+
+            stale = tile_payload(self.catalogue, 10, 558, 390, stale=True)
+            self.assertIsNot(stale, first)
+            self.assertEqual(build.call_count, 2)
+
+            refreshed = StopSnapshot(grid_stops(prefix="H"), time.monotonic())
+            self.assertIsNot(tile_payload(refreshed, 10, 558, 390), first)
+            self.assertEqual(build.call_count, 3)
+        self.assertEqual(self.tile_cache.stats()["size"], 3)
+
+
+class PlanQueryTests(SimpleTestCase):
+    def plan_request(self, mode):
+        return PlanRequest({
+            "fromLat": 39.2990, "fromLon": 16.2530, "toLat": 39.3560, "toLon": 16.2260,
+            "date": date(2024, 5, 6), "time": "08:00:00",
+            "requested_date": date(2024, 5, 6), "requested_time": "07:55:00",
+            "mode": mode,
+        })
+
+    def test_query_declares_and_passes_transport_modes(self):
+        self.assertIn("$transportModes: [TransportMode]", PLAN_QUERY_WITH_MODES)
+        self.assertIn("transportModes: $transportModes", PLAN_QUERY_WITH_MODES)
+        self.assertNotIn("transportModes", PLAN_QUERY)
+        self.assertEqual(build_plan_query(with_transport_modes=True), PLAN_QUERY_WITH_MODES)
+
+    def test_walk(self):
+        request = self.plan_request("walk")
+        self.assertIs(request.query(), PLAN_QUERY_WITH_MODES)
+        self.assertEqual(request.variables()["transportModes"], [{"mode": "WALK"}])
+
+    def test_bus(self):
+        request = self.plan_request("BUS")
+        self.assertIs(request.query(), PLAN_QUERY_WITH_MODES)
+        self.assertEqual(request.variables()["transportModes"], [{"mode": "BUS"}, {"mode": "WALK"}])
+
+    def test_bicycle(self):
+        request = self.plan_request("Bicycle")
+        self.assertIs(request.query(), PLAN_QUERY_WITH_MODES)
+        self.assertEqual(request.variables()["transportModes"], [{"mode": "BICYCLE"}])
+
+    def test_scooter_is_rented(self):
+        request = self.plan_request(" scooter ")
+        self.assertIs(request.query(), PLAN_QUERY_WITH_MODES)
+        self.assertEqual(
+            request.variables()["transportModes"],
+            [{"mode": "SCOOTER", "qualifier": "RENT"}, {"mode": "WALK"}],
+        )
+
+    def test_all_keeps_otp_defaults(self):
+        request = self.plan_request("ALL")
+        self.assertIs(request.query(), PLAN_QUERY)
+        self.assertNotIn("transportModes", request.variables())
+
+    def test_every_mode_has_a_test(self):
+        self.assertEqual(set(TRANSPORT_MODES), {"WALK", "BUS", "BICYCLE", "SCOOTER"})
+
+    def test_trip_variables(self):
+        variables = self.plan_request("BUS").variables()
+        self.assertEqual(
+            {key: value for key, value in variables.items() if key != "transportModes"},
+            {"fromLat": 39.2990, "fromLon": 16.2530, "toLat": 39.3560, "toLon": 16.2260,
+             "date": "2024-05-06", "time": "08:00:00"},
+        )
+
+
+@override_settings(SEARCH_LOG_WRITE_BEHIND=False)
+class ItineraryDetailTests(TestCase):
+    def setUp(self):
+        self.otp = mock.Mock()
+        self.otp.query.return_value = OTP_PLAN
+        self.clock = mock.Mock()
+        self.clock.monotonic.return_value = 1000.0
+        self.store = LRUCache(8, ttl=60)
+        for target, value in (
+            ("activity.views.get_otp_client", mock.Mock(return_value=self.otp)),
+            ("activity.views.stop_catalogue", StopCatalogue(lambda: PLAN_STOPS, ttl=600)),
+            ("activity.views.plan_cache", LRUCache(8, ttl=300)),
+            ("activity.planning.itinerary_store", self.store),
+            ("activity.views.itinerary_store", self.store),
+            ("activity.cache.time", self.clock),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def plan(self, **extra):
+        response = self.client.post(reverse("plan-trip"), {
+            "fromLat": 39.3001, "fromLon": 16.2500, "toLat": 39.3560, "toLon": 16.2260,
+            "date": "2026-10-19", "time": "08:00:00",
+            "requested_date": "2026-10-19", "requested_time": "08:00:00",
+            "mode": "walk", **extra,
+        }, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def detail(self, itinerary_id):
+        return self.client.get(reverse("plan-trip-itinerary", args=[itinerary_id]))
+
+    def test_summary_leaves_out_geometry_and_steps(self):
+        full = self.plan()
+        summary = self.plan(summary=True)
+
+        option, = summary["options"]["walk"]
+        full_option, = full["options"]["walk"]
+        leg, = option["legs"]
+        full_leg, = full_option["legs"]
+        self.assertNotIn("geometry", leg)
+        self.assertNotIn("walk_steps", leg)
+        self.assertEqual(leg, {key: value for key, value in full_leg.items() if key not in ("geometry", "walk_steps")})
+        self.assertEqual(summary["fromStationName"], full["fromStationName"])
+        self.assertIn("itinerary_id", option)
+        self.assertNotIn("itinerary_id", full_option)
+
+    def test_summarize_plan_keeps_the_details_by_itinerary_id(self):
+        full = self.plan()
+        summary = summarize_plan(full)
+        option_id = summary["options"]["walk"][0]["itinerary_id"]
+        full_leg, = full["options"]["walk"][0]["legs"]
+
+        self.assertEqual(self.store.get(option_id), {
+            "itinerary_id": option_id,
+            "legs": [{
+                "type": full_leg["type"], "from": full_leg["from"], "to": full_leg["to"],
+                "geometry": full_leg["geometry"], "walk_steps": full_leg["walk_steps"],
+            }],
+        })
+        # content-derived: the same itinerary keeps its id
+        self.assertEqual(summarize_plan(full)["options"]["walk"][0]["itinerary_id"], option_id)
+
+    def test_detail_of_a_summarized_itinerary(self):
+        full = self.plan()
+        option_id = self.plan(summary=True)["options"]["walk"][0]["itinerary_id"]
+
+        response = self.detail(option_id)
+        self.assertEqual(response.status_code, 200)
+        leg, = response.json()["legs"]
+        full_leg, = full["options"]["walk"][0]["legs"]
+        self.assertEqual(leg["geometry"], full_leg["geometry"])
+        self.assertEqual(leg["walk_steps"], full_leg["walk_steps"])
+
+    def test_expired_itinerary(self):
+        option_id = self.plan(summary=True)["options"]["walk"][0]["itinerary_id"]
+        self.clock.monotonic.return_value += 61
+
+        response = self.detail(option_id)
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("error", response.json())
+
+    def test_unknown_itinerary(self):
+        self.plan(summary=True)
+        response = self.detail("0" * 20)
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("error", response.json())
+
+
+class StopCatalogueRefreshTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = mock.Mock()
+        self.clock.monotonic.return_value = 1000.0
+        client = mock.patch("activity.stop_catalogue.get_otp_client")
+        self.otp = client.start().return_value
+        self.otp.query.side_effect = fake_otp_stops_query
+        self.addCleanup(client.stop)
+        clock = mock.patch("activity.stop_catalogue.time", self.clock)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.catalogue = StopCatalogue(fetch_stops, ttl=600, retry_interval=30)
+
+    def advance(self, seconds):
+        self.clock.monotonic.return_value += seconds
+
+    def test_first_get_loads_and_later_ones_reuse_the_snapshot(self):
+        snapshot = self.catalogue.get()
+        self.assertEqual(sorted(snapshot.by_id), ["1:S1", "1:S2"])
+        self.advance(599)
+        self.assertIs(self.catalogue.get(), snapshot)
+        self.assertEqual(self.otp.query.call_count, 1)
+
+    def test_expired_snapshot_is_served_while_one_background_refresh_runs(self):
+        snapshot = self.catalogue.get()
+        release = threading.Event()
+
+        def slow_query(query, *args, **kwargs):
+            release.wait(5)
+            return {"stops": [{"id": "1:S3", "name": "Nuova", "lat": 39.31, "lon": 16.24, "code": None}]}
+
+        self.otp.query.side_effect = slow_query
+        self.advance(600)
+        try:
+            for _ in range(3):
+                self.assertIs(self.catalogue.get(), snapshot)
+            self.assertTrue(wait_until(lambda: self.otp.query.call_count == 2))
+        finally:
+            release.set()
+
+        self.assertTrue(wait_until(lambda: self.catalogue.peek() is not snapshot))
+        self.assertEqual(self.otp.query.call_count, 2)
+        self.assertEqual(list(self.catalogue.get().by_id), ["1:S3"])
+        self.assertFalse(self.catalogue.stale)
+
+    def test_failed_refresh_keeps_the_snapshot_and_flags_it_stale(self):
+        snapshot = self.catalogue.get()
+        self.otp.query.side_effect = OTPUnavailable("OTP is down")
+        self.advance(600)
+        with self.assertLogs("activity.stop_catalogue", "WARNING"):
+            self.assertIs(self.catalogue.get(), snapshot)
+            self.assertTrue(wait_until(lambda: self.catalogue.stale))
+        self.assertIs(self.catalogue.get(), snapshot)
+
+        # no new attempt before retry_interval
+        self.advance(29)
+        self.catalogue.get()
+        time.sleep(0.05)
+        self.assertEqual(self.otp.query.call_count, 2)
+
+        self.otp.query.side_effect = fake_otp_stops_query
+        self.advance(1)
+        self.assertIs(self.catalogue.get(), snapshot)
+        self.assertTrue(wait_until(lambda: not self.catalogue.stale))
+        self.assertIsNot(self.catalogue.get(), snapshot)
+        self.assertEqual(self.otp.query.call_count, 3)
+
+
+@override_settings(GTFS_STORE_PATH=os.path.join(tempfile.gettempdir(), "no-feed.npz"))
+class AsyncViewsOffLoopTests(SimpleTestCase):
+    """File loading and payload rendering of the async views run in threads, not on the event loop."""
+
+    def setUp(self):
+        self.threads = {}
+        self.catalogue = StopCatalogue(grid_stops, ttl=600)
+        for target in (
+            "activity.async_views.get_gtfs_store",
+            "activity.async_views.stops_payload",
+            "activity.async_views.tile_payload",
+            "activity.boards.local_board",
+            "activity.boards.fallback_board",
+        ):
+            self.record(target)
+        patcher = mock.patch("activity.async_views.stop_catalogue", self.catalogue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, target):
+        module_name, name = target.rsplit(".", 1)
+        original = getattr(__import__(module_name, fromlist=[name]), name)
+
+        def recorded(*args, **kwargs):
+            self.threads[name] = threading.current_thread()
+            return original(*args, **kwargs)
+
+        patcher = mock.patch(target, recorded)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertOffLoop(self, *names):
+        loop_thread = threading.current_thread()
+        for name in names:
+            self.assertIn(name, self.threads)
+            self.assertIsNot(self.threads[name], loop_thread, name)
+
+    async def test_stops(self):
+        response = await self.async_client.get(reverse("stops-list-async"), headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertOffLoop("get_gtfs_store", "stops_payload")
+
+    async def test_stop_tile(self):
+        response = await self.async_client.get(reverse("stops-tile-async", args=[10, 558, 390]))
+        self.assertEqual(response.status_code, 200)
+        self.assertOffLoop("get_gtfs_store", "tile_payload")
+
+        response = await self.async_client.get(reverse("stops-tile-async", args=[23, 0, 0]))
+        self.assertEqual(response.status_code, 400)
+
+    async def test_stop_schedule(self):
+        with mock.patch("activity.boards.get_async_otp_client") as client:
+            client.return_value.query = mock.AsyncMock(side_effect=OTPUnavailable("OTP is down"))
+            response = await self.async_client.get(reverse("stop_schedule_async", args=["1:OFFLOOP"]))
+        self.assertEqual(response.status_code, 503)
+        self.assertOffLoop("local_board", "fallback_board")
+
+    async def test_catalogue_file_checks_run_in_a_thread(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        catalogue = StopCatalogue(grid_stops, ttl=600, path=os.path.join(tmp, "stop_catalogue.bin"), check_interval=0)
+        first = await catalogue.aget()
+        swap = catalogue._swap_in_published
+
+        def recorded_swap(snapshot):
+            self.threads["swap"] = threading.current_thread()
+            return swap(snapshot)
+
+        with mock.patch.object(catalogue, "_swap_in_published", recorded_swap):
+            self.assertIs(await catalogue.aget(), first)
+        self.assertOffLoop("swap")
@@ -1,11 +1,14 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 from .views import (
     FeedbackView,
     FavoritePlaceListCreateView,
     FavoritePlaceDetailView,
+    ItineraryDetailView,
     PlanTripView,
+    PlanTripBatchView,
     StopsView,
+    StopTileView,
     get_stop_schedule,
     
 )
@@ -19,6 +22,17 @@ urlpatterns = [
     path('auth/booking/', views.BookingListCreateView.as_view(), name='booking-api'),
     path('auth/feedback/', FeedbackView.as_view(), name='submit-feedback'),
     path('auth/plan-trip/', PlanTripView.as_view(), name='plan-trip'),
+    path('auth/plan-trip/batch/', PlanTripBatchView.as_view(), name='plan-trip-batch'),
+    path('auth/plan-trip/itinerary/<str:itinerary_id>/', ItineraryDetailView.as_view(), name='plan-trip-itinerary'),
     path('auth/stops/', StopsView.as_view(), name='stops-list'),
+    path('auth/stops/tiles/<int:z>/<int:x>/<int:y>/', StopTileView.as_view(), name='stops-tile'),
     path("auth/station/<str:stop_id>/", get_stop_schedule, name="stop_schedule"),
+    path("auth/station/<str:stop_id>/departures/", views.get_stop_departures, name="stop_departures"),
+    # async (ASGI-native) variants of the OTP-bound endpoints
+    path('auth/async/plan-trip/', async_views.plan_trip, name='plan-trip-async'),
+    path('auth/async/stops/', async_views.stops, name='stops-list-async'),
+    path('auth/async/stops/tiles/<int:z>/<int:x>/<int:y>/', async_views.stop_tile, name='stops-tile-async'),
+    path("auth/async/station/<str:stop_id>/", async_views.stop_schedule, name="stop_schedule_async"),
+    path("auth/async/station/<str:stop_id>/departures/", async_views.stop_departures, name="stop_departures_async"),
+    path("auth/async/station/<str:stop_id>/stream/", async_views.stop_board_stream, name="stop_board_stream"),
 ]
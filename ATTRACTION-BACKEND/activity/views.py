@@ -1,10 +1,12 @@
+from django.conf import settings
+from datetime import datetime
+from django.http import HttpResponseNotAllowed, HttpResponseNotModified, JsonResponse
 from django.shortcuts import render
-from django.utils import timezone
+from django.utils.http import parse_etags
 from django.contrib.auth.signals import user_logged_in
 from django.dispatch import receiver
-from datetime import datetime, timedelta
-from math import radians, cos, sin, asin, sqrt
-import requests
+from concurrent.futures import FIRST_COMPLETED, TimeoutError as FuturesTimeout, wait
+import time
 
 from rest_framework import generics, status, permissions
 from rest_framework.permissions import AllowAny, IsAuthenticated
@@ -20,21 +22,30 @@ from .serializers import (
     BookingSerializer,
     FeedbackSerializer,
     PlanTripSerializer,
+    PlanTripBatchSerializer,
+    StopQuerySerializer,
 )
-
-# ------------------------------
-#helpers
-# ------------------------------
-def haversine(lon1, lat1, lon2, lat2):
-    # Convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * asin(sqrt(a))
-    r = 6371000  # Radius of Earth in meters
-    return c * r
+from .boards import BoardUnavailable, UnknownStop, board_etag, get_board
+from .gtfs import get_gtfs_store
+from .otp_client import get_batch_executor, get_otp_client, get_otp_executor, OTPQueryError, OTPUnavailable
+from .planning import (
+    PlanRequest,
+    PlanRequestError,
+    closest_stations,
+    itinerary_store,
+    plan_cache,
+    plan_response,
+    shape_options,
+    shape_plan,
+    simplify_plan_geometry,
+    summarize_plan,
+)
+from .polyline import OTP_PRECISION
+from .search_log import flush_searches, log_search
+from .stations import InvalidCursor, query_stops
+from .stop_catalogue import stop_catalogue
+from .stop_tiles import InvalidTile, tile_payload
+from .stops_payload import stops_payload
 
 # ------------------------------
 # Authentication Mixin
@@ -326,303 +337,185 @@ class PlanTripView(APIView):
         if not serializer.is_valid():
             return Response({"success": False, "error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
-        data = serializer.validated_data
-        mode_filter = data.get('mode')
-        if not mode_filter:
-            return Response({"error": "Mode is required and cannot be empty."}, status=status.HTTP_400_BAD_REQUEST)
-        mode_filter = mode_filter.strip().upper()
+        try:
+            plan_request = PlanRequest(serializer.validated_data)
+        except PlanRequestError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # -------- Plan cache ----------
+        cache_key = plan_request.cache_key()
+        options = plan_cache.get(cache_key)
+        if options is None:
+            response_data, error_response = self.build_plan(plan_request)
+            if error_response is not None:
+                return error_response
+            plan_cache.set(cache_key, response_data["options"])
+        else:
+            # the options fit every nearby request, the closest stations only this one
+            try:
+                from_stop, to_stop = closest_stations(stop_catalogue.get(), plan_request.data)
+            except OTPUnavailable as e:
+                return Response({"error": f"Failed to fetch stops: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            except OTPQueryError as e:
+                return Response({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+            response_data = plan_response(options, from_stop, to_stop)
+        validated = serializer.validated_data
+        if "geometry_tolerance" in validated or "geometry_precision" in validated:
+            response_data = simplify_plan_geometry(
+                response_data,
+                tolerance_m=validated.get("geometry_tolerance", 0),
+                precision=validated.get("geometry_precision", OTP_PRECISION),
+            )
+        if validated["summary"]:
+            response_data = summarize_plan(response_data)
 
-        date_obj = data.get('date')
-        time_str = data.get('time', None)
-        req_date_obj = data.get('requested_date')
-        req_time_str = data.get('requested_time', None)
+        # ---- Save search ----
+        user = request.user if request.user.is_authenticated else None
+        if not request.session.session_key:
+            request.session.create()
+        anonymous_session_key = request.session.session_key if user is None else None
+
+        log_search(
+            user=user,
+            anonymous_session_key=anonymous_session_key,
+            **plan_request.search_fields()
+        )
 
-        if not time_str or (isinstance(time_str, str) and time_str.lower() == 'timenow'):
-            time_str = datetime.now().strftime("%H:%M:%S")
+        return Response(response_data, status=status.HTTP_200_OK)
 
-        if not req_time_str or (isinstance(req_time_str, str) and req_time_str.lower() == 'timenow'):
-            req_time_str = datetime.now().strftime("%H:%M:%S")
+    def build_plan(self, plan_request):
+        """Query OTP and shape the itineraries; returns (response_data, error_response)."""
+        # -------- Plan query and closest stations, in parallel ----------
+        # The plan does not depend on the stops, so both share one deadline
+        # instead of running back to back.
+        deadline = time.monotonic() + settings.OTP_REQUEST_DEADLINE
+        client = get_otp_client()
+        executor = get_otp_executor()
+        plan_future = executor.submit(
+            client.query, plan_request.query(), plan_request.variables(), name="plan", deadline=deadline
+        )
+        stations_future = executor.submit(
+            lambda: closest_stations(stop_catalogue.get(), plan_request.data)
+        )
 
         try:
-            datetime.strptime(time_str, "%H:%M:%S")
-            datetime.strptime(req_time_str, "%H:%M:%S")
-        except ValueError:
-            return Response({"error": "Time must be in HH:MM:SS format."}, status=status.HTTP_400_BAD_REQUEST)
-
-        date_str = date_obj.strftime("%Y-%m-%d")
-        req_date_str = req_date_obj.strftime("%Y-%m-%d")
-
-        # -------- Fetch stops ----------
-        stops_query = """
-        query {
-          stops {
-            id
-            name
-            lat
-            lon
-            code
-          }
-        }
-        """
-        headers = {"Content-Type": "application/json"}
+            from_stop, to_stop = stations_future.result(timeout=max(0, deadline - time.monotonic()))
+        except OTPUnavailable as e:
+            plan_future.cancel()
+            return None, Response({"error": f"Failed to fetch stops: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except OTPQueryError as e:
+            plan_future.cancel()
+            return None, Response({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        except FuturesTimeout:
+            plan_future.cancel()
+            return None, Response({"error": "Failed to fetch stops: timed out"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
         try:
-            stops_response = requests.post(
-                "https://otp.somos.srl/otp/routers/default/index/graphql",
-                json={"query": stops_query},
-                headers=headers,
-                timeout=10
-            )
-            stops_response.raise_for_status()
-            stops_data = stops_response.json()
-        except requests.exceptions.RequestException as e:
-            return Response({"error": f"Failed to fetch stops: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            result = plan_future.result(timeout=max(0, deadline - time.monotonic()))
+        except OTPUnavailable as e:
+            return None, Response({"error": f"Failed to fetch plan: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except OTPQueryError as e:
+            return None, Response({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        except FuturesTimeout:
+            return None, Response({"error": "Failed to fetch plan: timed out"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        if "errors" in stops_data:
-            return Response({"errors": stops_data["errors"]}, status=status.HTTP_400_BAD_REQUEST)
-
-        stops = stops_data["data"]["stops"]
-
-        def find_closest_stop(lat, lon):
-            closest = None
-            min_dist = float('inf')
-            for stop in stops:
-                dist = haversine(lon, lat, stop['lon'], stop['lat'])
-                if dist < min_dist:
-                    min_dist = dist
-                    closest = stop
-            return closest
-
-        from_stop = find_closest_stop(data['fromLat'], data['fromLon'])
-        to_stop = find_closest_stop(data['toLat'], data['toLon'])
-
-        # -------- OTP Plan Query ----------
-        plan_query = """
-        query PlanTrip(
-            $fromLat: Float!, $fromLon: Float!,
-            $toLat: Float!, $toLon: Float!,
-            $date: String!, $time: String!
-        ) {
-            plan(
-                from: { lat: $fromLat, lon: $fromLon },
-                to: { lat: $toLat, lon: $toLon },
-                date: $date,
-                time: $time
-            ) {
-                itineraries {
-                    duration
-                    walkDistance
-                    legs {
-                        mode
-                        startTime
-                        endTime
-                        distance
-                        from { name }
-                        to { name }
-                        trip {
-                            routeShortName
-                            tripHeadsign
-                            route {
-                                id
-                                shortName
-                                longName
-                                agency { id name }
-                            }
-                        }
-                        legGeometry { points }
-                        steps {
-                            distance
-                            streetName
-                        }
-                    }
-                }
-            }
-        }
-        """
+        return shape_plan(result, plan_request.mode_filter, from_stop, to_stop), None
 
-        variables = {
-            "fromLat": data['fromLat'],
-            "fromLon": data['fromLon'],
-            "toLat": data['toLat'],
-            "toLon": data['toLon'],
-            "date": date_str,
-            "time": time_str,
-        }
 
-        try:
-            plan_response = requests.post(
-                "https://otp.somos.srl/otp/routers/default/index/graphql",
-                json={"query": plan_query, "variables": variables},
-                headers=headers,
-                timeout=10
-            )
-            plan_response.raise_for_status()
-            result = plan_response.json()
-        except requests.exceptions.RequestException as e:
-            return Response({"error": f"Failed to fetch plan: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-
-        if "errors" in result:
-            return Response({"errors": result["errors"]}, status=status.HTTP_400_BAD_REQUEST)
-
-        itineraries = result["data"]["plan"].get("itineraries", [])
-        options = {"walk": [], "bus": [], "bicycle": [], "scooter": [], "other": []}
-
-        for idx, itinerary in enumerate(itineraries, start=1):
-            legs = itinerary.get("legs", []) or []
-            modes_in_itinerary = {(leg.get("mode") or "").upper() for leg in legs}
-
-            if mode_filter != "ALL":
-                if mode_filter == "WALK" and modes_in_itinerary != {"WALK"}:
-                    continue
-                elif mode_filter == "BUS" and "BUS" not in modes_in_itinerary:
-                    continue
-                elif mode_filter == "BICYCLE" and "BICYCLE" not in modes_in_itinerary:
-                    continue
-                elif mode_filter == "SCOOTER" and "SCOOTER" not in modes_in_itinerary:
-                    continue
-                elif mode_filter not in modes_in_itinerary:
-                    continue
-
-            itinerary_total_m = int(round(sum((leg.get("distance") or 0) for leg in legs)))
-            walk_total_m = int(round(itinerary.get("walkDistance") or 0))
-
-            legs_out = []
-            for leg in legs:
-                mode = (leg.get("mode") or "UNKNOWN").lower()
-                start_ts = leg.get("startTime")
-                end_ts = leg.get("endTime")
-                from_name = leg.get("from", {}).get("name") or "Unknown stop"
-                to_name = leg.get("to", {}).get("name") or "Unknown stop"
-                geometry = (leg.get("legGeometry") or {}).get("points")
-                leg_distance_m = int(round(leg.get("distance") or 0))
-
-                if start_ts and end_ts:
-                    start_dt = datetime.fromtimestamp(start_ts / 1000)
-                    end_dt = datetime.fromtimestamp(end_ts / 1000)
-                    duration_s = int((end_ts - start_ts) / 1000)
-                    duration_str = f"{duration_s // 60}m {duration_s % 60}s"
-                    start_time_iso = start_dt.isoformat()
-                    end_time_iso = end_dt.isoformat()
-                else:
-                    duration_s = 0
-                    duration_str = "N/A"
-                    start_time_iso = None
-                    end_time_iso = None
-
-                leg_obj = {
-                    "type": mode,
-                    "from": from_name,
-                    "to": to_name,
-                    "duration": duration_str,
-                    "duration_s": duration_s,
-                    "start_time": start_time_iso,
-                    "end_time": end_time_iso,
-                    "geometry": geometry,
-                    "distance_m": leg_distance_m,
-                }
+class ItineraryDetailView(APIView):
+    """Leg geometry and walk steps of one itinerary from a summary plan."""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [AllowAny]
 
-                if mode == "bus":
-                    bus_trip = leg.get("trip") or {}
-                    route_info = bus_trip.get("route") or {}
-                    agency_info = route_info.get("agency") or {}
-
-                    authority_id = agency_info.get("id")
-                    authority_name = agency_info.get("name")
-
-                    leg_obj.update({
-                        "route_short": bus_trip.get("routeShortName"),
-                        "route_long": route_info.get("longName"),
-                        "headsign": bus_trip.get("tripHeadsign"),
-                        "authority_id": authority_id,
-                        "authority_name": authority_name,
-                        "bus_name": (
-                            f"Bus {bus_trip.get('routeShortName') or ''} - {bus_trip.get('tripHeadsign') or ''}".strip()
-                            or authority_name
-                        ),
-                    })
-
-                if mode == "walk" and leg.get("steps"):
-                    leg_obj["walk_steps"] = [
-                        {"streetName": st.get("streetName"), "distance_m": int(round(st.get("distance") or 0))}
-                        for st in (leg.get("steps") or [])
-                    ]
-
-                legs_out.append(leg_obj)
-
-            # ---- Segments aggregation ----
-            segments = []
-            for lg in legs_out:
-                if not segments or segments[-1]["mode"] != lg["type"]:
-                    seg = {
-                        "mode": lg["type"],
-                        "from": lg["from"],
-                        "to": lg["to"],
-                        "distance_m": lg["distance_m"],
-                        "duration_s": lg["duration_s"],
-                        "legs_count": 1,
-                    }
-                    if lg["type"] == "bus":
-                        seg["routes"] = [lg.get("route_short")] if lg.get("route_short") else []
-                    segments.append(seg)
-                else:
-                    segments[-1]["to"] = lg["to"]
-                    segments[-1]["distance_m"] += lg["distance_m"]
-                    segments[-1]["duration_s"] += lg["duration_s"]
-                    segments[-1]["legs_count"] += 1
-                    if lg["type"] == "bus" and lg.get("route_short"):
-                        routes = segments[-1].setdefault("routes", [])
-                        if lg["route_short"] not in routes:
-                            routes.append(lg["route_short"])
-
-            # ---- Primary mode ----
-            primary_mode = "other"
-            if modes_in_itinerary == {"WALK"}:
-                primary_mode = "walk"
-            elif "BUS" in modes_in_itinerary:
-                primary_mode = "bus"
-            elif "BICYCLE" in modes_in_itinerary:
-                primary_mode = "bicycle"
-            elif "SCOOTER" in modes_in_itinerary:
-                primary_mode = "scooter"
-
-            options[primary_mode].append({
-                "option": idx,
-                "total_distance_m": itinerary_total_m,
-                "walk_distance_m": walk_total_m,
-                "legs": legs_out,
-                "segments": segments
-            })
+    def get(self, request, itinerary_id):
+        itinerary = itinerary_store.get(itinerary_id)
+        if itinerary is None:
+            return Response({"error": "Itinerary not found or expired, plan the trip again."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(itinerary, status=status.HTTP_200_OK)
 
-        # ---- Save search ----
-        user = request.user if request.user.is_authenticated else None
-        if not request.session.session_key:
-            request.session.create()
-        anonymous_session_key = request.session.session_key if user is None else None
 
-        trip_datetime_naive = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M:%S")
-        trip_datetime = timezone.make_aware(trip_datetime_naive)
-        req_datetime_naive = datetime.strptime(f"{req_date_str} {req_time_str}", "%Y-%m-%d %H:%M:%S")
-        req_datetime = timezone.make_aware(req_datetime_naive)
 
-        Search.objects.create(
-            user=user,
-            anonymous_session_key=anonymous_session_key,
-            from_lat=data['fromLat'],
-            from_lon=data['fromLon'],
-            to_lat=data['toLat'],
-            to_lon=data['toLon'],
-            trip_date=trip_datetime,
-            requested_at=req_datetime,
-            modes=mode_filter
-        )
+class PlanTripBatchView(APIView):
+    """Plans for many origin/destination pairs, at most PLAN_BATCH_CONCURRENCY at a time.
+
+    Pairs run on the worker's batch pool (PLAN_BATCH_WORKERS threads for all
+    batches together), not on the pool the interactive views share.
+
+    Every pair gets its own entry in `results`; a failed pair carries its
+    error and HTTP status instead of failing the whole batch.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        serializer = PlanTripBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"success": False, "error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
 
-        response_data = {
-            "fromStationName": from_stop['name'] if from_stop else None,
-            "toStationName": to_stop['name'] if to_stop else None,
-            "options": options
+        # one catalogue snapshot for every pair of the batch
+        try:
+            snapshot = stop_catalogue.get()
+        except OTPUnavailable as e:
+            return Response({"error": f"Failed to fetch stops: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except OTPQueryError as e:
+            return Response({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        pairs = data["pairs"]
+        shared = {
+            "date": data["date"],
+            "time": data["time"],
+            "requested_date": data["date"],
+            "requested_time": data["time"],
+            "mode": data["mode"],
         }
+        executor = get_batch_executor()
+        results = [None] * len(pairs)
+        pending = {}
+        next_index = 0
+        while next_index < len(pairs) or pending:
+            while next_index < len(pairs) and len(pending) < settings.PLAN_BATCH_CONCURRENCY:
+                future = executor.submit(self.plan_pair, snapshot, {**shared, **pairs[next_index]}, data["summary"])
+                pending[future] = next_index
+                next_index += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                pair = pairs[index]
+                results[index] = {
+                    "index": index,
+                    "from": {"lat": pair["fromLat"], "lon": pair["fromLon"]},
+                    "to": {"lat": pair["toLat"], "lon": pair["toLon"]},
+                    **future.result(),
+                }
+
+        return Response({"success": True, "count": len(results), "results": results}, status=status.HTTP_200_OK)
+
+    def plan_pair(self, snapshot, pair_data, summary):
+        """Plan one pair through the plan cache; returns the result entry body."""
+        try:
+            plan_request = PlanRequest(pair_data)
+        except PlanRequestError as e:
+            return {"success": False, "status": status.HTTP_400_BAD_REQUEST, "error": str(e)}
+
+        cache_key = plan_request.cache_key()
+        options = plan_cache.get(cache_key)
+        if options is None:
+            try:
+                # the client's own OTP_REQUEST_DEADLINE bounds the attempts and retries
+                result = get_otp_client().query(plan_request.query(), plan_request.variables(), name="plan")
+            except OTPUnavailable as e:
+                return {"success": False, "status": status.HTTP_503_SERVICE_UNAVAILABLE, "error": f"Failed to fetch plan: {str(e)}"}
+            except OTPQueryError as e:
+                return {"success": False, "status": status.HTTP_400_BAD_REQUEST, "errors": e.errors}
+            options = shape_options(result, plan_request.mode_filter)
+            plan_cache.set(cache_key, options)
+        response_data = plan_response(options, *closest_stations(snapshot, pair_data))
+
+        if summary:
+            response_data = summarize_plan(response_data)
+        return {"success": True, "plan": response_data}
 
-        return Response(response_data, status=status.HTTP_200_OK)
 
 '''import requests
 from datetime import datetime
@@ -920,6 +813,7 @@ class PlanTripView(APIView):
 def link_anonymous_searches_to_user_signal(sender, request, user, **kwargs):
     session_key = request.session.session_key
     if session_key:
+        flush_searches()  # searches still queued in this worker must be linked too
         Search.objects.filter(anonymous_session_key=session_key).update(user=user, anonymous_session_key=None)
 
 # ------------------------------
@@ -927,117 +821,105 @@ def link_anonymous_searches_to_user_signal(sender, request, user, **kwargs):
 # ------------------------------
 
 class StopsView(APIView):
-    def get(self, request):
-        graphql_query = """
-        query {
-          stops {
-            id
-            name
-            lat
-            lon
-            code
-          }
-        }
-        """
+    """Stops of the Rende/Cosenza area, or one page of the stops in a bbox or radius."""
 
-        json_data = {"query": graphql_query}
-        headers = {"Content-Type": "application/json"}
+    def get(self, request):
+        query = StopQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response({"success": False, "error": query.errors}, status=status.HTTP_400_BAD_REQUEST)
 
+        store = get_gtfs_store()
         try:
-            resp = requests.post(
-                "http://server.somos.srl:8080/otp/routers/default/index/graphql",
-                json=json_data,
-                headers=headers,
-                timeout=10
-            )
-            resp.raise_for_status()
-            result = resp.json()
-
-            if "errors" in result:
-                return Response({"errors": result["errors"]}, status=status.HTTP_400_BAD_REQUEST)
-
-            all_stops = result.get("data", {}).get("stops", [])
-
-            # Filter for Rende and Cosenza
-            def in_rende_or_cosenza(stop):
-                lat = stop.get("lat")
-                lon = stop.get("lon")
-                if not lat or not lon:
-                    return False
+            catalogue = store if store is not None else stop_catalogue.get()
+        except OTPQueryError as e:
+            return Response({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        except OTPUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-                in_cosenza = 39.28 <= lat <= 39.32 and 16.22 <= lon <= 16.28
-                in_rende = 39.30 <= lat <= 39.38 and 16.17 <= lon <= 16.26
-                return in_cosenza or in_rende
+        stale = store is None and stop_catalogue.stale
+        if "bbox" in query.validated_data or "radius" in query.validated_data:
+            try:
+                response_data = query_stops(catalogue.index, catalogue.version, query.validated_data)
+            except InvalidCursor as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            if stale:
+                response_data["stale"] = True
+            return Response(response_data, status=status.HTTP_200_OK)
+        return stops_payload(catalogue, query.validated_data.get("since"), stale).response(request)
 
-            filtered_stops = [stop for stop in all_stops if in_rende_or_cosenza(stop)]
 
-            return Response({"stops": filtered_stops}, status=status.HTTP_200_OK)
+class StopTileView(APIView):
+    """Stops of one z/x/y map tile, clustered at low zoom."""
 
-        except requests.RequestException as e:
+    def get(self, request, z, x, y):
+        store = get_gtfs_store()
+        try:
+            catalogue = store if store is not None else stop_catalogue.get()
+        except OTPQueryError as e:
+            return Response({"errors": e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        except OTPUnavailable as e:
             return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
+        try:
+            payload = tile_payload(catalogue, z, x, y, stale=store is None and stop_catalogue.stale)
+        except InvalidTile as e:
+            return Response({"success": False, "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return payload.response(request)
+
 
 # ------------------------------
 # Stop Schedule
 # ------------------------------
 
 def get_stop_schedule(request, stop_id):
-    query = """
-    query ($stopId: String!) {
-      stop(id: $stopId) {
-        name
-        stoptimesWithoutPatterns (numberOfDepartures: 300) {
-          scheduledArrival
-          realtimeArrival
-          scheduledDeparture
-          realtimeDeparture
-          trip {
-            route {
-              shortName
-              longName
-            }
-          }
-        }
-      }
-    }
-    """
-    variables = {"stopId": stop_id}
-    response = requests.post(
-        'http://server.somos.srl:8080/otp/routers/default/index/graphql',
-        json={'query': query, 'variables': variables}
-    )
-    data = response.json()
-
-    if "errors" in data or not data.get("data") or not data["data"].get("stop"):
+    try:
+        board = get_board(stop_id)
+    except UnknownStop:
         return render(request, "stop_schedule.html", {
             "stop_name": "Unknown Stop",
             "upcoming_trips": []
         })
-
-    stop = data["data"]["stop"]
-    now_seconds = datetime.now().hour * 3600 + datetime.now().minute * 60 + datetime.now().second
-    midnight_seconds = 86400
-
-    filtered = [
-        t for t in stop.get("stoptimesWithoutPatterns", [])
-        if t["realtimeArrival"] is not None and now_seconds <= t["realtimeArrival"] <= midnight_seconds
-    ]
-
-    # Optional: sort and limit
-    filtered = sorted(filtered, key=lambda t: t["realtimeArrival"])
-
-    upcoming_trips = []
-    for t in filtered:
-        arrival_sec = t["realtimeArrival"] or t["scheduledArrival"]
-        departure_sec = t["realtimeDeparture"] or t["scheduledDeparture"]
-        upcoming_trips.append({
-            "route": t["trip"]["route"]["shortName"],
-            "name": t["trip"]["route"]["longName"],
-            "arrival": str(timedelta(seconds=arrival_sec))[:-3],
-            "departure": str(timedelta(seconds=departure_sec))[:-3]
-        })
+    except BoardUnavailable as e:
+        return render(request, "stop_schedule.html", {
+            "stop_name": e.stop_name or "Unknown Stop",
+            "upcoming_trips": []
+        }, status=503)
 
     return render(request, "stop_schedule.html", {
-        "stop_name": stop["name"],
-        "upcoming_trips": upcoming_trips
+        "stop_name": board["stop_name"],
+        "upcoming_trips": board["upcoming_trips"],
+        "stale": board["stale"]
     })
+
+
+def departures_response(request, board):
+    """JSON board with a strong ETag, cacheable until the end of the minute."""
+    etag = board_etag(board)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={60 - datetime.now().second}",
+    }
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse({
+            "stop_id": board["stop_id"],
+            "stop_name": board["stop_name"],
+            "stale": board["stale"],
+            "upcoming_trips": board["upcoming_trips"],
+        })
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+
+def get_stop_departures(request, stop_id):
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    try:
+        board = get_board(stop_id)
+    except UnknownStop:
+        return JsonResponse({"error": "Unknown stop."}, status=status.HTTP_404_NOT_FOUND)
+    except BoardUnavailable as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return departures_response(request, board)
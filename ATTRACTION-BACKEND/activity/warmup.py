@@ -0,0 +1,105 @@
+"""Warm-up of a freshly started worker.
+
+The WSGI / ASGI entry points call `warm_up_on_first_request()`: every
+process then starts `start_warm_up()` on the first request it serves (under
+ASGI already on lifespan startup), so servers that fork after loading the
+application warm each worker rather than their parent. In a daemon thread it
+does the work later requests would otherwise pay for: loading the stop
+catalogue (or GTFS store) and its spatial index, opening a pooled connection
+to OTP, resolving the URLconf and building the serializers. Every step is
+timed and logged; a step that fails (OTP unreachable, say) is logged and
+skipped, and no request ever waits for any of it.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+
+logger = logging.getLogger(__name__)
+
+WARMUP_QUERY = "{ __typename }"
+
+_started_pid = None
+_started_lock = threading.Lock()
+
+
+def load_catalogue():
+    from .gtfs import get_gtfs_store
+    from .stop_catalogue import stop_catalogue
+
+    store = get_gtfs_store()
+    catalogue = store if store is not None else stop_catalogue.get()
+    # the first lookup also initialises the numpy kernels behind the index
+    catalogue.index.nearest_k(39.3, 16.25, 1)
+    return f"{len(catalogue.stops)} stops"
+
+
+def prime_otp_pool():
+    from .otp_client import get_otp_client
+
+    timeout = (settings.OTP_CONNECT_TIMEOUT, settings.OTP_CONNECT_TIMEOUT)
+    get_otp_client().query(WARMUP_QUERY, name="warmup", timeout=timeout, coalesce=False)
+
+
+def prepare_documents():
+    """Build the GraphQL documents, URLconf and serializers the views use."""
+    from django.urls import get_resolver
+
+    from .serializers import PlanTripBatchSerializer, PlanTripSerializer, StopQuerySerializer
+
+    # importing the URLconf imports the views and, with them, every GraphQL document
+    get_resolver().url_patterns
+    for serializer in (PlanTripSerializer, PlanTripBatchSerializer, StopQuerySerializer):
+        serializer().fields
+
+
+WARMUP_STEPS = (
+    ("documents", prepare_documents),
+    ("catalogue", load_catalogue),
+    ("otp pool", prime_otp_pool),
+)
+
+
+def warm_up():
+    """Run every warm-up step; returns {step: (seconds, error or detail)}."""
+    report = {}
+    total = time.perf_counter()
+    for name, step in WARMUP_STEPS:
+        start = time.perf_counter()
+        try:
+            detail = step()
+        except Exception as e:
+            detail = e
+            logger.warning("Warm-up step %s failed: %s", name, e)
+        report[name] = (time.perf_counter() - start, detail)
+    logger.info(
+        "Worker warm-up finished in %.0f ms (%s)",
+        (time.perf_counter() - total) * 1000,
+        ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, (seconds, _) in report.items()),
+    )
+    return report
+
+
+def start_warm_up():
+    """Warm the worker up in the background, once per process."""
+    global _started_pid
+    if not settings.WORKER_WARMUP:
+        return
+    with _started_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    threading.Thread(target=warm_up, name="worker-warm-up", daemon=True).start()
+
+
+def _start_on_request(sender, **kwargs):
+    if _started_pid != os.getpid():
+        start_warm_up()
+
+
+def warm_up_on_first_request():
+    """Warm each process up from the first request it serves, after any fork."""
+    request_started.connect(_start_on_request, dispatch_uid="activity.warmup")
@@ -13,4 +13,24 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from activity.otp_client import close_async_otp_client  # noqa: E402
+from activity.warmup import start_warm_up, warm_up_on_first_request  # noqa: E402
+warm_up_on_first_request()
+
+
+async def application(scope, receive, send):
+    if scope["type"] != "lifespan":
+        return await django_application(scope, receive, send)
+    # Django does not speak the lifespan protocol; use it to warm the worker up and
+    # to close its OTP client
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            start_warm_up()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_async_otp_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -182,6 +182,10 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Files the workers write at runtime live outside the source tree, under
+# $ATTRACTION_DATA_DIR (default ~/.attraction)
+DATA_DIR = os.environ.get('ATTRACTION_DATA_DIR', os.path.join(os.path.expanduser('~'), '.attraction'))
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
@@ -189,3 +193,92 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# OpenTripPlanner
+OTP_GRAPHQL_URL = 'https://otp.somos.srl/otp/routers/default/index/graphql'
+# keep-alive connection pool shared by all OTP queries of a worker
+OTP_CONNECT_TIMEOUT = 3.05
+OTP_READ_TIMEOUT = 10
+OTP_MAX_RETRIES = 2
+OTP_RETRY_BACKOFF = 0.3
+OTP_POOL_SIZE = 10
+# connection limit of the per-event-loop client used by the async views
+OTP_ASYNC_MAX_CONNECTIONS = 100
+# circuit breaker: fail fast after this many consecutive OTP failures, probe
+# again after the reset timeout (seconds)
+OTP_CIRCUIT_FAILURE_THRESHOLD = 5
+OTP_CIRCUIT_RESET_TIMEOUT = 30
+OTP_CIRCUIT_HALF_OPEN_CALLS = 1
+# overall budget of one OTP query, retries included, and of the upstream calls
+# of one trip-planning request
+OTP_REQUEST_DEADLINE = 12
+
+# Trip plan cache: near-duplicate requests (same rounded origin/destination,
+# date, departure-time bucket and mode) reuse one OTP answer
+PLAN_CACHE_SIZE = 512
+PLAN_CACHE_TTL = 300
+PLAN_CACHE_COORD_PRECISION = 3
+PLAN_CACHE_TIME_BUCKET = 300
+# Summary plans: leg geometry and walk steps of each returned itinerary are kept
+# server-side for the itinerary detail endpoint
+ITINERARY_STORE_SIZE = 4096
+ITINERARY_STORE_TTL = 900
+# Batch trip planning: pairs per request, plans computed at once per request, and
+# threads shared by all batches of a worker (apart from the OTP_POOL_SIZE pool)
+PLAN_BATCH_MAX_PAIRS = 100
+PLAN_BATCH_CONCURRENCY = 4
+PLAN_BATCH_WORKERS = 4
+# seconds before the in-process stop catalogue is refreshed in the background
+OTP_STOP_CATALOGUE_TTL = 600
+# memory-mapped stop catalogue shared by the workers of a host (None keeps it per worker),
+# and how often (s) workers look for a version published by another worker
+OTP_STOP_CATALOGUE_PATH = os.path.join(DATA_DIR, 'cache', 'stop_catalogue.bin')
+OTP_STOP_CATALOGUE_CHECK_INTERVAL = 5
+# bbox / radius stop queries: default and maximum page size, largest radius (m)
+STOPS_PAGE_SIZE = 200
+STOPS_PAGE_MAX = 1000
+STOPS_MAX_RADIUS = 50000
+# rendered stops lists kept per catalogue version, and how many versions `?since=` can diff against
+STOPS_PAYLOAD_CACHE_SIZE = 64
+STOPS_PAYLOAD_VERSIONS = 8
+# stop map tiles: rendered tiles kept, last zoom that is clustered, cluster grid per tile side
+STOPS_TILE_CACHE_SIZE = 4096
+STOPS_TILE_CLUSTER_MAX_ZOOM = 15
+STOPS_TILE_GRID = 8
+# last good departure board per stop, served (marked stale) while OTP is down
+SCHEDULE_STALE_CACHE_SIZE = 2048
+SCHEDULE_STALE_TTL = 6 * 3600
+# station boards computed per stop and minute, shared by the page and the JSON API
+BOARD_CACHE_SIZE = 2048
+# live board streams (SSE, ASGI only): refresh interval, keep-alive comment
+# interval and stream lifetime in seconds, client reconnect delay, and events
+# buffered per listener
+BOARD_STREAM_INTERVAL = 15
+BOARD_STREAM_KEEPALIVE = 20
+BOARD_STREAM_MAX_SECONDS = 600
+BOARD_STREAM_RETRY_MS = 3000
+BOARD_STREAM_QUEUE_SIZE = 16
+
+# Search history: searches are written behind the response (rows queued at most,
+# rows per INSERT, seconds between flushes; False writes each search inside its request)
+SEARCH_LOG_WRITE_BEHIND = True
+SEARCH_LOG_MAX_PENDING = 10000
+SEARCH_LOG_BATCH_SIZE = 200
+SEARCH_LOG_FLUSH_INTERVAL = 2
+# monthly Search partitions (PostgreSQL): months created ahead, months kept before the
+# current one, and where `manage.py search_partitions` archives older months
+SEARCH_PARTITIONS_AHEAD = 3
+SEARCH_RETENTION_MONTHS = 12
+SEARCH_ARCHIVE_DIR = os.path.join(DATA_DIR, 'archive', 'search')
+
+# Local GTFS store written by `manage.py ingest_gtfs`. When present it answers
+# the stops list and station boards; OTP stays in use for routing and, with
+# GTFS_REALTIME_OVERLAY, for live times on the station page.
+GTFS_STORE_PATH = os.path.join(DATA_DIR, 'gtfs', 'feed.npz')
+GTFS_FEED_ID = '1'
+GTFS_REALTIME_OVERLAY = False
+# seconds before a failed departure index build is tried again
+GTFS_INDEX_RETRY_INTERVAL = 300
+# preload the stop catalogue and OTP connections in the background when a worker starts
+WORKER_WARMUP = True
+
+
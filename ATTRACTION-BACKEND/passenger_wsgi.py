@@ -25,3 +25,6 @@ if os.path.exists(activate_this):
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+from activity.warmup import warm_up_on_first_request  # noqa: E402
+warm_up_on_first_request()